@@ -0,0 +1,58 @@
+"""Facet extraction speed on large multilingual texts.
+
+Times :func:`service.facets.extract_spans` against the previous approach (two
+separate regex scans over two separate UTF-8 encodings, mentions and links
+only). The extractor's invariants are checked in ``tests/test_facets.py``.
+
+    cd src && python -m benchmarks.bench_facets --sizes 10000 100000 1000000
+"""
+import argparse
+import re
+import statistics
+import time
+
+from service.facets import extract_spans
+
+SENTENCES = [
+    'Ping @alice.bsky.social about https://example.com/docs?page=2#intro #atproto ',
+    'Ci vediamo domani al caffè con @marco.test, porta la torta! #festa ',
+    '東京で会いましょう @yuki.example.jp https://例え.jp は無視 #日本語タグ ',
+    'مرحبا بالجميع @omar.test #مرحبا https://example.org/ar ',
+    'Family 👨‍👩‍👧 trip 🇮🇹 to see 👍🏽 https://photos.example.com/a/b #travel2024 ',
+]
+
+def legacy_spans(text: str):
+    """What the old mention and URL parsers did: two encodes, two scans."""
+    mention_regex = rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
+    url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
+    spans = [(m.start(1), m.end(1)) for m in re.finditer(mention_regex, text.encode('UTF-8'))]
+    spans += [(m.start(1), m.end(1)) for m in re.finditer(url_regex, text.encode('UTF-8'))]
+    return spans
+
+def make_text(size: int) -> str:
+    text = ''.join(SENTENCES)
+    return (text * (size // len(text) + 1))[:size]
+
+def timed(function, text: str, rounds: int) -> float:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(text)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'chars':>9} {'spans':>7} {'extract ms':>11} {'legacy ms':>10} {'legacy spans':>13}")
+    for size in args.sizes:
+        text = make_text(size)
+        spans = len(extract_spans(text))
+        print(f'{size:>9} {spans:>7} {timed(extract_spans, text, args.rounds) * 1000:>11.2f} '
+              f'{timed(legacy_spans, text, args.rounds) * 1000:>10.2f} {len(legacy_spans(text)):>13}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Page fetch time of /list_posts as the Posts collection grows.
+
+Runs against the database configured for the bot (BSKY_BOT_DATABASE, MONGO_HOST,
+MONGO_PORT), using a separate ``<db>_bench`` database, or against mongomock with
+``--mongomock``. Mongomock has no real indexes, so only a local mongod shows the
+flat curve; mongomock is there to smoke-test the script offline.
+
+    cd src && python -m benchmarks.bench_list_posts --sizes 1000 10000 100000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks.common import reconnect
+from dal import db
+from service.bluesky_service import AsyncBlueskyService
+
+def seed(total: int):
+    """Grow the collection to ``total`` documents with raw inserts."""
+    collection = db.Posts._get_collection()
+    current = collection.count_documents({})
+    batch = []
+    for post_id in range(current + 1, total + 1):
+        batch.append({'_id': post_id, 'text': f'post number {post_id}', 'cid': f'cid{post_id}', 'uri': f'at://bench/{post_id}'})
+        if len(batch) == 5000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    db.Posts.ensure_indexes()
+
+async def time_pages(service: AsyncBlueskyService, total: int, rounds: int):
+    first, middle = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await service.list_posts()
+        first.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await service.list_posts(before_id=total // 2)
+        middle.append(time.perf_counter() - start)
+    return statistics.median(first), statistics.median(middle)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--mongomock', action='store_true')
+    args = parser.parse_args()
+
+    reconnect(args.mongomock)
+    db.Posts.drop_collection()
+    # list_posts only touches Mongo, no Bluesky client needed
+    service = AsyncBlueskyService(client=None, resolver=None)
+
+    print(f"{'posts':>10} {'first page ms':>14} {'middle page ms':>15}")
+    for size in sorted(args.sizes):
+        seed(size)
+        first, middle = await time_pages(service, size, args.rounds)
+        print(f'{size:>10} {first * 1000:>14.2f} {middle * 1000:>15.2f}')
+
+    db.Posts.drop_collection()
+
+if __name__ == '__main__':
+    asyncio.run(main())
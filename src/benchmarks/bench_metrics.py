@@ -0,0 +1,164 @@
+"""Cost of the instrumentation, and a scrape of the metrics endpoint.
+
+Times a bare handler callback against the same one wrapped by
+:func:`service.metrics.timed_callback` (which also opens the update's trace),
+plus ``Histogram.observe``, ``Counter.inc`` and a tracing span, inside a trace
+and outside of one. Then runs posts, reposts and deletes through
+AsyncBlueskyService against the fake PDS, serves ``/metrics`` on a local port,
+scrapes it and checks the result: every histogram's buckets are cumulative
+and end at its count, and the XRPC call counts match what the fake PDS served.
+The Mongo listener is fed from several threads at once to check no
+observation is lost.
+
+    cd src && python -m benchmarks.bench_metrics --mongomock --calls 200000
+"""
+import argparse
+import asyncio
+import re
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict
+
+from benchmarks.bench_service import make_jpeg, start_pds
+
+SAMPLE = re.compile(r'^(?P<name>[a-z_]+)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+METHOD = re.compile(r'method="([^"]+)"')
+
+def parse(text: str) -> Dict[str, Dict[str, float]]:
+    """``{metric name: {label string: value}}`` from the text format."""
+    samples: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = SAMPLE.match(line)
+        assert match, f'unparseable line {line!r}'
+        samples[match['name']][match['labels'] or ''] = float(match['value'])
+    return samples
+
+def check_histograms(samples: Dict[str, Dict[str, float]]):
+    for name in [name[:-len('_count')] for name in samples if name.endswith('_count')]:
+        for labels, count in samples[f'{name}_count'].items():
+            prefix = f'{labels},' if labels else ''
+            buckets = [value for key, value in samples[f'{name}_bucket'].items()
+                       if key.startswith(prefix) and key[len(prefix):].startswith('le=')]
+            assert buckets == sorted(buckets), f'{name}{{{labels}}} buckets are not cumulative'
+            assert buckets[-1] == count, f'{name}{{{labels}}} +Inf bucket {buckets[-1]} != count {count}'
+
+async def time_handlers(calls: int):
+    from service import tracing
+    from service.metrics import errors, handler_seconds, timed_callback
+
+    async def handler(update, context):
+        return None
+
+    wrapped = timed_callback(handler)
+    for name, callback in (('bare handler', handler), ('timed handler', wrapped)):
+        start = time.perf_counter()
+        for _ in range(calls):
+            await callback(None, None)
+        print(f'{name:<22} {(time.perf_counter() - start) / calls * 1e9:>8.0f} ns/call')
+
+    child = handler_seconds.labels('bench')
+    counter = errors.labels('Bench')
+    for name, function in (('Histogram.observe', lambda: child.observe(0.003)), ('Counter.inc', counter.inc)):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        print(f'{name:<22} {(time.perf_counter() - start) / calls * 1e9:>8.0f} ns/call')
+
+    def spans(count: int):
+        for _ in range(count):
+            with tracing.span('bench'):
+                pass
+    start = time.perf_counter()
+    spans(calls)
+    print(f"{'span, no trace':<22} {(time.perf_counter() - start) / calls * 1e9:>8.0f} ns/call")
+    # traces the size of a real update, so the span cap isn't what's measured
+    per_trace = tracing.MAX_SPANS - 1
+    start = time.perf_counter()
+    for _ in range(calls // per_trace):
+        trace, token = tracing.start_trace('bench')
+        spans(per_trace)
+        tracing.finish_trace(trace, token)
+    print(f"{'span, in a trace':<22} {(time.perf_counter() - start) / (calls // per_trace * per_trace) * 1e9:>8.0f} ns/call")
+
+def check_mongo_listener(threads: int, events: int):
+    from service.metrics import MongoCommandListener, mongo_seconds
+
+    listener = MongoCommandListener()
+    event = SimpleNamespace(command_name='benchfind', duration_micros=1500)
+
+    def feed():
+        for _ in range(events):
+            listener.succeeded(event)
+    workers = [threading.Thread(target=feed) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    observed = sum(mongo_seconds.labels('benchfind').counts)
+    assert observed == threads * events, f'{observed} of {threads * events} Mongo events recorded'
+    print(f'Mongo listener: {observed} events from {threads} threads, none lost')
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200000, help='calls per micro-benchmark')
+    parser.add_argument('--iterations', type=int, default=10, help='post/repost/delete rounds against the fake PDS')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--mongomock', action='store_true')
+    args = parser.parse_args()
+    args.jitter, args.error_rate = 0.0, 0.0
+
+    pds = start_pds(args)
+
+    from benchmarks.common import reconnect
+    from dal import db
+    from service import metrics
+    from service.bluesky_service import AsyncBlueskyService
+    from service.http import get_http_client
+    from service.images import ImageRef
+    reconnect(args.mongomock)
+    db.Posts.drop_collection()
+
+    await time_handlers(args.calls)
+    check_mongo_listener(threads=8, events=20000)
+
+    service = await AsyncBlueskyService.create()
+    jpeg = make_jpeg()
+    for i in range(args.iterations):
+        await service.post(f'metrics round {i} for @alice.test', [ImageRef(data=jpeg)])
+        post = await asyncio.to_thread(lambda: db.Posts.objects.order_by('-id').first())
+        await service.repost(f'https://bsky.app/profile/bob.test/post/3k{i:011d}')
+        await service.delete_post(post.id)
+
+    port = await metrics.start_server('127.0.0.1', 0)
+    start = time.perf_counter()
+    response = await get_http_client().get(f'http://127.0.0.1:{port}/metrics')
+    scrape_ms = (time.perf_counter() - start) * 1000
+    response.raise_for_status()
+    await metrics.stop_server()
+
+    samples = parse(response.text)
+    check_histograms(samples)
+    scraped = {METHOD.search(labels)[1]: int(count)
+               for labels, count in samples['bot_xrpc_seconds_count'].items()}
+    with pds._lock:
+        served = {nsid: count for nsid, count in pds.requests.items()}
+    for nsid, count in served.items():
+        assert scraped.get(nsid) == count, f'{nsid}: fake PDS served {count}, metrics counted {scraped.get(nsid)}'
+
+    print(f'\nScraped {len(response.content)} bytes in {scrape_ms:.1f} ms, histograms consistent, XRPC counts match the fake PDS\n')
+    print(f"{'XRPC method':<40} {'calls':>6} {'mean ms':>8}")
+    sums = samples['bot_xrpc_seconds_sum']
+    for labels, count in sorted(samples['bot_xrpc_seconds_count'].items()):
+        if count:
+            method = METHOD.search(labels)[1]
+            print(f'{method:<40} {int(count):>6} {sums[labels] / count * 1000:>8.2f}')
+    for name in ('bot_image_bytes_total', 'bot_cache_hits_total', 'bot_cache_misses_total'):
+        print(f"{name:<40} " + ', '.join(f'{labels}={int(value)}' for labels, value in sorted(samples[name].items())))
+    pds.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
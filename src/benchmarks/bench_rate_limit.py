@@ -0,0 +1,102 @@
+"""Bursts against a rate-limited fake PDS, with and without the client-side limiter.
+
+The fake PDS allows ``--rate-limit`` requests and ``--write-limit`` write points
+per ``--window`` seconds and answers 429 past that, like Bluesky. Each round
+fetches one quoted post ``--reads`` times concurrently, resolves ``--reads``
+distinct handles, posts ``--posts`` texts at once and deletes them all with one
+multi-delete. It reports how long that took, how many 429s the server sent and
+how many operations failed. Without the limiter the burst runs straight into
+the limits. With it, calls wait for their budget, and the concurrent identical
+reads collapse into a single getRecord and resolveHandle.
+
+    cd src && python -m benchmarks.bench_rate_limit --mongomock --posts 30 --window 5
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.fake_pds import FakePds
+
+async def burst(service, pds: FakePds, posts: int, reads: int, round_name: str):
+    from dal import db
+    from service.bluesky_service import post_ref_cache
+    from service.handles import handle_resolver
+
+    handle_resolver.cache.clear()
+    post_ref_cache.clear()
+    pds.reset_rate_limits()
+    pds.reset_counters()
+    start = time.perf_counter()
+
+    # a url the service hasn't seen, so every read below misses the caches at once
+    quoted = f'https://bsky.app/profile/{round_name}.test/post/3kratelimit'
+    fetched = await asyncio.gather(*(service.fetch_post(quoted) for _ in range(reads)), return_exceptions=True)
+    fetched += await asyncio.gather(*(handle_resolver.resolve(f'{round_name}{i}.test') for i in range(reads)), return_exceptions=True)
+    posted = await asyncio.gather(*(service.post(f'{round_name} burst {i}') for i in range(posts)), return_exceptions=True)
+    ids = await asyncio.to_thread(lambda: [post.id for post in db.Posts.objects(text__startswith=f'{round_name} burst')])
+    deleted = await service.delete_posts(ids) if ids else {}
+
+    elapsed = time.perf_counter() - start
+    failed = sum(isinstance(result, Exception) for result in fetched + posted) + sum(error is not None for error in deleted.values())
+    with pds._lock:
+        served, throttled = dict(pds.requests), sum(pds.throttled.values())
+    return {
+        'elapsed': elapsed,
+        'throttled': throttled,
+        'failed': failed,
+        'getRecord': served.get('com.atproto.repo.getRecord', 0),
+        'resolveHandle': served.get('com.atproto.identity.resolveHandle', 0),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=30, help='posts created (and then deleted) at once')
+    parser.add_argument('--reads', type=int, default=80, help='concurrent fetches of one quoted post, and distinct handles resolved')
+    parser.add_argument('--rate-limit', type=int, default=60, help='requests per window the fake PDS allows')
+    parser.add_argument('--write-limit', type=int, default=60, help='write points per window the fake PDS allows')
+    parser.add_argument('--window', type=int, default=5, help='rate-limit window in seconds')
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--mongomock', action='store_true')
+    args = parser.parse_args()
+
+    pds = FakePds(latency=args.latency, rate_limit=args.rate_limit, rate_window=args.window, write_limit=args.write_limit).start()
+    # the service modules read these on import: the client's budgets match the server's limits
+    os.environ['BSKY_SERVICE_URL'] = pds.url
+    os.environ.setdefault('BSKY_USERNAME', 'bench.test')
+    os.environ.setdefault('BSKY_PASSWORD', 'bench')
+    os.environ['XRPC_READS_PER_SECOND'] = str(args.rate_limit / args.window)
+    os.environ['XRPC_READ_BURST'] = str(args.rate_limit)
+    os.environ['XRPC_WRITE_POINTS_PER_HOUR'] = str(args.write_limit / args.window * 3600)
+    os.environ['XRPC_WRITE_BURST'] = str(args.write_limit)
+    os.environ['XRPC_MAX_RATE_LIMIT_WAIT'] = str(args.window + 1)
+
+    from benchmarks.common import reconnect
+    from dal import db
+    from service.bluesky_service import AsyncBlueskyService
+    from service.rate_limit import RateLimiter, rate_limiter
+    from service.session import session_manager
+    reconnect(args.mongomock)
+    db.Posts.drop_collection()
+
+    service = await AsyncBlueskyService.create()
+    print(f"{'limiter':<8} {'seconds':>8} {'429s':>6} {'failed':>7} {'getRecord':>10} {'resolveHandle':>14}")
+    for enabled in (False, True):
+        # fresh budgets for every round, the server's windows are reset too
+        fresh = RateLimiter()
+        rate_limiter.reads, rate_limiter.writes, rate_limiter.enabled = fresh.reads, fresh.writes, enabled
+        result = await burst(service, pds, args.posts, args.reads, 'on' if enabled else 'off')
+        print(f"{'on' if enabled else 'off':<8} {result['elapsed']:>8.2f} {result['throttled']:>6} {result['failed']:>7} "
+              f"{result['getRecord']:>10} {result['resolveHandle']:>14}")
+    assert result['failed'] == 0, f"{result['failed']} operations failed with the limiter on"
+    # the quoted post's author once, plus every distinct handle
+    assert result['getRecord'] == 1 and result['resolveHandle'] == args.reads + 1, 'identical reads were not coalesced'
+    print(f'\n{session_manager._client.coalesced} queries coalesced, '
+          f'waits: reads {rate_limiter.reads.waits} ({rate_limiter.reads.waited:.1f}s), '
+          f'writes {rate_limiter.writes.waits} ({rate_limiter.writes.waited:.1f}s)')
+
+    db.Posts.drop_collection()
+    pds.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
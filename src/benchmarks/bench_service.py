@@ -0,0 +1,148 @@
+"""End-to-end timings of AsyncBlueskyService against the local fake PDS.
+
+Times post with 0-4 images (with and without mentions), repost, delete_post,
+update_profile and add_to_list, reporting p50/p95/p99 latency and the number of
+XRPC requests each operation made. Caches are cleared before every iteration so
+the request counts show the cold path; an extra round trip shows up as a higher
+"req/op". The last scenario posts concurrently to check the calls overlap.
+
+    cd src && python -m benchmarks.bench_service --mongomock --latency 0.02 --iterations 30
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, List
+
+from benchmarks.fake_pds import FAKE_DID, FakePds
+
+def start_pds(args) -> FakePds:
+    # the service modules read these on import, so this runs before they are imported
+    pds = FakePds(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+    os.environ['BSKY_SERVICE_URL'] = pds.url
+    os.environ.setdefault('BSKY_USERNAME', 'bench.test')
+    os.environ.setdefault('BSKY_PASSWORD', 'bench')
+    os.environ['BLUESKY_LIST'] = f'at://{FAKE_DID}/app.bsky.graph.list/benchlist'
+    # the fake PDS has no limits unless asked to, the client-side limiter shouldn't add its own
+    os.environ.setdefault('XRPC_READS_PER_SECOND', '100000')
+    os.environ.setdefault('XRPC_READ_BURST', '100000')
+    os.environ.setdefault('XRPC_WRITE_POINTS_PER_HOUR', str(100000 * 3600))
+    os.environ.setdefault('XRPC_WRITE_BURST', '100000')
+    return pds
+
+def make_jpeg(width: int = 1200, height: int = 900) -> bytes:
+    from PIL import Image
+    buffer = BytesIO()
+    Image.effect_noise((width, height), 64).convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+async def run_scenario(pds: FakePds, name: str, operation: Callable[[int], Awaitable], iterations: int,
+                       setup: Callable[[int], Awaitable] = None, clear_caches: Callable[[], None] = None) -> Dict:
+    samples: List[float] = []
+    requests: Counter = Counter()
+    for i in range(iterations):
+        if setup:
+            await setup(i)
+        if clear_caches:
+            clear_caches()
+        pds.reset_counters()
+        start = time.perf_counter()
+        await operation(i)
+        samples.append(time.perf_counter() - start)
+        with pds._lock:
+            requests.update(pds.requests)
+    return {'name': name, 'samples': samples, 'requests': requests, 'iterations': iterations}
+
+def print_report(results: List[Dict]):
+    from benchmarks.common import percentiles
+
+    print(f"{'operation':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/op':>7}  calls per op")
+    for result in results:
+        stats = percentiles(result['samples'])
+        per_op = sum(result['requests'].values()) / result['iterations']
+        calls = ', '.join(f'{nsid.rsplit(".", 1)[-1]}={count / result["iterations"]:g}'
+                          for nsid, count in sorted(result['requests'].items()))
+        print(f"{result['name']:<28} {stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f} {per_op:>7.1f}  {calls}")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every fake PDS request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=8, help='posts sent at once in the overlap scenario')
+    parser.add_argument('--mongomock', action='store_true')
+    args = parser.parse_args()
+
+    pds = start_pds(args)
+
+    from benchmarks.common import reconnect
+    from dal import db
+    from service.bluesky_service import AsyncBlueskyService, post_ref_cache
+    from service.handles import handle_resolver
+    from service.images import ImageRef
+
+    reconnect(args.mongomock)
+    db.Posts.drop_collection()
+
+    service = await AsyncBlueskyService.create()
+    jpeg = make_jpeg()
+    mentions = ' @alice.test @bob.test @carol.test'
+    quoted = 'https://bsky.app/profile/alice.test/post/3kbenchquoted'
+
+    def clear_caches():
+        handle_resolver.cache.clear()
+        post_ref_cache.clear()
+
+    async def seed_post(i: int):
+        record = await service.client.app.bsky.feed.post.create(
+            service.client.me.did,
+            {'$type': 'app.bsky.feed.post', 'text': f'to delete {i}', 'createdAt': service.client.get_current_time_iso()},
+        )
+        await service.save_post(f'to delete {i}', record.cid, record.uri)
+
+    async def delete_latest(_: int):
+        posts, _, _ = await service.list_posts(limit=1)
+        await service.delete_post(posts[0].id)
+
+    scenarios = []
+    for images in range(5):
+        for with_mentions in (False, True):
+            name = f"post {images} img{' +mentions' if with_mentions else ''}"
+            text = f'benchmark post{mentions if with_mentions else ""}'
+            scenarios.append((name, lambda i, text=text, images=images: service.post(
+                text, [ImageRef(data=jpeg) for _ in range(images)]), None))
+    scenarios += [
+        ('post quote', lambda i: service.post('quoting', qrt_link=quoted), None),
+        ('repost', lambda i: service.repost(quoted), None),
+        ('delete_post', delete_latest, seed_post),
+        ('update_profile', lambda i: service.update_profile(name=f'Bench {i}'), None),
+        ('add_to_list', lambda i: service.add_to_list(f'user{i}.test'), None),
+    ]
+
+    # warm up the image worker pool so spawning it doesn't land in the first sample
+    await service.post('warm up', [ImageRef(data=jpeg)])
+
+    results = []
+    for name, operation, setup in scenarios:
+        results.append(await run_scenario(pds, name, operation, args.iterations, setup, clear_caches))
+    print_report(results)
+
+    # posts from several updates at once should overlap instead of queueing behind each other
+    clear_caches()
+    start = time.perf_counter()
+    await service.post('sequential baseline')
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    await asyncio.gather(*(service.post(f'concurrent {i}') for i in range(args.concurrency)))
+    together = time.perf_counter() - start
+    print(f'\n{args.concurrency} concurrent text posts: {together * 1000:.1f} ms '
+          f'(one post {single * 1000:.1f} ms, serial would be ~{single * args.concurrency * 1000:.1f} ms)')
+
+    db.Posts.drop_collection()
+    pds.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+"""Time of split_thread on long texts, ASCII and emoji/combining-mark heavy.
+
+Every URL gets a link facet, so the rebasing is timed too.
+Checks every chunk is within the limit and every facet still points at its URL.
+
+    cd src && python -m benchmarks.bench_thread_split --sizes 10000 100000 1000000
+"""
+import argparse
+import statistics
+import time
+
+from service.facets import extract_spans, make_facet
+from service.text_split import POST_GRAPHEME_LIMIT, grapheme_len, split_thread
+
+SENTENCES = {
+    'ascii': 'Reading https://example.com/some/long/path?ref=bench and taking notes. ',
+    'emoji': 'Caffè e cornetti 👨‍👩‍👧 🇮🇹 👍🏽 https://example.com/näme dopo. ',
+}
+
+def make_text(kind: str, size: int) -> str:
+    sentence = SENTENCES[kind]
+    return (sentence * (size // len(sentence) + 1))[:size]
+
+def make_facets(text: str):
+    return [make_facet(span) for span in extract_spans(text) if span.kind == 'link']
+
+def check(chunks, limit: int):
+    assert chunks, 'text dropped'
+    for chunk, facets in chunks:
+        assert grapheme_len(chunk) <= limit, 'chunk over the limit'
+        data = chunk.encode('UTF-8')
+        for facet in facets:
+            target = data[facet.index.byte_start:facet.index.byte_end].decode('UTF-8')
+            assert target == facet.features[0].uri, 'facet moved off its URL'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=POST_GRAPHEME_LIMIT)
+    args = parser.parse_args()
+
+    print(f"{'text':<6} {'chars':>9} {'posts':>6} {'facets':>7} {'median ms':>10} {'us/post':>8}")
+    for kind in SENTENCES:
+        for size in args.sizes:
+            text = make_text(kind, size)
+            facets = make_facets(text)
+            samples = []
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                chunks = split_thread(text, facets, args.limit)
+                samples.append(time.perf_counter() - start)
+            check(chunks, args.limit)
+            median = statistics.median(samples)
+            kept = sum(len(chunk_facets) for _, chunk_facets in chunks)
+            print(f'{kind:<6} {size:>9} {len(chunks):>6} {kept:>7} {median * 1000:>10.2f} {median / len(chunks) * 1e6:>8.1f}')
+
+if __name__ == '__main__':
+    main()
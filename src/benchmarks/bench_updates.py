@@ -0,0 +1,239 @@
+"""Updates per second through polling and through PTB's webhook server.
+
+Starts a fake Telegram Bot API (getMe, getUpdates, setWebhook, deleteWebhook,
+sendMessage) and an Application with one ``/ping`` handler that waits
+``--work-ms`` (standing in for the Bluesky call) and replies. Polling mode queues
+synthetic updates for getUpdates; webhook mode POSTs them to the updater's
+webhook from ``--connections`` keep-alive connections, like Telegram does. Both count an update as done when its reply reaches the
+fake API. The updates come from 50 chats, and as in the bot each chat's
+updates are handled one at a time.
+
+    cd src && python -m benchmarks.bench_updates --updates 2000 --latency 0.02 --work-ms 50
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import urllib.request
+from urllib.parse import parse_qs
+
+from telegram.ext import ApplicationBuilder, CommandHandler
+
+from service.update_processor import PerChatUpdateProcessor
+from webhook import allowed_updates
+
+TOKEN = '123456:bench'
+SECRET = 'bench-secret'
+
+def make_update(update_id: int) -> Dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1000 + update_id % 50, 'type': 'private'},
+            'from': {'id': 1000 + update_id % 50, 'is_bot': False, 'first_name': 'bench'},
+            'text': '/ping',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        },
+    }
+
+class FakeBotApi():
+    """Just enough of api.telegram.org for an Application to poll and reply.
+
+    Runs in its own process, so its threads don't share the GIL with the bot
+    being measured; the benchmark drives it through ``/control/<name>`` calls.
+    """
+    def __init__(self, latency: float, port: int = 0):
+        self.latency = latency
+        self.updates: List[Dict] = []
+        self.replies = 0
+        self.target = 0
+        self.done = threading.Event()
+        self._cond = threading.Condition()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('content-length') or 0))
+                if 'json' in (self.headers.get('content-type') or ''):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                if self.path.startswith('/control/'):
+                    result = api.control(method, params)
+                else:
+                    if api.latency:
+                        time.sleep(api.latency)
+                    result = api.call(method, params)
+                data = json.dumps({'ok': True, 'result': result}).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header('content-type', 'application/json')
+                    self.send_header('content-length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except ConnectionError:
+                    # the updater drops its last long poll when it stops
+                    pass
+
+        class Server(ThreadingHTTPServer):
+            # the bot opens up to its pool size of connections at once, the default backlog of 5 resets them
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', port), Handler)
+        self.port = self._server.server_port
+
+    def serve(self):
+        self._server.serve_forever()
+
+    def control(self, name: str, params: Dict):
+        with self._cond:
+            if name == 'expect':
+                self.replies = 0
+                self.target = int(params['count'])
+                self.done.clear()
+            elif name == 'queue':
+                first = int(params['first'])
+                self.updates.extend(make_update(i) for i in range(first, first + int(params['count'])))
+                self._cond.notify_all()
+        if name == 'wait':
+            self.done.wait()
+        return True
+
+    def call(self, method: str, params: Dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or 100)
+            with self._cond:
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                if not self.updates:
+                    self._cond.wait(timeout=min(float(params.get('timeout') or 0), 1))
+                return self.updates[:limit]
+        if method == 'sendMessage':
+            with self._cond:
+                self.replies += 1
+                if self.replies == self.target:
+                    self.done.set()
+            chat_id = int(json.loads(params['chat_id']) if isinstance(params['chat_id'], str) else params['chat_id'])
+            return {'message_id': self.replies, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'pong'}
+        # setWebhook, deleteWebhook, ...
+        return True
+
+def serve_fake_api(latency: float, ports: multiprocessing.Queue):
+    api = FakeBotApi(latency)
+    ports.put(api.port)
+    api.serve()
+
+class FakeBotApiProcess():
+    """:class:`FakeBotApi` in a child process, with the control calls as methods."""
+    def __init__(self, latency: float):
+        ports = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=serve_fake_api, args=(latency, ports), daemon=True)
+        self._process.start()
+        self.port = ports.get()
+        self.url = f'http://127.0.0.1:{self.port}/bot'
+
+    async def control(self, name: str, **params):
+        request = urllib.request.Request(f'http://127.0.0.1:{self.port}/control/{name}', data=json.dumps(params).encode(),
+                                         headers={'content-type': 'application/json'})
+        await asyncio.to_thread(lambda: urllib.request.urlopen(request).read())
+
+    def stop(self):
+        self._process.terminate()
+
+def build_app(api: FakeBotApiProcess, work: float, pool: int):
+    async def ping(update, _):
+        await asyncio.sleep(work)
+        await update.message.reply_text('pong')
+
+    app = (ApplicationBuilder().token(TOKEN).base_url(api.url).concurrent_updates(PerChatUpdateProcessor())
+           .connection_pool_size(pool).build())
+    app.add_handler(CommandHandler('ping', ping))
+    return app
+
+async def run_polling(api: FakeBotApiProcess, updates: int, work: float, pool: int) -> float:
+    app = build_app(api, work, pool)
+    await api.control('expect', count=updates)
+    await api.control('queue', first=1, count=updates)
+    async with app:
+        await app.start()
+        start = time.perf_counter()
+        await app.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=allowed_updates(app))
+        await api.control('wait')
+        elapsed = time.perf_counter() - start
+        await app.updater.stop()
+        await app.stop()
+    return elapsed
+
+async def run_webhook(api: FakeBotApiProcess, updates: int, work: float, connections: int, pool: int) -> float:
+    app = build_app(api, work, pool)
+    await api.control('expect', count=updates)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    async with app:
+        await app.start()
+        await app.updater.start_webhook(listen='127.0.0.1', port=port, url_path='telegram', secret_token=SECRET,
+                                        webhook_url=f'http://127.0.0.1:{port}/telegram', allowed_updates=allowed_updates(app))
+        pending = list(range(updates, 0, -1))
+
+        async def sender():
+            # hand-written keep-alive requests: an HTTP client library in this same
+            # event loop would cost more CPU than the server being measured
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            while pending:
+                body = json.dumps(make_update(pending.pop())).encode()
+                writer.write(f'POST /telegram HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+                             f'X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+                status = await reader.readline()
+                assert status.split()[1] == b'200', status
+                while await reader.readline() not in (b'\r\n', b''):
+                    pass
+            writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(connections)))
+        await api.control('wait')
+        elapsed = time.perf_counter() - start
+        await app.updater.stop()
+        await app.stop()
+    return elapsed
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every fake Bot API call')
+    parser.add_argument('--work-ms', type=float, default=50, help='time the handler waits before replying')
+    parser.add_argument('--connections', type=int, default=40, help='webhook connections, Telegram allows up to 100')
+    # httpcore walks every pooled connection for every queued request, past a few dozen that costs more than it gives
+    parser.add_argument('--pool', type=int, default=32, help='Bot API connection pool size of the bot')
+    args = parser.parse_args()
+
+    api = FakeBotApiProcess(args.latency)
+    work = args.work_ms / 1000
+    print(f"{'mode':<8} {'updates':>8} {'seconds':>8} {'updates/s':>10}")
+    for mode in ('polling', 'webhook'):
+        if mode == 'polling':
+            elapsed = await run_polling(api, args.updates, work, args.pool)
+        else:
+            elapsed = await run_webhook(api, args.updates, work, args.connections, args.pool)
+        print(f'{mode:<8} {args.updates:>8} {elapsed:>8.2f} {args.updates / elapsed:>10.1f}')
+    api.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
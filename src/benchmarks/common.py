@@ -0,0 +1,27 @@
+"""Shared setup for the benchmark scripts."""
+import os
+import statistics
+from typing import Dict, List
+
+os.environ.setdefault('BSKY_BOT_DATABASE', 'bsky_bot')
+os.environ.setdefault('MONGO_HOST', 'localhost')
+os.environ.setdefault('MONGO_PORT', '27017')
+
+from mongoengine import connect, disconnect
+
+def reconnect(use_mongomock: bool):
+    """Point mongoengine at ``<db>_bench`` on the configured server, or at mongomock."""
+    disconnect()
+    name = f"{os.environ['BSKY_BOT_DATABASE']}_bench"
+    if use_mongomock:
+        import mongomock
+        connect(name, host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+    else:
+        connect(name, host=os.environ['MONGO_HOST'], port=int(os.environ['MONGO_PORT']))
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 of ``samples`` in milliseconds."""
+    if len(samples) == 1:
+        return {'p50': samples[0] * 1000, 'p95': samples[0] * 1000, 'p99': samples[0] * 1000}
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49] * 1000, 'p95': cuts[94] * 1000, 'p99': cuts[98] * 1000}
@@ -0,0 +1,356 @@
+"""Local stand-in for the Bluesky PDS, enough of XRPC for everything the bot calls.
+
+Implements createSession/refreshSession, getProfile, uploadBlob,
+createRecord/putRecord/deleteRecord/getRecord/listRecords/applyWrites and
+resolveHandle, with configurable latency and error injection, and counts the
+requests it served per NSID. Records of other accounts (posts we quote, reply to
+or repost) are made up on the fly.
+
+Run it standalone and point the bot at it with BSKY_SERVICE_URL:
+
+    cd src && python -m benchmarks.fake_pds --port 2583 --latency 0.05
+    BSKY_SERVICE_URL=http://127.0.0.1:2583 python main.py
+
+or start it in-process with :class:`FakePds` (see bench_service.py).
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+FAKE_DID = 'did:plc:fakebenchaccount000000'
+FAKE_HANDLE = 'bench.test'
+
+_TID_ALPHABET = '234567abcdefghijklmnopqrstuvwxyz'
+
+# Bluesky's write points per record operation
+WRITE_POINTS = {
+    'com.atproto.repo.createRecord': 3,
+    'com.atproto.repo.putRecord': 2,
+    'com.atproto.repo.deleteRecord': 1,
+}
+_APPLY_WRITES_POINTS = {'create': 3, 'update': 2, 'delete': 1}
+
+def make_cid(data: bytes, codec: int = 0x71) -> str:
+    """CIDv1 (dag-cbor by default, 0x55 for raw blobs) with a sha2-256 multihash."""
+    raw = bytes([0x01, codec, 0x12, 0x20]) + hashlib.sha256(data).digest()
+    return 'b' + base64.b32encode(raw).decode('ascii').lower().rstrip('=')
+
+def make_jwt(scope: str, lifetime: int) -> str:
+    def encode(part: Dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip('=')
+    now = int(time.time())
+    payload = {'scope': scope, 'sub': FAKE_DID, 'iat': now, 'exp': now + lifetime, 'jti': str(random.random())}
+    signature = base64.urlsafe_b64encode(hashlib.sha256(json.dumps(payload).encode()).digest()).decode().rstrip('=')
+    return f"{encode({'typ': 'JWT', 'alg': 'HS256'})}.{encode(payload)}.{signature}"
+
+class _Server(ThreadingHTTPServer):
+    # a burst opens dozens of connections at once, the default backlog of 5 resets them
+    request_queue_size = 1024
+    daemon_threads = True
+
+class FakePds():
+    """In-memory PDS served by a ThreadingHTTPServer on a background thread.
+
+    Args:
+        latency (float): Seconds added to every request.
+        jitter (float): Up to this many extra random seconds per request.
+        error_rate (float): Share of requests answered with a 503.
+        rate_limit (int): Requests allowed per ``rate_window`` before answering
+            429 with ``ratelimit-*`` headers, 0 disables it.
+        rate_window (int): Rate-limit window in seconds.
+        write_limit (int): Write points (create 3, update 2, delete 1) allowed
+            per ``rate_window``, counted apart from ``rate_limit`` like Bluesky
+            does. Record writes get this window's headers, 0 disables it.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, rate_limit: int = 0, rate_window: int = 60, write_limit: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.write_limit = write_limit
+        self.requests: Counter = Counter()
+        # requests answered with a 429, per NSID
+        self.throttled: Counter = Counter()
+        # requests being served right now, and the most there were at once
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.records: Dict[Tuple[str, str], Dict] = {}
+        # window name -> [start, used]
+        self._windows: Dict[str, list] = {'requests': [time.time(), 0], 'writes': [time.time(), 0]}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakePds':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.throttled.clear()
+            self.peak_in_flight = self.in_flight
+
+    def reset_rate_limits(self):
+        """Start fresh rate-limit windows, as if ``rate_window`` just passed."""
+        with self._lock:
+            for window in self._windows.values():
+                window[0], window[1] = time.time(), 0
+
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.requests.values())
+
+    # region rate limit
+
+    def _write_points(self, nsid: str, body: bytes) -> int:
+        if nsid != 'com.atproto.repo.applyWrites':
+            return WRITE_POINTS.get(nsid, 0)
+        writes = json.loads(body or b'{}').get('writes', [])
+        return sum(_APPLY_WRITES_POINTS.get(write.get('$type', '').rsplit('#', 1)[-1], 3) for write in writes)
+
+    def _rate_limit_headers(self, nsid: str, body: bytes) -> Tuple[bool, Dict[str, str]]:
+        points = self._write_points(nsid, body) if self.write_limit else 0
+        name, limit, cost = ('writes', self.write_limit, points) if points else ('requests', self.rate_limit, 1)
+        if not limit:
+            return False, {}
+        with self._lock:
+            window = self._windows[name]
+            now = time.time()
+            if now - window[0] >= self.rate_window:
+                window[0], window[1] = now, 0
+            # a rejected call costs nothing
+            limited = window[1] + cost > limit
+            if not limited:
+                window[1] += cost
+            else:
+                self.throttled[nsid] += 1
+            remaining = limit - window[1]
+            reset = math.ceil(window[0] + self.rate_window)
+        return limited, {
+            'ratelimit-limit': str(limit),
+            'ratelimit-remaining': str(remaining),
+            'ratelimit-reset': str(reset),
+            'ratelimit-policy': f'{limit};w={self.rate_window}',
+        }
+
+    # endregion
+
+    # region xrpc methods
+
+    def _record_key(self, params: Dict) -> Tuple[str, str]:
+        return params['collection'], params['rkey']
+
+    def _get_record(self, params: Dict):
+        key = self._record_key(params)
+        repo = params.get('repo')
+        with self._lock:
+            record = self.records.get(key) if repo in (FAKE_DID, FAKE_HANDLE) else None
+        if record:
+            return 200, record
+        if repo in (FAKE_DID, FAKE_HANDLE):
+            return 400, {'error': 'RecordNotFound', 'message': 'Could not locate record'}
+        # somebody else's post, invent it
+        value = {'$type': params['collection'], 'text': 'someone else\'s post', 'createdAt': _now_iso()}
+        uri = f"at://{repo}/{params['collection']}/{params['rkey']}"
+        return 200, {'uri': uri, 'cid': make_cid(uri.encode()), 'value': value}
+
+    def _write_record(self, collection: str, rkey: Optional[str], value: Dict, must_not_exist: bool):
+        rkey = rkey or _make_tid()
+        uri = f'at://{FAKE_DID}/{collection}/{rkey}'
+        cid = make_cid(json.dumps(value, sort_keys=True).encode() + uri.encode())
+        with self._lock:
+            if must_not_exist and (collection, rkey) in self.records:
+                return 400, {'error': 'InvalidRequest', 'message': 'Record already exists'}
+            self.records[(collection, rkey)] = {'uri': uri, 'cid': cid, 'value': value}
+        return 200, {'uri': uri, 'cid': cid, 'commit': {'cid': make_cid(cid.encode()), 'rev': _make_tid()}}
+
+    def _list_records(self, params: Dict):
+        collection = params['collection']
+        limit = int(params.get('limit', 50))
+        cursor = params.get('cursor')
+        reverse = params.get('reverse') == 'true'
+        with self._lock:
+            keys = sorted((rkey for coll, rkey in self.records if coll == collection), reverse=not reverse)
+            if cursor:
+                keys = [rkey for rkey in keys if (rkey > cursor if reverse else rkey < cursor)]
+            page = keys[:limit]
+            records = [self.records[(collection, rkey)] for rkey in page]
+        body = {'records': records}
+        if len(page) == limit:
+            body['cursor'] = page[-1]
+        return 200, body
+
+    def _apply_writes(self, body: Dict):
+        results = []
+        for write in body.get('writes', []):
+            kind = write['$type'].split('#')[-1]
+            if kind == 'delete':
+                with self._lock:
+                    self.records.pop((write['collection'], write['rkey']), None)
+                results.append({'$type': 'com.atproto.repo.applyWrites#deleteResult'})
+            else:
+                status, result = self._write_record(write['collection'], write.get('rkey'), write['value'], kind == 'create')
+                if status != 200:
+                    return status, result
+                results.append({'$type': f'com.atproto.repo.applyWrites#{kind}Result', 'uri': result['uri'], 'cid': result['cid']})
+        return 200, {'commit': {'cid': make_cid(str(time.time()).encode()), 'rev': _make_tid()}, 'results': results}
+
+    def handle(self, nsid: str, params: Dict, body: bytes, content_type: str):
+        """Dispatch one XRPC call, returns (status, json body)."""
+        data = json.loads(body) if body and 'json' in content_type else {}
+        if nsid in ('com.atproto.server.createSession', 'com.atproto.server.refreshSession'):
+            return 200, {
+                'accessJwt': make_jwt('com.atproto.access', 2 * 3600),
+                'refreshJwt': make_jwt('com.atproto.refresh', 60 * 24 * 3600),
+                'handle': FAKE_HANDLE,
+                'did': FAKE_DID,
+            }
+        if nsid == 'app.bsky.actor.getProfile':
+            return 200, {'did': FAKE_DID, 'handle': FAKE_HANDLE}
+        if nsid == 'com.atproto.identity.resolveHandle':
+            handle = params.get('handle', '')
+            if not handle or handle.startswith(('missing', 'invalid')):
+                return 400, {'error': 'InvalidRequest', 'message': 'Unable to resolve handle'}
+            return 200, {'did': 'did:plc:' + hashlib.sha256(handle.encode()).hexdigest()[:24]}
+        if nsid == 'com.atproto.repo.uploadBlob':
+            return 200, {'blob': {
+                '$type': 'blob',
+                'ref': {'$link': make_cid(body, codec=0x55)},
+                'mimeType': content_type or 'application/octet-stream',
+                'size': len(body),
+            }}
+        if nsid == 'com.atproto.repo.createRecord':
+            return self._write_record(data['collection'], data.get('rkey'), data['record'], must_not_exist=True)
+        if nsid == 'com.atproto.repo.putRecord':
+            return self._write_record(data['collection'], data['rkey'], data['record'], must_not_exist=False)
+        if nsid == 'com.atproto.repo.deleteRecord':
+            with self._lock:
+                self.records.pop((data['collection'], data['rkey']), None)
+            return 200, {}
+        if nsid == 'com.atproto.repo.getRecord':
+            return self._get_record(params)
+        if nsid == 'com.atproto.repo.listRecords':
+            return self._list_records(params)
+        if nsid == 'com.atproto.repo.applyWrites':
+            return self._apply_writes(data)
+        return 501, {'error': 'MethodNotImplemented', 'message': f'{nsid} is not implemented by the fake PDS'}
+
+    # endregion
+
+    def _handler_class(self):
+        pds = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *_):
+                pass
+
+            def setup(self):
+                super().setup()
+                # headers and body go out as separate writes, don't let Nagle hold the body back
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def _serve(self):
+                parsed = urlparse(self.path)
+                length = int(self.headers.get('content-length') or 0)
+                body = self.rfile.read(length) if length else b''
+
+                if parsed.path == '/_stats':
+                    with pds._lock:
+                        return self._reply(200, dict(pds.requests), {})
+
+                nsid = parsed.path.rsplit('/', 1)[-1]
+                with pds._lock:
+                    pds.requests[nsid] += 1
+                    pds.in_flight += 1
+                    pds.peak_in_flight = max(pds.peak_in_flight, pds.in_flight)
+                try:
+                    self._handle(parsed, nsid, body)
+                finally:
+                    with pds._lock:
+                        pds.in_flight -= 1
+
+            def _handle(self, parsed, nsid: str, body: bytes):
+                delay = pds.latency + (random.uniform(0, pds.jitter) if pds.jitter else 0)
+                if delay:
+                    time.sleep(delay)
+
+                limited, headers = pds._rate_limit_headers(nsid, body)
+                if limited:
+                    return self._reply(429, {'error': 'RateLimitExceeded', 'message': 'Rate Limit Exceeded'}, headers)
+                if pds.error_rate and random.random() < pds.error_rate:
+                    return self._reply(503, {'error': 'InternalServerError', 'message': 'Injected failure'}, headers)
+
+                params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+                status, payload = pds.handle(nsid, params, body, self.headers.get('content-type', ''))
+                self._reply(status, payload, headers)
+
+            def _reply(self, status: int, payload: Dict, headers: Dict[str, str]):
+                encoded = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json; charset=utf-8')
+                self.send_header('content-length', str(len(encoded)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            do_GET = _serve
+            do_POST = _serve
+
+        return Handler
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def _make_tid() -> str:
+    value = (time.time_ns() // 1000 << 10) | random.randrange(1024)
+    return ''.join(_TID_ALPHABET[(value >> (60 - 5 * i)) & 31] for i in range(13))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2583)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0)
+    parser.add_argument('--rate-window', type=int, default=60)
+    parser.add_argument('--write-limit', type=int, default=0)
+    args = parser.parse_args()
+
+    pds = FakePds(args.host, args.port, args.latency, args.jitter, args.error_rate, args.rate_limit, args.rate_window,
+                  args.write_limit)
+    print(f'Fake PDS listening on {pds.url}')
+    try:
+        pds._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
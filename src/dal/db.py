@@ -1,4 +1,5 @@
-from mongoengine import connect, Document, StringField, ReferenceField, SequenceField
+from datetime import datetime
+from mongoengine import connect, Document, StringField, ReferenceField, SequenceField, DictField, IntField, DateTimeField, BooleanField, BinaryField, FloatField, ListField
 import os
 
 connect(os.getenv('BSKY_BOT_DATABASE'), host=os.getenv('MONGO_HOST'), port=int(os.getenv('MONGO_PORT')))
@@ -8,10 +9,115 @@ class Config(Document):
     Value = StringField()
 
 class Posts(Document):
+    meta = {
+        # lookups done by delete (uri), reply/thread views (parent, root) and dedupe (cid)
+        'indexes': ['uri', 'cid', 'parent', 'root'],
+    }
+
     id = SequenceField(primary_key=True)
     text = StringField()
     cid = StringField()
     uri = StringField()
     #refs to other Posts
     parent = ReferenceField('self')
-    root = ReferenceField('self')
\ No newline at end of file
+    root = ReferenceField('self')
+
+class Outbox(Document):
+    meta = {
+        # the worker always asks for the next pending job by due time
+        'indexes': [('status', 'due_at')],
+    }
+
+    idempotency_key = StringField(required=True, unique=True)
+    operation = StringField(required=True)
+    payload = DictField()
+    #pending, running, done, failed or cancelled
+    status = StringField(default='pending')
+    attempts = IntField(default=0)
+    due_at = DateTimeField(default=datetime.utcnow)
+    #picked by the user with "send at", not just queued
+    scheduled = BooleanField(default=False)
+    created_at = DateTimeField(default=datetime.utcnow)
+    last_error = StringField()
+    #telegram chat to report the result to
+    chat_id = IntField()
+
+class ListMembers(Document):
+    meta = {
+        # one listitem per subject and list, looked up by subject on every add/remove
+        'indexes': [{'fields': ('list_uri', 'subject'), 'unique': True}],
+    }
+
+    list_uri = StringField(required=True)
+    #DID of the listed account
+    subject = StringField(required=True)
+    uri = StringField()
+    rkey = StringField()
+
+class LinkPreviews(Document):
+    meta = {
+        'indexes': [
+            {'fields': ['url'], 'unique': True},
+            # Mongo drops previews on its own once they're older than LINK_PREVIEW_TTL
+            {'fields': ['fetched_at'], 'expireAfterSeconds': int(os.getenv('LINK_PREVIEW_TTL', str(7 * 24 * 3600)))},
+        ],
+    }
+
+    url = StringField(required=True)
+    title = StringField()
+    description = StringField()
+    image_url = StringField()
+    #optimised card thumbnail, uploaded again for every post that uses it
+    thumb = BinaryField()
+    fetched_at = DateTimeField(default=datetime.utcnow)
+
+# drafts and conversation states nobody touched for this long are dropped
+DRAFT_TTL = int(os.getenv('DRAFT_TTL', str(7 * 24 * 3600)))
+
+class UserData(Document):
+    meta = {
+        'indexes': [
+            {'fields': ['user_id'], 'unique': True},
+            {'fields': ['updated_at'], 'expireAfterSeconds': DRAFT_TTL},
+        ],
+    }
+
+    #telegram user id
+    user_id = IntField(required=True)
+    #context.user_data, images as references (file_id/url), never bytes
+    data = DictField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+class Conversations(Document):
+    meta = {
+        'indexes': [
+            {'fields': ('name', 'key'), 'unique': True},
+            {'fields': ['updated_at'], 'expireAfterSeconds': DRAFT_TTL},
+        ],
+    }
+
+    #name of the ConversationHandler
+    name = StringField(required=True)
+    #conversation key as JSON, [chat_id, user_id] for ours
+    key = StringField(required=True)
+    state = IntField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+class SlowUpdates(Document):
+    meta = {
+        # capped: only the latest ones are kept, no index or cleanup needed
+        'max_documents': 200,
+        'max_size': 2 * 1024 * 1024,
+    }
+
+    #handler or outbox job that ran
+    name = StringField(required=True)
+    started_at = DateTimeField(required=True)
+    duration_ms = FloatField()
+    error = StringField()
+    #user_id, chat_id or job id
+    info = DictField()
+    #name, depth, offset_ms and ms of every stage, depth first
+    spans = ListField(DictField())
+    #stages past the per-update limit, not recorded
+    dropped = IntField(default=0)
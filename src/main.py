@@ -1,21 +1,62 @@
 import os
-from telegram import Update
-from telegram.ext import ApplicationBuilder
+import secrets
+from urllib.parse import urlparse
+from telegram.ext import Application, ApplicationBuilder
+# first, so the Mongo client dal.db connects on import is already monitored
+from service import metrics
 import telegram_modules.bluesky_profile as bluesky_profile
 import telegram_modules.bsky_list as bsky_list
 import telegram_modules.bluesky_post_web as bluesky_post_web
 import telegram_modules.bluesky_post as bluesky_post
+from service.outbox import outbox
+from service.persistence import persistence
+from service.tracing import TracedRequest
+from service.update_processor import PerChatUpdateProcessor
+from webhook import allowed_updates
 
 TOKEN = os.getenv('TELEGRAM_TOKEN_BSKY') 
+# public https URL Telegram should post updates to, polling is used when it's not set
+WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH')
+# a fresh one every start is fine, set_webhook hands it to Telegram each time
+WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_CERT = os.getenv('TELEGRAM_WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('TELEGRAM_WEBHOOK_KEY')
+
+async def post_init(app: Application) -> None:
+    outbox.start(app.bot)
+    persistence.start(app)
+    if metrics.METRICS_PORT:
+        await metrics.start_server()
+
+async def post_shutdown(_: Application) -> None:
+    await outbox.stop()
+    await persistence.stop()
+    await metrics.stop_server()
 
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    # handlers await the Bluesky calls, let several updates be processed at once,
+    # one at a time per chat so the conversation states and drafts don't race
+    # drafts and conversation states are kept in Mongo, a deploy doesn't lose them
+    # Bot API calls are traced, same pool size as the builder's default request
+    app = (ApplicationBuilder().token(TOKEN).concurrent_updates(PerChatUpdateProcessor()).persistence(persistence)
+           .request(TracedRequest(connection_pool_size=256))
+           .post_init(post_init).post_shutdown(post_shutdown).build())
     bsky_list.load(app)
     bluesky_post_web.load(app)
     bluesky_post.load(app)
     bluesky_profile.load(app)
+    metrics.instrument_handlers(app)
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # the local path defaults to the one of the public URL, a proxy in front may rewrite it
+        app.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH or urlparse(WEBHOOK_URL).path,
+                        cert=WEBHOOK_CERT, key=WEBHOOK_KEY, webhook_url=WEBHOOK_URL,
+                        allowed_updates=allowed_updates(app), secret_token=WEBHOOK_SECRET)
+    else:
+        app.run_polling(allowed_updates=allowed_updates(app))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,14 +1,55 @@
-from io import BytesIO
+import asyncio
+import math
 import os
 import re as regex
-from atproto import AtUri, Client, models, IdResolver
+from atproto import AsyncClient, AtUri, models
 from atproto.exceptions import BadRequestError
-import base64
 from dal import db
-from PIL import Image
+from mongoengine.queryset.visitor import Q
+from service.cache import TTLCache
+from service.facets import build_facets
+from service.handles import HandleResolver, handle_resolver
+from service import image_pipeline, images
+from service.image_pipeline import optimise
+from service.images import ImageRef
+from service.link_preview import link_previews
+from service.list_mirror import list_mirror
+from service.metrics import registry
+from service.session import session_manager
+from service.tracing import span, traced
+from service.text_split import split_thread
+from service.tid import offset_tid
 from typing import Optional
-import requests
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, Set, Tuple
+
+# how many blobs a single post uploads at the same time
+UPLOAD_CONCURRENCY = int(os.getenv('BSKY_UPLOAD_CONCURRENCY', '4'))
+# strong refs of posts we quote or reply to, keyed by (did, rkey)
+post_ref_cache = TTLCache(
+    max_size=int(os.getenv('BSKY_POST_CACHE_SIZE', '512')),
+    ttl=float(os.getenv('BSKY_POST_CACHE_TTL', str(24 * 3600))),
+)
+
+def forget_post(uri: str):
+    """Drop a deleted post from :data:`post_ref_cache`."""
+    at_uri = AtUri.from_str(uri)
+    post_ref_cache.invalidate((at_uri.host, at_uri.rkey))
+
+_caches = {'handles': handle_resolver.cache, 'posts': post_ref_cache, 'link_previews': link_previews.cache}
+registry.collect('bot_cache_hits_total', 'Cache lookups that found a fresh entry.', 'counter',
+                 lambda: {name: cache.hits for name, cache in _caches.items()}, 'cache')
+registry.collect('bot_cache_misses_total', 'Cache lookups that found nothing or an expired entry.', 'counter',
+                 lambda: {name: cache.misses for name, cache in _caches.items()}, 'cache')
+registry.collect('bot_image_bytes_total', 'Image bytes downloaded, fed to and produced by the image pipeline.', 'counter',
+                 lambda: {'downloaded': images.bytes_downloaded, 'optimise_in': image_pipeline.bytes_in, 'optimise_out': image_pipeline.bytes_out},
+                 'stage')
+
+# how many record writes (deletes) one bulk action sends at the same time
+WRITE_CONCURRENCY = int(os.getenv('BSKY_WRITE_CONCURRENCY', '8'))
+# the PDS accepts at most 200 writes per applyWrites call
+APPLY_WRITES_BATCH = 200
+
+bluesky_url_regex = regex.compile(r'^https?:\/\/bsky\.app\/profile\/[^\/]+\/post\/[^\/]+$')
 
 def is_valid_bluesky_url(url: str) -> bool:
     """Check if the given URL is a valid Bluesky post URL.
@@ -18,73 +59,24 @@ def is_valid_bluesky_url(url: str) -> bool:
     Returns:
         bool: True if the URL is a valid Bluesky post URL, otherwise False.
     """
-    bluesky_regex = r'^https?:\/\/bsky\.app\/profile\/[^\/]+\/post\/[^\/]+$'
-    return bool(regex.match(bluesky_regex, url))
-
-def parse_mentions(text: str) -> List[Dict]:
-    spans = []
-    mention_regex = rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in regex.finditer(mention_regex, text_bytes):
-        spans.append({
-            "start": m.start(1),
-            "end": m.end(1),
-            "handle": m.group(1)[1:].decode("UTF-8")
-        })
-    return spans
-
-def parse_urls(text: str) -> List[Dict]:
-    spans = []
-    url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in regex.finditer(url_regex, text_bytes):
-        spans.append({
-            "start": m.start(1),
-            "end": m.end(1),
-            "url": m.group(1).decode("UTF-8"),
-        })
-    return spans
-
-def parse_facets(text: str) -> List[Dict]:
-    facets = []
-    for m in parse_mentions(text):
-        resp = requests.get(
-            "https://bsky.social/xrpc/com.atproto.identity.resolveHandle",
-            params={"handle": m["handle"]},
-        )
-        if resp.status_code == 400:
-            continue
-        did = resp.json()["did"]
-        facets.append({
-            "index": {
-                "byteStart": m["start"],
-                "byteEnd": m["end"],
-            },
-            "features": [{"$type": "app.bsky.richtext.facet#mention", "did": did}],
-        })
-    for u in parse_urls(text):
-        facets.append({
-            "index": {
-                "byteStart": u["start"],
-                "byteEnd": u["end"],
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    "uri": u["url"],
-                }
-            ],
-        })
-    return facets
-
-class BlueskyService():
-    def __init__(self):
-        self.client = Client()
-        self.resolver = IdResolver()
-        self.client.login(os.environ['BSKY_USERNAME'], os.environ['BSKY_PASSWORD'])
-
-
-    def fetch_post(self, url: str) -> Optional[models.ComAtprotoRepoStrongRef.Main] | Optional[models.ComAtprotoRepoStrongRef.Main]:
+    return bool(bluesky_url_regex.match(url))
+
+async def parse_facets(text: str) -> List[models.AppBskyRichtextFacet.Main]:
+    """Mention, link and tag facets of ``text``, see :func:`service.facets.build_facets`."""
+    return await build_facets(text, handle_resolver.resolve_many)
+
+class AsyncBlueskyService():
+    def __init__(self, client: AsyncClient, resolver: HandleResolver):
+        self.client = client
+        self.resolver = resolver
+
+    @classmethod
+    async def create(cls) -> 'AsyncBlueskyService':
+        # shared across every service instance, logs in only once per process
+        return cls(await session_manager.get_client(), handle_resolver)
+
+    @traced('bluesky.fetch_post')
+    async def fetch_post(self, url: str) -> Optional[models.ComAtprotoRepoStrongRef.Main] | Optional[models.ComAtprotoRepoStrongRef.Main]:
         """Fetch a post using its Bluesky URL.
 
         Args:
@@ -101,38 +93,48 @@ class BlueskyService():
             post_rkey = url_parts[6]  # Post Record Key in the URL
 
             # Resolve the DID for the username
-            did = self.resolver.handle.resolve(handle)
+            did = await self.resolver.resolve(handle)
             if not did:
                 print(f'Could not resolve DID for handle "{handle}".')
                 return (None, None)
             
-            post = self.client.get_post(post_rkey, did)
+            # cid is a content hash, a cached ref stays right until the post is deleted
+            cached = post_ref_cache.get((did, post_rkey))
+            if cached:
+                return cached
+
+            post = await self.client.get_post(post_rkey, did)
 
             # check for a reply chain and root post
             root_post = post.value.reply.root if post.value.reply else None
             root_ref = models.create_strong_ref(root_post) if root_post else None
 
             # Fetch the post record
-            return models.create_strong_ref(post), root_ref
+            refs = (models.create_strong_ref(post), root_ref)
+            post_ref_cache.set((did, post_rkey), refs)
+            return refs
         except (ValueError, KeyError) as e:
             print(f'Error fetching post for URL {url}: {e}')
             return (None, None)
 
-    def update_profile(self, name: str = None, description: str = None, photo = None, banner = None):
+    @traced('bluesky.update_profile')
+    async def update_profile(self, name: str = None, description: str = None, photo: Optional[ImageRef] = None, banner: Optional[ImageRef] = None):
         if not name and not description and not photo and not banner:
             raise ValueError('At least one field must be provided to update the profile')
 
         try:
-            current_profile_record = self.client.app.bsky.actor.profile.get(self.client.me.did, 'self')
+            current_profile_record = await self.client.app.bsky.actor.profile.get(self.client.me.did, 'self')
             current_profile = current_profile_record.value
             swap_record_cid = current_profile_record.cid
         except BadRequestError:
             current_profile = swap_record_cid = None
 
-        old_description = old_display_name = None
+        old_description = old_display_name = old_avatar = old_banner = None
         if current_profile:
             old_description = current_profile.description
             old_display_name = current_profile.display_name
+            old_avatar = current_profile.avatar
+            old_banner = current_profile.banner
 
         # set new values to update
         new_description = description
@@ -140,51 +142,80 @@ class BlueskyService():
         new_avatar = new_banner = None
 
         if photo:
-            # Decode the base64 encoded photo
-            photo_data = base64.b64decode(photo)
-            new_avatar = self.client.upload_blob(photo_data).blob
+            photo = await optimise(photo, 'avatar')
+            new_avatar = (await self.client.upload_blob(photo.data)).blob
 
         if banner:
-            # Decode the base64 encoded banner
-            banner_data = base64.b64decode(banner)
-            new_banner = self.client.upload_blob(banner_data).blob
+            banner = await optimise(banner, 'banner')
+            new_banner = (await self.client.upload_blob(banner.data)).blob
 
-        self.client.com.atproto.repo.put_record(
+        await self.client.com.atproto.repo.put_record(
             models.ComAtprotoRepoPutRecord.Data(
                 collection=models.ids.AppBskyActorProfile,
                 repo=self.client.me.did,
                 rkey='self',
                 swap_record=swap_record_cid,
                 record=models.AppBskyActorProfile.Record(
-                    avatar=new_avatar or current_profile.avatar,
-                    banner=new_banner or current_profile.banner,
+                    avatar=new_avatar or old_avatar,
+                    banner=new_banner or old_banner,
                     description=new_description or old_description,
                     display_name=new_display_name or old_display_name,
                 ),
             )
         )
 
-    def list_posts(self):
-        #pick last 10
-        posts = db.Posts.objects().order_by('-id')[:10]
-        return posts
+    @traced('bluesky.list_posts')
+    async def list_posts(self, before_id: Optional[int] = None, after_id: Optional[int] = None, limit: int = 10):
+        """Fetch one page of posts, newest first, using keyset pagination on ``id``.
 
-    def make_photo_post_content(self, photo, link: Optional[str] = None):
+        Args:
+            before_id (int): Only posts older than this id (next page).
+            after_id (int): Only posts newer than this id (previous page).
+            limit (int): Page size.
+        Returns:
+            tuple: (posts, has_older, has_newer)
+        """
+        def fetch():
+            query = db.Posts.objects().only('id', 'text')
+            if after_id is not None:
+                # walk forward from the cursor, then flip back to newest first
+                posts = list(query.filter(id__gt=after_id).order_by('id')[:limit + 1])
+                has_newer = len(posts) > limit
+                posts = posts[:limit][::-1]
+                has_older = True
+            else:
+                if before_id is not None:
+                    query = query.filter(id__lt=before_id)
+                posts = list(query.order_by('-id')[:limit + 1])
+                has_older = len(posts) > limit
+                posts = posts[:limit]
+                has_newer = before_id is not None
+            return posts, has_older, has_newer
+
+        return await asyncio.to_thread(fetch)
+
+    @traced('bluesky.upload_photo')
+    async def upload_photo(self, photo: ImageRef, semaphore: asyncio.Semaphore):
+        """Upload one (already loaded) image and work out its aspect ratio."""
+        if photo.data is None:
+            raise ValueError('Image must be loaded before uploading')
+        photo = await optimise(photo, 'post')
+        async with semaphore:
+            uploaded_photo = (await self.client.upload_blob(photo.data)).blob
+        size = photo.size()
+        aspect_ratio = models.AppBskyEmbedDefs.AspectRatio(width=size[0], height=size[1]) if size else None
+        return uploaded_photo, aspect_ratio
+
+    async def make_photo_post_content(self, photo: List[ImageRef], link: Optional[str] = None):
         """Create a post content with photos and an optional link."""
-        photos = []
-        aspect_ratios = []
-
-        for p in photo:
-            photo_data = base64.b64decode(p)
-            uploaded_photo = self.client.upload_blob(photo_data).blob
-            image: Image = Image.open(BytesIO(photo_data))
-            aspect_ratio = models.AppBskyEmbedDefs.AspectRatio(height=image.height, width=image.width)
-            aspect_ratios.append(aspect_ratio)
-            photos.append(uploaded_photo)
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        uploaded = await asyncio.gather(*(self.upload_photo(p, semaphore) for p in photo))
+        photos = [blob for blob, _ in uploaded]
+        aspect_ratios = [aspect_ratio for _, aspect_ratio in uploaded]
         if link:
             if is_valid_bluesky_url(link):
                 # If the link is a Bluesky post, fetch the post details
-                post_record, _ = self.fetch_post(link)
+                post_record, _ = await self.fetch_post(link)
                 if post_record:
                     embed = models.AppBskyEmbedRecordWithMedia.Main(
                         record=models.AppBskyEmbedRecord.Main(record=post_record),
@@ -199,19 +230,12 @@ class BlueskyService():
                         )
                     )
             else:
-                # If the link is not a Bluesky post, create an embed for the images with the link
+                # A post has one embed and the images take it, there's no room for a link card
                 embed = models.AppBskyEmbedImages.Main(
                     images=[models.AppBskyEmbedImages.Image(
                         image=photo,
                         aspect_ratio=aspect_ratio
-                    ) for photo, aspect_ratio in zip(photos, aspect_ratios)],
-                    external=models.AppBskyEmbedExternal.Main(
-                        external=models.AppBskyEmbedExternal.External(
-                            uri=link,
-                            title=None,  # Optional title can be set if needed
-                            description=None  # Optional description can be set if needed
-                        )
-                    )
+                    ) for photo, aspect_ratio in zip(photos, aspect_ratios)]
                 )
         else:
             # If there is no link, create an embed for the images
@@ -225,26 +249,37 @@ class BlueskyService():
 
         return embed
         
-    def make_link_post_content(self, link: str):
+    async def make_link_post_content(self, link: str):
         """Create a post content with a link."""
         if is_valid_bluesky_url(link):
             # If the link is a Bluesky post, fetch the post details
-            post_record, _ = self.fetch_post(link)
+            post_record, _ = await self.fetch_post(link)
             if post_record:
                 return models.AppBskyEmbedRecord.Main(record=post_record)
         else:
             # If the link is not a Bluesky post, create an embed for the link
-            return models.AppBskyEmbedExternal.Main(
-                external=models.AppBskyEmbedExternal.External(
-                    uri=link,
-                    title=None,  # Optional title can be set if needed
-                    description=None  # Optional description can be set if needed
-                )
+            return await self.make_external(link)
+
+    @traced('bluesky.make_external')
+    async def make_external(self, link: str) -> models.AppBskyEmbedExternal.Main:
+        """Link card with the page's title, description and thumbnail."""
+        preview = await link_previews.get(link)
+        thumb = None
+        if preview.thumb:
+            # uploaded per post, a blob no record points to anymore is garbage collected by the PDS
+            thumb = (await self.client.upload_blob(preview.thumb)).blob
+        return models.AppBskyEmbedExternal.Main(
+            external=models.AppBskyEmbedExternal.External(
+                uri=link,
+                title=preview.title,
+                description=preview.description,
+                thumb=thumb,
             )
-        
-    def make_reply_post_ref(self, reply_link: str):
+        )
+
+    async def make_reply_post_ref(self, reply_link: str):
         """Create a post content for replying to another post."""
-        post_to_reply, root_post = self.fetch_post(reply_link)
+        post_to_reply, root_post = await self.fetch_post(reply_link)
         if not post_to_reply:
             raise ValueError('Post to reply to not found or could not be fetched')
         
@@ -256,85 +291,327 @@ class BlueskyService():
 
         return models.AppBskyFeedPost.ReplyRef(parent=parent_ref, root=root_ref)
 
-    def post(self, text: str, photo = None, qrt_link: Optional[str] = None, respond_to: Optional[str] = None):
-        if not text and not photo:
-            raise ValueError('At least one field must be provided to create a post')
-        
-        embed = None
-
-        if photo and len(photo) > 0:
-            if len(photo) > 4:
-                raise ValueError('You can only upload up to 4 photos in a single post')
-            embed = self.make_photo_post_content(photo, qrt_link)
-        elif qrt_link:
-            embed = self.make_link_post_content(qrt_link)
-
-        facets = parse_facets(text)
+    @traced('bluesky.post')
+    async def post(self, text: str, photo: Optional[List[ImageRef]] = None, qrt_link: Optional[str] = None, respond_to: Optional[str] = None, rkey: Optional[str] = None, resume: bool = False):
+        """Post ``text``, as a thread when it's over the length limit.
 
-        if respond_to:
-            reply_to = self.make_reply_post_ref(respond_to)
-            post = self.client.send_post(text, embed=embed, reply_to=reply_to, facets=facets)
-        else:
-            post = self.client.send_post(text, embed=embed, facets=facets)
-        db.Posts(text=text, cid=post.cid, uri=post.uri).save()
+        Images and the quoted post go on the first post only, every following
+        chunk replies to the previous one. With ``rkey`` the posts get record keys
+        derived from it, and ``resume`` skips the ones a previous attempt created.
+        """
+        if not (text and text.strip()) and not photo:
+            raise ValueError('At least one field must be provided to create a post')
+        if photo and len(photo) > 4:
+            raise ValueError('You can only upload up to 4 photos in a single post')
+
+        async def make_embed():
+            if photo:
+                return await self.make_photo_post_content(photo, qrt_link)
+            if qrt_link:
+                return await self.make_link_post_content(qrt_link)
+            return None
+
+        reply_to = await self.make_reply_post_ref(respond_to) if respond_to else None
+        await self._post_thread(text, reply_to, make_embed, rkey=rkey, resume=resume)
+
+    @traced('bluesky.create_thread')
+    async def _post_thread(self, text: str, reply_to: Optional[models.AppBskyFeedPost.ReplyRef] = None,
+                           make_embed: Optional[Callable[[], Awaitable]] = None, parent: Optional[db.Posts] = None,
+                           root: Optional[db.Posts] = None, rkey: Optional[str] = None, resume: bool = False):
+        """Create the posts of ``text`` as a reply chain, saving each with its parent/root."""
+        with span('bluesky.facets'):
+            facets = await parse_facets(text) if text else []
+            chunks = split_thread(text, facets)
+
+        for i, (chunk, chunk_facets) in enumerate(chunks):
+            chunk_rkey = offset_tid(rkey, i) if rkey else None
+            created = await self.get_own_record(models.ids.AppBskyFeedPost, chunk_rkey) if resume and chunk_rkey else None
+            if not created:
+                embed = await make_embed() if i == 0 and make_embed else None
+                # same record send_post builds, but created through the namespace so a fixed rkey
+                # (the outbox idempotency key) makes a retried create collide instead of duplicating
+                record = models.AppBskyFeedPost.Record(
+                    created_at=self.client.get_current_time_iso(),
+                    text=chunk,
+                    reply=reply_to,
+                    embed=embed,
+                    langs=['en'],
+                    facets=chunk_facets,
+                )
+                created = await self.client.app.bsky.feed.post.create(self.client.me.did, record, rkey=chunk_rkey)
+
+            saved = await self.save_post(chunk, created.cid, created.uri, parent=parent, root=root)
+            parent = saved
+            root = root or saved
+            # the rest of the thread hangs under the first post, or under the thread it answers
+            post_ref = models.ComAtprotoRepoStrongRef.Main(cid=created.cid, uri=created.uri)
+            reply_to = models.AppBskyFeedPost.ReplyRef(parent=post_ref, root=reply_to.root if reply_to else post_ref)
+
+    @traced('bluesky.save_post')
+    async def save_post(self, text: str, cid: str, uri: str, parent: Optional[db.Posts] = None, root: Optional[db.Posts] = None) -> db.Posts:
+        """Keep track of something we posted, once per record URI."""
+        def save():
+            return db.Posts.objects(uri=uri).first() or db.Posts(text=text, cid=cid, uri=uri, parent=parent, root=root).save()
+        return await asyncio.to_thread(save)
+
+    async def get_own_record(self, collection: str, rkey: str):
+        """Fetch one of our own records, None if it doesn't exist."""
+        try:
+            return await self.client.com.atproto.repo.get_record(
+                models.ComAtprotoRepoGetRecord.Params(repo=self.client.me.did, collection=collection, rkey=rkey)
+            )
+        except BadRequestError:
+            return None
 
-    def repost(self, original_post_url: str):
+    @traced('bluesky.repost')
+    async def repost(self, original_post_url: str, rkey: Optional[str] = None):
         if not is_valid_bluesky_url(original_post_url):
             raise ValueError('Invalid Bluesky post URL')
 
-        post_record, _ = self.fetch_post(original_post_url)
+        post_record, _ = await self.fetch_post(original_post_url)
         if not post_record:
             raise ValueError('Post not found or could not be fetched')
 
         # Create a repost
-        repost = self.client.repost(uri=post_record.uri, cid=post_record.cid)
-        db.Posts(text=f'retweet from this: {original_post_url}', cid=repost.cid, uri=repost.uri).save()
+        repost = await self.client.app.bsky.feed.repost.create(
+            self.client.me.did,
+            models.AppBskyFeedRepost.Record(created_at=self.client.get_current_time_iso(), subject=post_record),
+            rkey=rkey,
+        )
+        await self.save_post(f'retweet from this: {original_post_url}', repost.cid, repost.uri)
 
-    def delete_post(self, post_id: int):
+    @traced('bluesky.delete_post')
+    async def delete_post(self, post_id: int):
         if not post_id:
             raise ValueError('Post ID is required to delete a post')
-        post = db.Posts.objects(id=post_id).first()
+        post = await asyncio.to_thread(db.Posts.objects(id=post_id).first)
         if not post:
             raise ValueError('Post not found')
-        self.client.delete_post(post.uri)
-        post.delete()
+        await self.client.delete_post(post.uri)
+        forget_post(post.uri)
+        await asyncio.to_thread(post.delete)
+
+    @traced('bluesky.delete_posts')
+    async def delete_posts(self, post_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Delete several posts at once.
+
+        The records are deleted concurrently, then every post that is gone from
+        Bluesky is removed from ``db.Posts`` with one query.
+
+        Returns:
+            Dict[int, Optional[str]]: post id -> None when deleted, else the error.
+        """
+        uris = await asyncio.to_thread(
+            lambda: {doc['_id']: doc['uri'] for doc in db.Posts.objects(id__in=post_ids).only('id', 'uri').as_pymongo()})
+        semaphore = asyncio.Semaphore(WRITE_CONCURRENCY)
+
+        async def delete(post_id: int) -> Optional[str]:
+            if post_id not in uris:
+                return 'Post not found'
+            try:
+                async with semaphore:
+                    await self.client.delete_post(uris[post_id])
+            except Exception as e:
+                return f'{type(e).__name__}: {e}'
+            forget_post(uris[post_id])
+            return None
+
+        errors = await asyncio.gather(*(delete(post_id) for post_id in post_ids))
+        results = dict(zip(post_ids, errors))
+        deleted = [post_id for post_id, error in results.items() if error is None]
+        if deleted:
+            await asyncio.to_thread(lambda: db.Posts.objects(id__in=deleted).delete())
+        return results
+
+    def _load_thread_docs(self, post_id: int) -> Dict[int, Dict]:
+        """Raw documents of every post in the thread ``post_id`` belongs to, by id.
+
+        One query on ``_id``/``root`` when ``post_id`` is the root, a second one
+        when it turns out to be a reply. ``as_pymongo`` keeps ``parent``/``root``
+        as plain ids, so nothing is dereferenced one document at a time.
+        """
+        def query(root_id: int) -> Dict[int, Dict]:
+            return {doc['_id']: doc for doc in
+                    db.Posts.objects(Q(id=root_id) | Q(root=root_id)).only('id', 'text', 'cid', 'uri', 'parent', 'root').as_pymongo()}
+
+        docs = query(post_id)
+        post = docs.get(post_id)
+        if post and post.get('root'):
+            docs = query(post['root'])
+        return docs
+
+    @traced('bluesky.get_thread')
+    async def get_thread(self, post_id: int) -> Tuple[Dict, Dict[int, List[Dict]]]:
+        """Load the thread ``post_id`` belongs to.
 
-    def reply_to_post(self, post_id: int, text: str):
-        if not post_id or not text:
+        When the root post was deleted its replies still hang under its id, the
+        root document is then a placeholder with ``deleted`` set.
+
+        Returns:
+            tuple: (root document, parent id -> child documents, oldest first)
+        """
+        docs = await asyncio.to_thread(self._load_thread_docs, post_id)
+        post = docs.get(post_id)
+        if not post:
+            raise ValueError('Post not found')
+        root_id = post.get('root') or post_id
+        root = docs.get(root_id) or {'_id': root_id, 'text': None, 'deleted': True}
+
+        children: Dict[int, List[Dict]] = {}
+        for doc in sorted(docs.values(), key=lambda doc: doc['_id']):
+            if doc is root:
+                continue
+            # a reply whose parent we no longer track still belongs to the thread
+            parent = doc.get('parent') if doc.get('parent') in docs else root['_id']
+            children.setdefault(parent, []).append(doc)
+        return root, children
+
+    @traced('bluesky.reply_to_post')
+    async def reply_to_post(self, post_id: int, text: str, rkey: Optional[str] = None, resume: bool = False):
+        """Reply to one of our posts, as a thread when the text is over the length limit."""
+        if not post_id or not text or not text.strip():
             raise ValueError('Post ID and text are required to reply to a post')
-        post: db.Posts = db.Posts.objects(id=post_id).first()
+        docs = await asyncio.to_thread(self._load_thread_docs, post_id)
+        post = docs.get(post_id)
         if not post:
             raise ValueError('Post not found')
-        root_post = post.root or post
-        parent_ref = models.ComAtprotoRepoStrongRef.Main(cid=post.cid, uri=post.uri)
-        root_ref = models.ComAtprotoRepoStrongRef.Main(cid=root_post.cid, uri=root_post.uri)
-
-        reply_post = self.client.send_post(text, reply_to=models.AppBskyFeedPost.ReplyRef(parent=parent_ref, root=root_ref))
-        db.Posts(text=text, cid=reply_post.cid, uri=reply_post.uri, parent=post, root=root_post).save()
-
-    def add_to_list(self, username: str):
+        root_id = post.get('root') or post_id
+        parent_ref = models.ComAtprotoRepoStrongRef.Main(cid=post['cid'], uri=post['uri'])
+        if root_id in docs:
+            root_ref = models.ComAtprotoRepoStrongRef.Main(cid=docs[root_id]['cid'], uri=docs[root_id]['uri'])
+        else:
+            # the root was deleted, the parent's own record still points at it
+            parent = await self.get_own_record(models.ids.AppBskyFeedPost, AtUri.from_str(post['uri']).rkey)
+            if not parent:
+                raise ValueError('Post not found')
+            root_ref = parent.value.reply.root if parent.value.reply else parent_ref
+
+        # references only need the id, no need to load the full documents
+        await self._post_thread(text, models.AppBskyFeedPost.ReplyRef(parent=parent_ref, root=root_ref),
+                                parent=db.Posts(id=post['_id']), root=db.Posts(id=root_id), rkey=rkey, resume=resume)
+
+    @traced('bluesky.add_to_list')
+    async def add_to_list(self, username: str):
         """Add a user to the Bluesky list."""
         if not username:
             raise ValueError('Username is required to add to the list')
 
         # Check if the list exists
-        mod_list_uri = os.getenv("BLUESKY_LIST", "")
-        if not mod_list_uri:
-            raise ValueError('BLUESKY_LIST environment variable is not set')
+        mod_list_uri = list_mirror.list_uri
 
         # Resolve the DID for the username
-        user_to_add = self.resolver.handle.resolve(username)
+        user_to_add = await self.resolver.resolve(username)
         if not user_to_add:
             raise ValueError(f'Could not resolve DID for handle "{username}"')
 
+        # the mirror follows our own writes, it only needs its first sync since the start
+        await list_mirror.sync_if_stale(self.client, math.inf)
+        if await list_mirror.contains(user_to_add):
+            raise ValueError(f'@{username} is already on the list')
+
         # Resolve mod list owner
         mod_list_owner = AtUri.from_str(mod_list_uri).host
 
-        _ = self.client.app.bsky.graph.listitem.create(
+        response = await self.client.app.bsky.graph.listitem.create(
             mod_list_owner,
             models.AppBskyGraphListitem.Record(
                 list=mod_list_uri,
                 subject=user_to_add,
                 created_at=self.client.get_current_time_iso(),
             ),
-        )
\ No newline at end of file
+        )
+        await list_mirror.add(user_to_add, response.uri)
+
+    @traced('bluesky.remove_from_list')
+    async def remove_from_list(self, username: str):
+        """Remove a user from the Bluesky list."""
+        if not username:
+            raise ValueError('Username is required to remove from the list')
+
+        did = await self.resolver.resolve(username)
+        if not did:
+            raise ValueError(f'Could not resolve DID for handle "{username}"')
+
+        await list_mirror.sync_if_stale(self.client, math.inf)
+        uri = await list_mirror.get(did)
+        if not uri:
+            raise ValueError(f'@{username} is not on the list')
+
+        item = AtUri.from_str(uri)
+        await self.client.app.bsky.graph.listitem.delete(item.host, item.rkey)
+        await list_mirror.remove(did)
+
+    async def list_count(self) -> int:
+        """Number of users on the Bluesky list."""
+        await list_mirror.sync_if_stale(self.client)
+        return await list_mirror.count()
+
+    async def list_members(self) -> Set[str]:
+        """DIDs already on the Bluesky list, from the local mirror."""
+        await list_mirror.sync_if_stale(self.client)
+        return set(await list_mirror.members())
+
+    @traced('bluesky.bulk_add_to_list')
+    async def bulk_add_to_list(self, handles: List[str], progress: Optional[Callable[[str], Awaitable]] = None) -> Dict:
+        """Add many users to the Bluesky list.
+
+        Handles are resolved concurrently, users already on the list are skipped
+        and the rest are written with applyWrites in batches.
+
+        Args:
+            handles (List[str]): Handles (or DIDs) to add.
+            progress (Callable): Optional coroutine called with a progress line.
+        Returns:
+            Dict: ``added``, ``already`` and ``unresolved`` handles, and ``failed`` (handle, error) pairs.
+        """
+        mod_list_uri = list_mirror.list_uri
+        mod_list_owner = AtUri.from_str(mod_list_uri).host
+        handles = [handle.strip().lstrip('@') for handle in handles if handle.strip()]
+        # handles are case-insensitive, DIDs are not
+        handles = list(dict.fromkeys(handle if handle.startswith('did:') else handle.lower() for handle in handles))
+        if not handles:
+            raise ValueError('No handles to add to the list')
+
+        async def report(text: str):
+            if progress:
+                await progress(text)
+
+        await report(f'Resolving {len(handles)} handles...')
+        members = await self.list_members()
+        # one handle the resolver chokes on shouldn't sink the other few hundred
+        dids = await asyncio.gather(*(self.resolver.resolve(handle) for handle in handles), return_exceptions=True)
+
+        result = {'added': [], 'already': [], 'unresolved': [], 'failed': []}
+        to_add = {}
+        for handle, did in zip(handles, dids):
+            if isinstance(did, Exception):
+                result['failed'].append((handle, str(did)))
+            elif not did:
+                result['unresolved'].append(handle)
+            elif did in members or did in to_add:
+                result['already'].append(handle)
+            else:
+                to_add[did] = handle
+
+        pending = list(to_add.items())
+        for start in range(0, len(pending), APPLY_WRITES_BATCH):
+            batch = pending[start:start + APPLY_WRITES_BATCH]
+            created_at = self.client.get_current_time_iso()
+            writes = [
+                models.ComAtprotoRepoApplyWrites.Create(
+                    collection=models.ids.AppBskyGraphListitem,
+                    value=models.AppBskyGraphListitem.Record(list=mod_list_uri, subject=did, created_at=created_at),
+                )
+                for did, _ in batch
+            ]
+            try:
+                response = await self.client.com.atproto.repo.apply_writes(
+                    models.ComAtprotoRepoApplyWrites.Data(repo=mod_list_owner, writes=writes))
+                result['added'].extend(handle for _, handle in batch)
+                await list_mirror.add_many({did: created.uri for (did, _), created in zip(batch, response.results)})
+            except Exception as e:
+                # applyWrites is atomic, the whole batch failed
+                result['failed'].extend((handle, str(e)) for _, handle in batch)
+            await report(f'Added {len(result["added"])}/{len(pending)} users to the list...')
+
+        return result
@@ -0,0 +1,113 @@
+import re
+import unicodedata
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from atproto import models
+
+# app.bsky.richtext.facet#tag allows 64 graphemes, counting characters is close enough
+MAX_TAG_LENGTH = 64
+
+# One pattern for every facet kind, compiled once. Every branch starts with its
+# trigger ("@", "http", "#" or full-width "＃") as a plain literal, so the
+# regex engine jumps from one trigger character to the next instead of trying
+# every kind at every offset. The lookbehind right after the trigger only lets
+# a facet start at the beginning of the text, after whitespace or after an
+# opening bracket/quote, so e-mail addresses and "a#b" are left alone. Each
+# branch captures what follows its trigger. Being a single alternation, matches
+# never overlap: a "#" or "@" inside a URL is part of the URL, not a tag or
+# mention of its own.
+_not_after = r'''[^\s(\[{"'“‘«]'''
+_tag_rest = r'[^\s#＃\u00AD\u2060\u200A\u200B\u200C\u200D\u20E2]+'
+_facet_pattern = re.compile(rf'''
+    @(?<!{_not_after}@)((?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{{0,61}}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{{0,61}}[a-zA-Z0-9])?)
+  | http(?<!{_not_after}http)(s?://(?:www\.)?[-a-zA-Z0-9@:%._+~\#=]{{1,256}}\.[a-zA-Z0-9()]{{1,6}}\b(?:[-a-zA-Z0-9()@:%_+.~\#?&/=]*[-a-zA-Z0-9@%_+~\#/=])?)
+  | \#(?<!{_not_after}\#)({_tag_rest})
+  | ＃(?<!{_not_after}＃)({_tag_rest})
+''', re.VERBOSE)
+
+class FacetSpan(NamedTuple):
+    """A mention, link or tag found in a text, with UTF-8 byte offsets."""
+    kind: str
+    byte_start: int
+    byte_end: int
+    #handle without "@", URL, or tag without "#"
+    value: str
+
+# tuple.__new__ skips the NamedTuple constructor, a Python function
+_new_span = tuple.__new__
+
+def _trim_tag(tag: str) -> Optional[str]:
+    # trailing punctuation ends the tag ("#bluesky!"), a tag of only digits isn't one ("#1")
+    end = len(tag)
+    while end > 1 and unicodedata.category(tag[end - 1]).startswith('P'):
+        end -= 1
+    tag = tag[:end]
+    if len(tag) < 2 or tag[1:].isdigit() or len(tag) - 1 > MAX_TAG_LENGTH:
+        return None
+    return tag
+
+def extract_spans(text: str) -> List[FacetSpan]:
+    """Find every mention, link and hashtag in ``text`` in one scan.
+
+    ``split`` hands back the text between facets along with the groups, so no
+    match objects are built; encoding those pieces turns character counts into
+    the byte offsets facets use. Spans come back ordered and never overlap.
+    """
+    spans = []
+    ascii_only = text.isascii()
+    # text before a facet, then one group per branch, None for the branches that didn't match
+    parts = iter(_facet_pattern.split(text))
+    byte_pos = 0
+    for gap, mention, link, tag, wide_tag in zip(parts, parts, parts, parts, parts):
+        start = byte_pos + (len(gap) if ascii_only else len(gap.encode('UTF-8')))
+        # mentions and links are ASCII, one byte per character
+        if mention is not None:
+            byte_pos = start + 1 + len(mention)
+            spans.append(_new_span(FacetSpan, ('mention', start, byte_pos, mention)))
+            continue
+        if link is not None:
+            byte_pos = start + 4 + len(link)
+            spans.append(_new_span(FacetSpan, ('link', start, byte_pos, 'http' + link)))
+            continue
+        trigger, tag = ('#', tag) if tag is not None else ('＃', wide_tag)
+        byte_pos = start + (1 + len(tag) if ascii_only else len((trigger + tag).encode('UTF-8')))
+        # most tags end in a letter or digit and need no trimming
+        if tag[-1].isalnum() and len(tag) <= MAX_TAG_LENGTH and not tag.isdigit():
+            spans.append(_new_span(FacetSpan, ('tag', start, byte_pos, tag)))
+            continue
+        trimmed = _trim_tag(trigger + tag)
+        if trimmed is not None:
+            spans.append(_new_span(FacetSpan, ('tag', start, start + len(trimmed.encode('UTF-8')), trimmed[1:])))
+    return spans
+
+def make_facet(span: FacetSpan, did: Optional[str] = None) -> models.AppBskyRichtextFacet.Main:
+    if span.kind == 'mention':
+        feature = models.AppBskyRichtextFacet.Mention(did=did)
+    elif span.kind == 'link':
+        feature = models.AppBskyRichtextFacet.Link(uri=span.value)
+    else:
+        feature = models.AppBskyRichtextFacet.Tag(tag=span.value)
+    return models.AppBskyRichtextFacet.Main(
+        index=models.AppBskyRichtextFacet.ByteSlice(byte_start=span.byte_start, byte_end=span.byte_end),
+        features=[feature],
+    )
+
+async def build_facets(text: str, resolve_many: Callable[[Iterable[str]], Awaitable[Dict[str, Optional[str]]]]) -> List[models.AppBskyRichtextFacet.Main]:
+    """Typed facets for ``text``, ready for a post record.
+
+    Mentions are resolved in one concurrent batch; handles that don't resolve
+    are left as plain text.
+    """
+    spans = extract_spans(text)
+    handles = [span.value for span in spans if span.kind == 'mention']
+    dids = await resolve_many(handles) if handles else {}
+    facets = []
+    for span in spans:
+        if span.kind == 'mention':
+            did = dids.get(span.value)
+            if not did:
+                continue
+            facets.append(make_facet(span, did))
+        else:
+            facets.append(make_facet(span))
+    return facets
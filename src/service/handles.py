@@ -0,0 +1,82 @@
+import asyncio
+import time
+from typing import Dict, Iterable, Optional
+
+from service.cache import TTLCache, MISSING
+from service.http import BSKY_SERVICE_URL, get_http_client
+from service.metrics import xrpc_failures, xrpc_seconds
+from service.rate_limit import XRPC_MAX_RATE_LIMIT_WAIT, rate_limiter
+from service.tracing import span
+
+# goes through plain httpx, not the atproto client, so it's timed here
+_resolve_seconds = xrpc_seconds.labels('com.atproto.identity.resolveHandle')
+
+class HandleResolver():
+    """Resolves handles to DIDs through ``com.atproto.identity.resolveHandle``.
+
+    Results go through an LRU+TTL cache; handles the server rejects with a 400
+    are cached as ``None`` for a shorter time so typos don't hit the network on
+    every post. Bulk lookups run concurrently, at most ``max_concurrency`` at once,
+    drawing from the shared read budget.
+    """
+    def __init__(self, cache: Optional[TTLCache] = None, negative_ttl: float = 300, max_concurrency: int = 8):
+        self.cache = cache or TTLCache(max_size=4096, ttl=6 * 3600)
+        self.negative_ttl = negative_ttl
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def resolve(self, handle: str) -> Optional[str]:
+        handle = handle.lower().lstrip('@')
+        if handle.startswith('did:'):
+            return handle
+
+        did = self.cache.get(handle, MISSING)
+        if did is not MISSING:
+            return did
+
+        # the same handle asked for while its lookup is in flight shares the request
+        task = self._inflight.get(handle)
+        if not task:
+            task = asyncio.ensure_future(self._fetch(handle))
+            self._inflight[handle] = task
+            task.add_done_callback(lambda _: self._inflight.pop(handle, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, handle: str) -> Optional[str]:
+        async with self._semaphore:
+            while True:
+                await rate_limiter.acquire(rate_limiter.reads, 1)
+                start = time.perf_counter()
+                try:
+                    with span('xrpc.com.atproto.identity.resolveHandle'):
+                        resp = await get_http_client().get(
+                            f"{BSKY_SERVICE_URL}/xrpc/com.atproto.identity.resolveHandle",
+                            params={"handle": handle},
+                        )
+                except Exception:
+                    xrpc_failures.labels('com.atproto.identity.resolveHandle').inc()
+                    raise
+                finally:
+                    rate_limiter.reads.release(1)
+                    _resolve_seconds.observe(time.perf_counter() - start)
+                if resp.status_code != 429:
+                    rate_limiter.reads.update(resp.headers)
+                    break
+                xrpc_failures.labels('com.atproto.identity.resolveHandle').inc()
+                wait = rate_limiter.reads.limited(resp.headers)
+                if not rate_limiter.enabled or wait > XRPC_MAX_RATE_LIMIT_WAIT:
+                    resp.raise_for_status()
+        if resp.status_code == 400:
+            self.cache.set(handle, None, ttl=self.negative_ttl)
+            return None
+        resp.raise_for_status()
+        did = resp.json()["did"]
+        self.cache.set(handle, did)
+        return did
+
+    async def resolve_many(self, handles: Iterable[str]) -> Dict[str, Optional[str]]:
+        unique = list(dict.fromkeys(handles))
+        dids = await asyncio.gather(*(self.resolve(h) for h in unique))
+        return dict(zip(unique, dids))
+
+handle_resolver = HandleResolver()
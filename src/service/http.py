@@ -0,0 +1,15 @@
+import httpx
+import os
+from typing import Optional
+
+# PDS / entryway the bot talks to, overridable for a self-hosted PDS or the local fake one
+BSKY_SERVICE_URL = os.getenv('BSKY_SERVICE_URL', 'https://bsky.social')
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared async HTTP client for calls that don't go through atproto."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=10)
+    return _http_client
@@ -0,0 +1,112 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from service.images import ImageRef
+from service.tracing import span
+
+# Bluesky rejects blobs over 1,000,000 bytes
+MAX_BLOB_BYTES = int(os.getenv('BSKY_IMAGE_MAX_BYTES', '976560'))
+IMAGE_WORKERS = int(os.getenv('BSKY_IMAGE_WORKERS', '2'))
+
+@dataclass(frozen=True)
+class ImagePreset():
+    max_edge: int
+    max_bytes: int = MAX_BLOB_BYTES
+    max_quality: int = 90
+    min_quality: int = 40
+
+PRESETS: Dict[str, ImagePreset] = {
+    'post': ImagePreset(max_edge=2000),
+    'avatar': ImagePreset(max_edge=1000),
+    'banner': ImagePreset(max_edge=3000),
+    # link card thumbnails are shown small, no point in spending the full blob budget
+    'card': ImagePreset(max_edge=1200, max_bytes=300_000),
+}
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    # nothing from info (EXIF, XMP, ICC comments) is passed on, so metadata is dropped
+    image.save(buffer, image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def _fit_budget(image: Image.Image, image_format: str, preset: ImagePreset) -> bytes:
+    """Binary search the highest quality that fits, shrinking the image if even the lowest doesn't."""
+    while True:
+        low, high = preset.min_quality, preset.max_quality
+        best = None
+        while low <= high:
+            quality = (low + high) // 2
+            encoded = _encode(image, image_format, quality)
+            if len(encoded) <= preset.max_bytes:
+                best = encoded
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is not None:
+            return best
+        image = image.resize((max(1, int(image.width * 0.8)), max(1, int(image.height * 0.8))), Image.Resampling.LANCZOS)
+
+def optimise_image(data: bytes, preset: ImagePreset) -> Tuple[bytes, int, int]:
+    """Downscale, strip metadata and re-encode an image to fit ``preset``.
+
+    Runs in a worker process. Returns the new bytes and dimensions, or the
+    original bytes when the image already fits and carries no metadata.
+    """
+    with Image.open(BytesIO(data)) as image:
+        needs_resize = max(image.size) > preset.max_edge
+        has_metadata = bool(image.info.get('exif') or image.getexif())
+        if not needs_resize and not has_metadata and len(data) <= preset.max_bytes:
+            return data, image.width, image.height
+
+        # apply the EXIF orientation before the EXIF block is thrown away
+        image = ImageOps.exif_transpose(image)
+        if needs_resize:
+            image.thumbnail((preset.max_edge, preset.max_edge), Image.Resampling.LANCZOS)
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        if has_alpha:
+            image = image.convert('RGBA')
+            image_format = 'WEBP'
+        else:
+            image = image.convert('RGB')
+            image_format = 'JPEG'
+
+        encoded = _fit_budget(image, image_format, preset)
+        with Image.open(BytesIO(encoded)) as result:
+            return encoded, result.width, result.height
+
+_pool: Optional[ProcessPoolExecutor] = None
+bytes_in = 0
+bytes_out = 0
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, the bot process has threads (to_thread, pymongo) that don't survive a fork
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+async def optimise(image: ImageRef, preset_name: str = 'post') -> ImageRef:
+    """Run :func:`optimise_image` on a loaded image off the event loop."""
+    global bytes_in, bytes_out
+    if image.data is None:
+        raise ValueError('Image must be loaded before optimising')
+
+    preset = PRESETS[preset_name]
+    loop = asyncio.get_running_loop()
+    with span(f'optimise.{preset_name}'):
+        data, width, height = await loop.run_in_executor(get_pool(), optimise_image, image.data, preset)
+
+    saved = len(image.data) - len(data)
+    bytes_in += len(image.data)
+    bytes_out += len(data)
+    if saved:
+        print(f'Image optimised for {preset_name}: {len(image.data)} -> {len(data)} bytes ({saved} saved)')
+    return ImageRef(data=data, file_id=image.file_id, width=width, height=height)
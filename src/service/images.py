@@ -0,0 +1,207 @@
+import asyncio
+import os
+import struct
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from service.http import get_http_client
+from service.tracing import span
+
+# web images are optimised before upload, so this only guards memory
+WEB_IMAGE_MAX_BYTES = int(os.getenv('BSKY_WEB_IMAGE_MAX_BYTES', str(20 * 1024 * 1024)))
+# whole download, connect to last byte
+WEB_IMAGE_TIMEOUT = float(os.getenv('BSKY_WEB_IMAGE_TIMEOUT', '20'))
+
+# from Telegram and the web, for the metrics
+bytes_downloaded = 0
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        segment_length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        # SOF0..SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + segment_length
+    return None
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    return None
+
+# bytes up to the end of the size fields, a shorter file is cut off
+_HEADER_BYTES = {'png': 24, 'gif': 10, 'webp': 30}
+
+def image_format(data: bytes) -> Optional[str]:
+    """Tell PNG, JPEG, GIF and WebP apart by their magic bytes."""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read (width, height) from the image header without decoding the image.
+
+    Knows PNG, JPEG, GIF and WebP, anything else falls back to PIL (which also
+    only parses the header on open). None when the size can't be read, a
+    truncated header included.
+    """
+    size = None
+    image_type = image_format(data)
+    if len(data) < _HEADER_BYTES.get(image_type, 0):
+        return None
+    if image_type == 'png':
+        size = struct.unpack('>II', data[16:24])
+    elif image_type == 'jpeg':
+        size = _jpeg_size(data)
+    elif image_type == 'gif':
+        size = struct.unpack('<HH', data[6:10])
+    elif image_type == 'webp':
+        size = _webp_size(data)
+    if size:
+        return size
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            return image.width, image.height
+    except Exception:
+        return None
+
+async def _stream_image(url: str, max_bytes: int) -> bytes:
+    async with get_http_client().stream('GET', url, follow_redirects=True) as response:
+        if 400 <= response.status_code < 500:
+            # won't get better on a retry
+            raise ValueError(f'HTTP {response.status_code}')
+        response.raise_for_status()
+        content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+        # some hosts send octet-stream for everything, the magic bytes decide then
+        if content_type and not content_type.startswith('image/') and content_type != 'application/octet-stream':
+            raise ValueError(f'not an image ({content_type})')
+        length = response.headers.get('content-length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ValueError(f'too big ({length} bytes, limit {max_bytes})')
+
+        chunks = []
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            # content-length can be missing or lie
+            if received > max_bytes:
+                raise ValueError(f'too big (over {max_bytes} bytes)')
+            if not chunks and image_format(chunk) is None and len(chunk) >= 12:
+                raise ValueError('not an image (unknown file signature)')
+            chunks.append(chunk)
+    data = b''.join(chunks)
+    if image_format(data) is None:
+        raise ValueError('not an image (unknown file signature)')
+    return data
+
+async def download_image(url: str, max_bytes: int = WEB_IMAGE_MAX_BYTES, timeout: float = WEB_IMAGE_TIMEOUT) -> bytes:
+    """Stream an image from the web, stopping early if it's too big or not an image.
+
+    Raises:
+        ValueError: The URL isn't a PNG/JPEG/GIF/WebP image or is over ``max_bytes``.
+        TimeoutError: The whole download took longer than ``timeout`` seconds.
+    """
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError(f'Image URL must be http(s): {url}')
+    start = time.perf_counter()
+    try:
+        with span('image.download'):
+            data = await asyncio.wait_for(_stream_image(url, max_bytes), timeout=timeout)
+    except ValueError as e:
+        print(f'Rejected web image {url} after {time.perf_counter() - start:.2f}s: {e}')
+        raise ValueError(f'Image {url} rejected: {e}') from e
+    except asyncio.TimeoutError:
+        print(f'Rejected web image {url}: no complete response in {timeout:g}s')
+        raise TimeoutError(f'Image {url} took longer than {timeout:g}s to download')
+    global bytes_downloaded
+    bytes_downloaded += len(data)
+    print(f'Downloaded web image {url}: {len(data)} bytes in {time.perf_counter() - start:.2f}s')
+    return data
+
+@dataclass
+class ImageRef():
+    """An image the service can upload.
+
+    Either holds the raw bytes already, or only a Telegram ``file_id`` / web URL
+    which is downloaded by :meth:`load` right before sending. Width and height are
+    taken from Telegram's ``PhotoSize`` when known, otherwise probed from the header.
+    """
+    data: Optional[bytes] = None
+    file_id: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    url: Optional[str] = None
+
+    @classmethod
+    def from_photo(cls, photo) -> 'ImageRef':
+        """Reference a ``telegram.PhotoSize`` without downloading it."""
+        return cls(file_id=photo.file_id, width=photo.width, height=photo.height)
+
+    def to_dict(self) -> Dict:
+        """The reference part only, for storing in Mongo. Raw bytes are never stored."""
+        if not self.file_id and not self.url:
+            raise ValueError('Only images with a file_id or url can be stored')
+        return {'file_id': self.file_id, 'url': self.url, 'width': self.width, 'height': self.height}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'ImageRef':
+        return cls(file_id=data.get('file_id'), url=data.get('url'), width=data.get('width'), height=data.get('height'))
+
+    async def load(self, bot) -> 'ImageRef':
+        global bytes_downloaded
+        if self.data is None and self.url:
+            self.data = await download_image(self.url)
+        elif self.data is None:
+            if not self.file_id:
+                raise ValueError('Image has neither data nor a file_id to fetch it from')
+            with span('image.telegram'):
+                file = await bot.get_file(self.file_id)
+                buffer = BytesIO()
+                await file.download_to_memory(buffer)
+            # getvalue hands over the buffer without copying when nothing else references it
+            self.data = buffer.getvalue()
+            bytes_downloaded += len(self.data)
+        return self
+
+    def size(self) -> Optional[Tuple[int, int]]:
+        if self.width and self.height:
+            return self.width, self.height
+        if self.data is None:
+            return None
+        return image_size(self.data)
+
+async def load_images(images: Iterable[ImageRef], bot) -> List[ImageRef]:
+    """Download every image that is still only a reference, concurrently."""
+    return list(await asyncio.gather(*(image.load(bot) for image in images)))
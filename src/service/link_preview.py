@@ -0,0 +1,184 @@
+import asyncio
+import codecs
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from typing import Dict, Optional
+from urllib.parse import urljoin
+
+from dal import db
+from service.cache import TTLCache
+from service.http import get_http_client
+from service.image_pipeline import optimise
+from service.images import ImageRef, download_image
+from service.metrics import registry
+from service.tracing import span
+
+LINK_PREVIEW_TIMEOUT = float(os.getenv('LINK_PREVIEW_TIMEOUT', '5'))
+# the <head> is almost always in the first few KB, anything past this is not worth reading
+LINK_PREVIEW_MAX_BYTES = int(os.getenv('LINK_PREVIEW_MAX_BYTES', str(512 * 1024)))
+LINK_PREVIEW_TTL = int(os.getenv('LINK_PREVIEW_TTL', str(7 * 24 * 3600)))
+# a page that failed is tried again after this long
+LINK_PREVIEW_FAILURE_TTL = 10 * 60
+
+# card fields Bluesky shows, by the meta tags that can fill them (first one wins)
+_META_FIELDS = {
+    'title': ('og:title', 'twitter:title'),
+    'description': ('og:description', 'twitter:description', 'description'),
+    'image_url': ('og:image', 'og:image:url', 'og:image:secure_url', 'twitter:image', 'twitter:image:src'),
+}
+
+@dataclass
+class LinkPreview():
+    url: str
+    title: str = ''
+    description: str = ''
+    image_url: Optional[str] = None
+    thumb: Optional[bytes] = None
+
+class _HeadParser(HTMLParser):
+    """Collects OpenGraph/Twitter meta tags and <title>, stops caring at </head> or <body>."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta: Dict[str, str] = {}
+        self.title = ''
+        self.done = False
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+        elif tag == 'title':
+            self._in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            key = (attrs.get('property') or attrs.get('name') or '').strip().lower()
+            if key and attrs.get('content') and key not in self.meta:
+                self.meta[key] = attrs['content'].strip()
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+        elif tag == 'title':
+            self._in_title = False
+
+    def handle_data(self, data):
+        if self._in_title and not self.done:
+            self.title += data
+
+    def result(self) -> Dict[str, Optional[str]]:
+        fields = {field: next((self.meta[key] for key in keys if self.meta.get(key)), None)
+                  for field, keys in _META_FIELDS.items()}
+        fields['title'] = fields['title'] or ' '.join(self.title.split()) or None
+        return fields
+
+async def _read_head(url: str) -> Dict[str, Optional[str]]:
+    headers = {'Accept': 'text/html,application/xhtml+xml', 'User-Agent': 'Mozilla/5.0 (compatible; bsky-bot link preview)'}
+    async with get_http_client().stream('GET', url, headers=headers, follow_redirects=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get('content-type', '')
+        if 'html' not in content_type:
+            raise ValueError(f'not an HTML page ({content_type})')
+        charset = response.charset_encoding or 'utf-8'
+        try:
+            decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        parser = _HeadParser()
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            # leaving the stream early closes the connection, the rest of the page is never downloaded
+            if parser.done or received >= LINK_PREVIEW_MAX_BYTES:
+                break
+        fields = parser.result()
+        if fields['image_url']:
+            fields['image_url'] = urljoin(str(response.url), fields['image_url'])
+        return fields
+
+class LinkPreviews():
+    """OpenGraph metadata and a ready-to-upload thumbnail for external links.
+
+    Looked up in memory first, then in ``db.LinkPreviews`` (which Mongo expires
+    with a TTL index), and only then fetched: the page is streamed until the
+    end of its ``<head>`` under a strict timeout and byte cap, and the card
+    image goes through the image pipeline once. A failed fetch gives an empty
+    preview, so a post never fails because of its link card.
+    """
+    def __init__(self, cache: Optional[TTLCache] = None):
+        self.cache = cache or TTLCache(max_size=256, ttl=LINK_PREVIEW_TTL)
+        self.fetches = 0
+        self.failures = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def get(self, url: str) -> LinkPreview:
+        preview = self.cache.get(url)
+        if preview:
+            return preview
+        # several posts with the same link at once share one fetch
+        task = self._inflight.get(url)
+        if not task:
+            task = asyncio.ensure_future(self._load(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, url: str) -> LinkPreview:
+        stored = await asyncio.to_thread(self._load_stored, url)
+        if stored:
+            self.cache.set(url, stored)
+            return stored
+
+        with span('link_preview.fetch'):
+            preview = await self._fetch(url)
+        if preview:
+            self.cache.set(url, preview)
+            await asyncio.to_thread(self._store, preview)
+            return preview
+        preview = LinkPreview(url=url)
+        self.cache.set(url, preview, ttl=LINK_PREVIEW_FAILURE_TTL)
+        return preview
+
+    def _load_stored(self, url: str) -> Optional[LinkPreview]:
+        # the TTL monitor only runs once a minute, don't hand out what it's about to delete
+        fresh_after = datetime.utcnow() - timedelta(seconds=LINK_PREVIEW_TTL)
+        doc = db.LinkPreviews.objects(url=url, fetched_at__gt=fresh_after).first()
+        if not doc:
+            return None
+        return LinkPreview(url=doc.url, title=doc.title or '', description=doc.description or '', image_url=doc.image_url, thumb=doc.thumb)
+
+    def _store(self, preview: LinkPreview):
+        db.LinkPreviews.objects(url=preview.url).update_one(
+            set__title=preview.title, set__description=preview.description, set__image_url=preview.image_url,
+            set__thumb=preview.thumb, set__fetched_at=datetime.utcnow(), upsert=True)
+
+    async def _fetch(self, url: str) -> Optional[LinkPreview]:
+        self.fetches += 1
+        start = time.perf_counter()
+        try:
+            fields = await asyncio.wait_for(_read_head(url), timeout=LINK_PREVIEW_TIMEOUT)
+        except Exception as e:
+            self.failures += 1
+            print(f'Link preview for {url} failed after {time.perf_counter() - start:.2f}s: {type(e).__name__}: {e}')
+            return None
+
+        preview = LinkPreview(url=url, title=fields['title'] or '', description=fields['description'] or '', image_url=fields['image_url'])
+        if preview.image_url:
+            try:
+                image = ImageRef(data=await download_image(preview.image_url, timeout=LINK_PREVIEW_TIMEOUT))
+                preview.thumb = (await optimise(image, 'card')).data
+            except Exception as e:
+                # a card without a picture is still better than a bare link
+                print(f'Link preview image {preview.image_url} skipped: {type(e).__name__}: {e}')
+        print(f'Link preview for {url} fetched in {time.perf_counter() - start:.2f}s')
+        return preview
+
+link_previews = LinkPreviews()
+registry.collect('bot_link_preview_fetches_total', 'Link pages fetched for a card, and how many of those failed.', 'counter',
+                 lambda: {'fetched': link_previews.fetches, 'failed': link_previews.failures}, 'result')
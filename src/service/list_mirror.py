@@ -0,0 +1,167 @@
+import asyncio
+import os
+import time
+from typing import Dict, Iterable, Optional
+
+from atproto import AsyncClient, AtUri, models
+from pymongo import DeleteMany, UpdateMany
+
+from dal import db
+
+CURSOR_CONFIG_KEY = 'ListMirrorCursor'
+# list counts and member lists sync at most this often, adds and removes update the mirror themselves
+LIST_SYNC_INTERVAL = float(os.getenv('LIST_SYNC_INTERVAL', '300'))
+
+class ListMirror():
+    """Local copy of the ``listitem`` records of ``BLUESKY_LIST``.
+
+    Members live in ``db.ListMembers`` (subject DID -> record URI) and in an
+    in-memory dict loaded from it, so membership checks and counts never go to
+    the network. The first :meth:`sync` pages through every listitem record of
+    the list owner; later syncs only ask for records newer than the stored
+    cursor (record keys are TIDs, so they sort by creation time). Items deleted
+    outside the bot are only noticed by a full sync. The bot's own adds and
+    removes go straight into the mirror, see :meth:`sync_if_stale`.
+    """
+    def __init__(self):
+        self._members: Optional[Dict[str, str]] = None
+        self._synced_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def list_uri(self) -> str:
+        list_uri = os.getenv("BLUESKY_LIST", "")
+        if not list_uri:
+            raise ValueError('BLUESKY_LIST environment variable is not set')
+        return list_uri
+
+    def _cursor_key(self) -> str:
+        return f'{CURSOR_CONFIG_KEY}:{self.list_uri}'
+
+    def _load(self) -> Dict[str, str]:
+        return {member['subject']: member['uri'] for member in
+                db.ListMembers.objects(list_uri=self.list_uri).only('subject', 'uri').as_pymongo()}
+
+    async def _ensure_loaded(self) -> Dict[str, str]:
+        if self._members is None:
+            self._members = await asyncio.to_thread(self._load)
+        return self._members
+
+    async def contains(self, did: str) -> bool:
+        return did in await self._ensure_loaded()
+
+    async def get(self, did: str) -> Optional[str]:
+        """URI of the listitem record for ``did``, if it's on the list."""
+        return (await self._ensure_loaded()).get(did)
+
+    async def count(self) -> int:
+        return len(await self._ensure_loaded())
+
+    async def members(self) -> Dict[str, str]:
+        return dict(await self._ensure_loaded())
+
+    async def add(self, did: str, uri: str):
+        await self.add_many({did: uri})
+
+    async def add_many(self, added: Dict[str, str]):
+        members = await self._ensure_loaded()
+        members.update(added)
+        await asyncio.to_thread(self._save_members, added)
+
+    async def remove(self, did: str):
+        members = await self._ensure_loaded()
+        members.pop(did, None)
+        await asyncio.to_thread(lambda: db.ListMembers.objects(list_uri=self.list_uri, subject=did).delete())
+
+    def _save_members(self, members: Dict[str, str], gone: Iterable[str] = ()):
+        """Upsert ``members`` and delete the ``gone`` subjects in one round trip.
+
+        Each member is updated in place by its own upsert, so it's never missing
+        in between and two saves of the same subject can't trip the unique index.
+        The first sync can be thousands of items.
+        """
+        gone = list(gone)
+        # the filter is the unique key, so this touches one document; UpdateOne would
+        # do too, but mongomock (tests, benchmarks) can't take it in a bulk with pymongo 4.14
+        requests = [
+            UpdateMany({'list_uri': self.list_uri, 'subject': did},
+                       {'$set': {'uri': uri, 'rkey': AtUri.from_str(uri).rkey}}, upsert=True)
+            for did, uri in members.items()
+        ]
+        if gone:
+            requests.append(DeleteMany({'list_uri': self.list_uri, 'subject': {'$in': gone}}))
+        if requests:
+            db.ListMembers._get_collection().bulk_write(requests, ordered=False)
+
+    def _get_cursor(self) -> Optional[str]:
+        config = db.Config.objects(Key = self._cursor_key()).first()
+        return config.Value if config else None
+
+    def _set_cursor(self, cursor: str):
+        config = db.Config.objects(Key = self._cursor_key()).first()
+        newConfig = db.Config() if not config else config
+        newConfig.Key = self._cursor_key()
+        newConfig.Value = cursor
+        newConfig.save()
+
+    async def sync(self, client: AsyncClient, full: bool = False) -> int:
+        """Fetch listitem records created since the last sync.
+
+        Args:
+            client (AsyncClient): Logged in client.
+            full (bool): Page through every record and drop members that are gone.
+        Returns:
+            int: Number of members added to the mirror.
+        """
+        async with self._lock:
+            list_uri = self.list_uri
+            members = await self._ensure_loaded()
+            cursor = None if full else await asyncio.to_thread(self._get_cursor)
+            found: Dict[str, str] = {}
+            last_rkey = cursor
+            while True:
+                response = await client.com.atproto.repo.list_records(models.ComAtprotoRepoListRecords.Params(
+                    repo=AtUri.from_str(list_uri).host,
+                    collection=models.ids.AppBskyGraphListitem,
+                    limit=100,
+                    cursor=cursor,
+                    # oldest first, so the cursor always points at the newest record seen
+                    reverse=True,
+                ))
+                for record in response.records:
+                    last_rkey = AtUri.from_str(record.uri).rkey
+                    if record.value.list == list_uri:
+                        found[record.value.subject] = record.uri
+                cursor = response.cursor
+                if not cursor or not response.records:
+                    break
+
+            new = {did: uri for did, uri in found.items() if members.get(did) != uri}
+            gone = set(members) - set(found) if full else set()
+
+            def save():
+                self._save_members(new, gone)
+                if last_rkey:
+                    self._set_cursor(last_rkey)
+
+            await asyncio.to_thread(save)
+            members.update(new)
+            for did in gone:
+                members.pop(did, None)
+            self._synced_at = time.monotonic()
+            if new or gone:
+                print(f'List mirror synced: {len(new)} added, {len(gone)} removed, {len(members)} members')
+            return len(new)
+
+    async def sync_if_stale(self, client: AsyncClient, max_age: float = LIST_SYNC_INTERVAL) -> int:
+        """:meth:`sync`, unless the last one is less than ``max_age`` seconds old.
+
+        Records the bot creates or deletes are added to or removed from the
+        mirror from the write itself, a sync is only needed for changes made
+        outside the bot.
+        """
+        if self._synced_at is not None and time.monotonic() - self._synced_at < max_age:
+            return 0
+        return await self.sync(client)
+
+list_mirror = ListMirror()
@@ -0,0 +1,278 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from pymongo import monitoring
+from telegram.ext import Application, ConversationHandler
+
+from service import tracing
+
+# the metrics endpoint is only served when this is set
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+# seconds, from a Mongo lookup on the same host to a slow upload
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _CounterChild():
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class _HistogramChild():
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # one slot per bucket plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class _Metric():
+    kind = ''
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._children: Dict[str, object] = {}
+
+    def labels(self, value: str = ''):
+        """The child for one label value, created on first use. Hot paths keep the child."""
+        child = self._children.get(value)
+        if child is None:
+            child = self._children[value] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label(self, value: str, extra: str = '') -> str:
+        pairs = [f'{self.label}="{_escape(value)}"'] if self.label else []
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for value, child in sorted(self._children.items()):
+            lines += self._render_child(value, child)
+        return lines
+
+    def _render_child(self, value: str, child) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _render_child(self, value: str, child: _CounterChild) -> List[str]:
+        return [f'{self.name}{self._label(value)} {_format_value(child.value)}']
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _render_child(self, value: str, child: _HistogramChild) -> List[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            bucket_label = self._label(value, f'le="{le}"')
+            lines.append(f'{self.name}_bucket{bucket_label} {total}')
+        lines.append(f'{self.name}_sum{self._label(value)} {_format_value(child.sum)}')
+        lines.append(f'{self.name}_count{self._label(value)} {total}')
+        return lines
+
+class Collected(_Metric):
+    """Values some other object already counts, read when the endpoint is scraped."""
+    def __init__(self, name: str, help: str, kind: str, collect: Callable[[], Union[float, Dict[str, float]]], label: Optional[str] = None):
+        super().__init__(name, help, label)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {'': values}
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{self.name}{self._label(value)} {_format_value(number)}' for value, number in sorted(values.items())]
+        return lines
+
+class Registry():
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label: Optional[str] = None) -> Counter:
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name: str, help: str, label: Optional[str] = None, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, label, buckets))
+
+    def collect(self, name: str, help: str, kind: str, collect: Callable, label: Optional[str] = None) -> Collected:
+        return self._add(Collected(name, help, kind, collect, label))
+
+    def render(self) -> str:
+        """Everything in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+handler_seconds = registry.histogram('bot_handler_seconds', 'Time spent in a Telegram handler.', 'handler')
+errors = registry.counter('bot_errors_total', 'Exceptions raised out of handlers and outbox jobs.', 'type')
+xrpc_seconds = registry.histogram('bot_xrpc_seconds', 'Time of a Bluesky XRPC call, including a session refresh when one was due.', 'method')
+xrpc_failures = registry.counter('bot_xrpc_failures_total', 'Bluesky XRPC calls that raised.', 'method')
+mongo_seconds = registry.histogram('bot_mongo_command_seconds', 'Time of a Mongo command as measured by the driver.', 'command')
+mongo_failures = registry.counter('bot_mongo_command_failures_total', 'Mongo commands that failed.', 'command')
+
+# region handlers
+
+def _handler_name(callback: Callable) -> str:
+    return f"{callback.__module__.rsplit('.', 1)[-1]}.{getattr(callback, '__name__', type(callback).__name__)}"
+
+def timed_callback(callback: Callable) -> Callable:
+    """Wrap a handler callback so its run time and exceptions are recorded.
+
+    Each call is also the root of a trace, see :mod:`service.tracing`.
+    """
+    name = _handler_name(callback)
+    child = handler_seconds.labels(name)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        user = getattr(update, 'effective_user', None)
+        trace, token = tracing.start_trace(name, user_id=user.id if user else None)
+        error = None
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            errors.labels(type(e).__name__).inc()
+            error = e
+            raise
+        finally:
+            child.observe(time.perf_counter() - start)
+            tracing.finish_trace(trace, token, error)
+    wrapper.timed = True
+    return wrapper
+
+def instrument_handlers(app: Application):
+    """Time every callback registered on ``app``, conversation states included."""
+    def instrument(handler):
+        if isinstance(handler, ConversationHandler):
+            for child in handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]:
+                instrument(child)
+        elif getattr(handler, 'callback', None) and not getattr(handler.callback, 'timed', False):
+            handler.callback = timed_callback(handler.callback)
+
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+# endregion
+
+# region mongo
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Feeds the driver's own command timings into the Mongo metrics."""
+    def __init__(self):
+        # pymongo calls run in to_thread workers, several at once
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self._lock:
+            mongo_seconds.labels(event.command_name).observe(event.duration_micros / 1e6)
+        # the to_thread worker runs with a copy of the caller's context, so the command lands in its trace
+        tracing.record(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        with self._lock:
+            mongo_seconds.labels(event.command_name).observe(event.duration_micros / 1e6)
+            mongo_failures.labels(event.command_name).inc()
+        tracing.record(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+# every client created from here on reports its command timings, import this before dal.db connects
+monitoring.register(MongoCommandListener())
+# endregion
+
+# region endpoint
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        while await reader.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+_server: Optional[asyncio.AbstractServer] = None
+
+async def start_server(host: str = METRICS_LISTEN, port: int = int(METRICS_PORT or 0)) -> int:
+    """Serve ``GET /metrics`` on ``host:port`` and return the port, 0 picks a free one."""
+    global _server
+    if not _server:
+        _server = await asyncio.start_server(_serve, host, port)
+        print(f"Metrics on http://{host}:{_server.sockets[0].getsockname()[1]}/metrics")
+    return _server.sockets[0].getsockname()[1]
+
+async def stop_server():
+    global _server
+    if _server:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+# endregion
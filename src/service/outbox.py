@@ -0,0 +1,238 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from atproto import models
+from atproto.exceptions import BadRequestError
+
+from dal import db
+from service.bluesky_service import AsyncBlueskyService
+from service.images import ImageRef, load_images
+from service.metrics import errors, registry
+from service import tracing
+from service.tid import make_tid
+
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+BASE_BACKOFF = float(os.getenv('OUTBOX_BASE_BACKOFF', '5'))
+MAX_BACKOFF = 30 * 60
+
+OPERATION_LABELS = {'post': 'Post', 'reply': 'Reply', 'repost': 'Repost', 'delete': 'Delete'}
+
+job_seconds = registry.histogram('bot_outbox_job_seconds', 'Time of one outbox attempt.', 'operation')
+
+def retry_delay(error: Exception, attempts: int) -> float:
+    """Seconds to wait before the next attempt, honouring rate-limit headers."""
+    response = getattr(error, 'response', None)
+    if response is not None and response.status_code == 429:
+        reset = response.headers.get('ratelimit-reset')
+        if reset and reset.isdigit():
+            return max(0, int(reset) - time.time()) + 1
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempts) * random.uniform(0.8, 1.2)
+
+def is_retryable(error: Exception) -> bool:
+    # bad input stays bad, everything else (5xx, 429, timeouts, network) is worth another try
+    return not isinstance(error, (ValueError, BadRequestError))
+
+class OutboxWorker():
+    """Drains ``db.Outbox`` in the background.
+
+    Handlers :meth:`enqueue` an operation and return; the worker runs it with the
+    shared Bluesky session, retrying transient failures with exponential backoff.
+    Every job carries a TID idempotency key which is used as the record key of
+    the post/repost it creates, so a retry after an ambiguous failure finds the
+    existing record instead of posting twice. The worker sleeps until the next
+    job is due (or a new one is enqueued), it never polls, which is also what
+    makes scheduled posts work: they are jobs with a ``due_at`` in the future.
+    """
+    def __init__(self):
+        self.bot = None
+        self.retries = 0
+        self.processed = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, operation: str, payload: Dict, chat_id: Optional[int] = None, due_at: Optional[datetime] = None) -> db.Outbox:
+        if operation not in OPERATION_LABELS:
+            raise ValueError(f'Unknown outbox operation "{operation}"')
+        job = db.Outbox(
+            idempotency_key=make_tid(),
+            operation=operation,
+            payload=payload,
+            chat_id=chat_id,
+            due_at=due_at or datetime.utcnow(),
+            scheduled=due_at is not None,
+        )
+        await asyncio.to_thread(job.save)
+        self._wakeup.set()
+        return job
+
+    async def scheduled(self, limit: int = 10) -> List[db.Outbox]:
+        """Next scheduled jobs that haven't run yet, soonest first."""
+        return await asyncio.to_thread(
+            lambda: list(db.Outbox.objects(status='pending', scheduled=True).order_by('due_at')[:limit]))
+
+    async def cancel(self, idempotency_key: str) -> bool:
+        """Cancel a job that hasn't started yet."""
+        updated = await asyncio.to_thread(
+            lambda: db.Outbox.objects(idempotency_key=idempotency_key, status='pending').update(set__status='cancelled'))
+        if updated:
+            self._wakeup.set()
+        return bool(updated)
+
+    def start(self, bot):
+        self.bot = bot
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stats(self) -> Dict:
+        def count():
+            counts = {status: db.Outbox.objects(status=status).count() for status in ('pending', 'running', 'failed', 'done')}
+            counts['retrying'] = db.Outbox.objects(status='pending', attempts__gt=0).count()
+            counts['scheduled'] = db.Outbox.objects(status='pending', scheduled=True).count()
+            counts['last_errors'] = [
+                f'{OPERATION_LABELS.get(job.operation, job.operation)} #{job.idempotency_key}: {job.last_error}'
+                for job in db.Outbox.objects(status='failed').order_by('-due_at').only('operation', 'idempotency_key', 'last_error')[:5]
+            ]
+            return counts
+        stats = await asyncio.to_thread(count)
+        stats['retries'] = self.retries
+        stats['processed'] = self.processed
+        return stats
+
+    async def run(self):
+        # jobs that were running when the process died are picked up again, as a
+        # retry: they may have created their records already, resume them
+        await asyncio.to_thread(lambda: db.Outbox.objects(status='running').update(set__status='pending', inc__attempts=1))
+        while True:
+            self._wakeup.clear()
+            job, wait = await asyncio.to_thread(self._next_job)
+            if job:
+                await self._process(job)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_job(self):
+        """Claim the next due job, or return how long to sleep until one is due."""
+        upcoming = db.Outbox.objects(status='pending').order_by('due_at').only('id', 'due_at').first()
+        if not upcoming:
+            return None, None
+        wait = (upcoming.due_at - datetime.utcnow()).total_seconds()
+        if wait > 0:
+            return None, wait
+        job = db.Outbox.objects(id=upcoming.id, status='pending').modify(set__status='running', new=True)
+        return job, 0
+
+    async def _process(self, job: db.Outbox):
+        label = OPERATION_LABELS.get(job.operation, job.operation)
+        start = time.perf_counter()
+        trace, token = tracing.start_trace(f'outbox.{job.operation}', job=job.idempotency_key, attempt=job.attempts + 1)
+        try:
+            try:
+                detail = await self._execute(job)
+            except BaseException as e:
+                tracing.finish_trace(trace, token, e)
+                raise
+            tracing.finish_trace(trace, token)
+        except asyncio.CancelledError:
+            # stopped halfway through, the next start resumes it like a retry
+            job.attempts += 1
+            job.status = 'pending'
+            await asyncio.to_thread(job.save)
+            raise
+        except Exception as e:
+            job_seconds.labels(job.operation).observe(time.perf_counter() - start)
+            errors.labels(type(e).__name__).inc()
+            job.attempts += 1
+            job.last_error = f'{type(e).__name__}: {e}'
+            if is_retryable(e) and job.attempts < MAX_ATTEMPTS:
+                delay = retry_delay(e, job.attempts)
+                job.status = 'pending'
+                job.due_at = datetime.utcnow() + timedelta(seconds=delay)
+                self.retries += 1
+                print(f'Outbox {label} #{job.idempotency_key} failed ({job.last_error}), retry {job.attempts} in {delay:.0f}s')
+                await asyncio.to_thread(job.save)
+            else:
+                job.status = 'failed'
+                await asyncio.to_thread(job.save)
+                await self._notify(job, f'{label} failed: {job.last_error}')
+            return
+        job_seconds.labels(job.operation).observe(time.perf_counter() - start)
+
+        job.status = 'done'
+        self.processed += 1
+        await asyncio.to_thread(job.save)
+        await self._notify(job, f'{label} done: {detail}' if detail else f'{label} done')
+
+    async def _execute(self, job: db.Outbox) -> Optional[str]:
+        """Run the job, returning what the done notification should add, if anything."""
+        service = await AsyncBlueskyService.create()
+        payload = job.payload
+        if job.operation == 'post':
+            images = [ImageRef.from_dict(image) for image in payload.get('images') or []]
+            # images only go on the first post, no need to download them if it's already there
+            if images and not (job.attempts and await service.get_own_record(models.ids.AppBskyFeedPost, job.idempotency_key)):
+                images = await load_images(images, self.bot)
+            # a retry picks a long thread up where the last attempt stopped
+            await service.post(payload.get('text'), images, payload.get('qrt_link'), payload.get('respond_to'),
+                               rkey=job.idempotency_key, resume=job.attempts > 0)
+        elif job.operation == 'reply':
+            await service.reply_to_post(payload['post_id'], payload['text'], rkey=job.idempotency_key, resume=job.attempts > 0)
+        elif job.operation == 'repost':
+            url = payload['url']
+            if job.attempts and await self._already_created(service, models.ids.AppBskyFeedRepost, job, f'retweet from this: {url}'):
+                return
+            await service.repost(url, rkey=job.idempotency_key)
+        elif job.operation == 'delete' and 'post_ids' in payload:
+            return await self._delete_posts(service, job)
+        elif job.operation == 'delete':
+            post_id = payload['post_id']
+            if job.attempts and not await asyncio.to_thread(db.Posts.objects(id=post_id).first):
+                # a previous attempt got all the way through
+                return
+            await service.delete_post(post_id)
+
+    async def _delete_posts(self, service: AsyncBlueskyService, job: db.Outbox) -> str:
+        post_ids = job.payload['post_ids']
+        # posts no longer tracked are already deleted, by a previous attempt or a /delete_ of their own
+        remaining = await asyncio.to_thread(
+            lambda: [doc['_id'] for doc in db.Posts.objects(id__in=post_ids).only('id').as_pymongo()])
+        results = await service.delete_posts(remaining) if remaining else {}
+        failed = [f'#{post_id}: {error}' for post_id, error in results.items() if error is not None]
+        if failed:
+            # the next attempt only sends the ones still there
+            raise RuntimeError(f'{len(failed)} of {len(post_ids)} posts not deleted ({"; ".join(failed)})')
+        return f'{len(post_ids)} posts'
+
+    async def _already_created(self, service: AsyncBlueskyService, collection: str, job: db.Outbox, text: str) -> bool:
+        record = await service.get_own_record(collection, job.idempotency_key)
+        if not record:
+            return False
+        await service.save_post(text, record.cid, record.uri)
+        return True
+
+    async def _notify(self, job: db.Outbox, text: str):
+        if not job.chat_id or not self.bot:
+            return
+        try:
+            await self.bot.send_message(job.chat_id, text)
+        except Exception as e:
+            print(f'Could not report outbox result to chat {job.chat_id}: {e}')
+
+outbox = OutboxWorker()
+registry.collect('bot_outbox_jobs_total', 'Outbox jobs done and attempts retried since start.', 'counter',
+                 lambda: {'done': outbox.processed, 'retried': outbox.retries}, 'result')
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import Application, BasePersistence, PersistenceInput
+
+from dal import db
+from service.images import ImageRef
+from service.metrics import registry
+
+# how often the Application hands changed drafts over, at most this much is lost on a crash
+DRAFT_FLUSH_INTERVAL = float(os.getenv('DRAFT_FLUSH_INTERVAL', '10'))
+# how often idle users are dropped from memory
+DRAFT_EXPIRY_CHECK = 3600
+
+def _encode(value: Any) -> Any:
+    """user_data as plain BSON: images become their reference, tuples lists."""
+    if isinstance(value, ImageRef):
+        # the file_id is enough to download the photo again when the draft is sent
+        return {'_image': {key: item for key, item in value.to_dict().items() if item is not None}}
+    if isinstance(value, dict):
+        return {str(key): _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_encode(item) for item in value]
+    return value
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if set(value) == {'_image'}:
+            return ImageRef.from_dict(value['_image'])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+def _digest(encoded: Dict) -> int:
+    return hash(json.dumps(encoded, sort_keys=True, default=str))
+
+class MongoPersistence(BasePersistence):
+    """Keeps ``user_data`` (drafts) and persistent conversation states in Mongo.
+
+    Only what a deploy would otherwise lose is stored: user data and
+    conversation states, not chat or bot data. Images are stored as their
+    Telegram ``file_id``, never as bytes. The Application hands over the users
+    that had an update every ``DRAFT_FLUSH_INTERVAL`` seconds; those whose data
+    didn't actually change (compared by digest, not by keeping a second copy)
+    are skipped, and the rest of the run goes to Mongo in one bulk write per
+    collection.
+
+    Stale drafts expire twice: Mongo's TTL index on ``updated_at`` removes the
+    documents after ``DRAFT_TTL``, and :meth:`expire` drops users idle that long
+    from the Application's memory.
+    """
+    def __init__(self, update_interval: float = DRAFT_FLUSH_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.writes = 0
+        self.skipped = 0
+        self._digests: Dict[int, int] = {}
+        self._last_seen: Dict[int, float] = {}
+        self._pending_users: Dict[int, Tuple[Optional[Dict], Optional[int]]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Optional[int]] = {}
+        self._lock = asyncio.Lock()
+        self._write_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _fresh_after(self) -> datetime:
+        # the TTL monitor only runs once a minute, don't load what it's about to delete
+        return datetime.utcnow() - timedelta(seconds=db.DRAFT_TTL)
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        docs = await asyncio.to_thread(
+            lambda: list(db.UserData.objects(updated_at__gt=self._fresh_after()).as_pymongo()))
+        user_data = {}
+        for doc in docs:
+            user_data[doc['user_id']] = _decode(doc.get('data') or {})
+            self._digests[doc['user_id']] = _digest(doc.get('data') or {})
+            self._last_seen[doc['user_id']] = doc['updated_at'].replace(tzinfo=timezone.utc).timestamp()
+        print(f'Loaded {len(user_data)} drafts')
+        return user_data
+
+    async def get_conversations(self, name: str) -> Dict:
+        docs = await asyncio.to_thread(
+            lambda: list(db.Conversations.objects(name=name, updated_at__gt=self._fresh_after()).as_pymongo()))
+        return {tuple(json.loads(doc['key'])): doc['state'] for doc in docs}
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        # called for every user that had an update since the last run, changed or not
+        self._last_seen[user_id] = time.time()
+        encoded = _encode(data)
+        digest = _digest(encoded)
+        if self._digests.get(user_id) == digest:
+            self.skipped += 1
+            return
+        # an empty user_data (sent or cancelled draft) is a delete, not an empty document
+        self._pending_users[user_id] = (encoded or None, digest)
+        self._schedule_write()
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        # None means the conversation ended
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._last_seen.pop(user_id, None)
+        self._pending_users[user_id] = (None, None)
+        self._schedule_write()
+
+    async def flush(self) -> None:
+        await self._write()
+        if self._write_task:
+            # scheduled by the last run, it finds nothing left to write
+            await self._write_task
+
+    def _schedule_write(self):
+        # update_persistence gathers the update_* calls, and none of them awaits
+        # anything: a task created by the first one runs after all of them have
+        # queued their change, and writes the whole run in one go
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_queued())
+
+    async def _write_queued(self):
+        # changes queued from here on get a write of their own
+        self._write_task = None
+        try:
+            await self._write()
+        except Exception as e:
+            # still queued, the next run or the flush on shutdown writes them
+            print(f'Could not save drafts: {type(e).__name__}: {e}')
+
+    async def _write(self):
+        async with self._lock:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            if not users and not conversations:
+                return
+            try:
+                await asyncio.to_thread(self._write_batch, users, conversations)
+            except Exception:
+                # back in the queue for the next write, unless something newer is already there
+                for user_id, pending in users.items():
+                    self._pending_users.setdefault(user_id, pending)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                raise
+            for user_id, (_, digest) in users.items():
+                if digest is None:
+                    self._digests.pop(user_id, None)
+                else:
+                    self._digests[user_id] = digest
+            self.writes += len(users) + len(conversations)
+
+    def _write_batch(self, users: Dict[int, Tuple[Optional[Dict], Optional[int]]], conversations: Dict[Tuple[str, str], Optional[int]]):
+        now = datetime.utcnow()
+        user_ops = [
+            UpdateOne({'user_id': user_id}, {'$set': {'data': data, 'updated_at': now}}, upsert=True) if data
+            else DeleteOne({'user_id': user_id})
+            for user_id, (data, _) in users.items()
+        ]
+        conversation_ops = [
+            UpdateOne({'name': name, 'key': key}, {'$set': {'state': state, 'updated_at': now}}, upsert=True) if state is not None
+            else DeleteOne({'name': name, 'key': key})
+            for (name, key), state in conversations.items()
+        ]
+        if user_ops:
+            db.UserData._get_collection().bulk_write(user_ops, ordered=False)
+        if conversation_ops:
+            db.Conversations._get_collection().bulk_write(conversation_ops, ordered=False)
+
+    def expire(self, app: Application) -> int:
+        """Drop the data of users idle for longer than ``DRAFT_TTL`` from ``app``."""
+        cutoff = time.time() - db.DRAFT_TTL
+        stale = [user_id for user_id, seen in self._last_seen.items() if seen < cutoff]
+        for user_id in stale:
+            # the next update_persistence run calls drop_user_data, which deletes the document
+            app.drop_user_data(user_id)
+            del self._last_seen[user_id]
+        if stale:
+            print(f'Expired the drafts of {len(stale)} idle users')
+        return len(stale)
+
+    async def _expire_loop(self, app: Application):
+        while True:
+            await asyncio.sleep(DRAFT_EXPIRY_CHECK)
+            self.expire(app)
+
+    def start(self, app: Application):
+        if not self._task:
+            self._task = asyncio.create_task(self._expire_loop(app))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # region not stored
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+    # endregion
+
+persistence = MongoPersistence()
+registry.collect('bot_draft_writes_total', 'Drafts and conversation states written, and unchanged drafts skipped.', 'counter',
+                 lambda: {'written': persistence.writes, 'skipped': persistence.skipped}, 'result')
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+from typing import Any, Mapping, Optional, Tuple
+
+from service.metrics import registry
+from service.tracing import span
+
+# Bluesky counts record writes in points per account: 5000 an hour, 35000 a day
+XRPC_WRITE_POINTS_PER_HOUR = float(os.getenv('XRPC_WRITE_POINTS_PER_HOUR', '5000'))
+# the whole hour's budget can go at once, a full applyWrites batch alone is 600 points
+XRPC_WRITE_BURST = float(os.getenv('XRPC_WRITE_BURST', '5000'))
+# everything else shares the per-IP limit of 3000 requests in 5 minutes
+XRPC_READS_PER_SECOND = float(os.getenv('XRPC_READS_PER_SECOND', '10'))
+XRPC_READ_BURST = float(os.getenv('XRPC_READ_BURST', '50'))
+# a 429 whose reset is further away than this is raised, the outbox retries it later
+XRPC_MAX_RATE_LIMIT_WAIT = float(os.getenv('XRPC_MAX_RATE_LIMIT_WAIT', '30'))
+
+WRITE_POINTS = {
+    'com.atproto.repo.createRecord': 3,
+    'com.atproto.repo.putRecord': 2,
+    'com.atproto.repo.deleteRecord': 1,
+}
+_APPLY_WRITES_POINTS = {'create': 3, 'update': 2, 'delete': 1}
+
+def _header_number(headers: Mapping[str, Any], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class TokenBucket():
+    """Token bucket that also follows the server's ``ratelimit-*`` headers.
+
+    Tokens refill at ``rate`` per second up to ``capacity``. On top of that the
+    last ``ratelimit-remaining`` / ``ratelimit-reset`` the server sent is kept,
+    and no more than that is spent before the reset, so a limit that is
+    stricter than the configured rate (or shared with another client of the
+    account) is still respected. Waiters are served in order.
+    """
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.waits = 0
+        self.waited = 0.0
+        self.throttled = 0
+        # cost of the calls sent and not answered yet
+        self.in_flight = 0
+        self._updated = time.monotonic()
+        # what the server said is left until its window resets (epoch seconds)
+        self._remaining: Optional[float] = None
+        self._reset_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _delay(self, cost: float) -> float:
+        """Take ``cost`` and return 0, or return how long to wait for it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._remaining is not None:
+            until_reset = self._reset_at - time.time()
+            if until_reset <= 0:
+                self._remaining = None
+            elif self._remaining < cost:
+                return until_reset
+        # a call bigger than the bucket goes once it's full and leaves it in debt
+        need = min(cost, self.capacity)
+        if self.tokens < need:
+            return (need - self.tokens) / self.rate
+        self.tokens -= cost
+        if self._remaining is not None:
+            self._remaining -= cost
+        return 0
+
+    async def acquire(self, cost: float = 1):
+        # straight through, unless others are already waiting their turn
+        if not self._lock.locked() and not self._delay(cost):
+            return
+        self.waits += 1
+        start = time.monotonic()
+        with span(f'rate_limit.{self.name}'):
+            async with self._lock:
+                delay = self._delay(cost)
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self._delay(cost)
+        self.waited += time.monotonic() - start
+
+    def release(self, cost: float):
+        """The call that took ``cost`` got its answer, whatever it was."""
+        self.in_flight -= cost
+
+    def update(self, headers: Mapping[str, Any]):
+        """Follow the ``ratelimit-*`` headers of a response, after :meth:`release`."""
+        remaining = _header_number(headers, 'ratelimit-remaining')
+        reset = _header_number(headers, 'ratelimit-reset')
+        if remaining is None or reset is None or reset < self._reset_at:
+            # a late response from a window that has already been replaced
+            return
+        # the count doesn't include the calls still on their way, they'll use some of it
+        remaining -= self.in_flight
+        if reset == self._reset_at and self._remaining is not None:
+            # responses of the same window arrive out of order, the lowest count is the latest
+            remaining = min(remaining, self._remaining)
+        self._remaining, self._reset_at = remaining, reset
+
+    def limited(self, headers: Mapping[str, Any]) -> float:
+        """Record a 429 and return the seconds until the server accepts requests again."""
+        self.throttled += 1
+        reset = _header_number(headers, 'ratelimit-reset')
+        retry_after = _header_number(headers, 'retry-after')
+        now = time.time()
+        self._reset_at = reset if reset is not None else now + (retry_after if retry_after is not None else 1)
+        # the headers count whole seconds, don't knock again before the next one
+        self._reset_at = max(self._reset_at, now + 1)
+        self._remaining = 0
+        self.tokens = 0
+        return max(0.0, self._reset_at - now)
+
+def write_points(method: str, data: Any = None) -> int:
+    """Points a call costs against the write budget, 0 when it isn't a record write."""
+    if method != 'com.atproto.repo.applyWrites':
+        return WRITE_POINTS.get(method, 0)
+    writes = data.get('writes', []) if isinstance(data, dict) else getattr(data, 'writes', None) or []
+    points = 0
+    for write in writes:
+        kind = write.get('$type', '') if isinstance(write, dict) else getattr(write, 'py_type', '')
+        points += _APPLY_WRITES_POINTS.get(kind.rsplit('#', 1)[-1], 3)
+    return points
+
+class RateLimiter():
+    """The read and write budgets every outbound XRPC call draws from.
+
+    Record writes (createRecord, putRecord, deleteRecord, applyWrites) cost
+    Bluesky's write points; every other call, uploads and session calls
+    included, costs one read.
+    """
+    def __init__(self):
+        self.reads = TokenBucket('reads', XRPC_READS_PER_SECOND, XRPC_READ_BURST)
+        self.writes = TokenBucket('writes', XRPC_WRITE_POINTS_PER_HOUR / 3600, XRPC_WRITE_BURST)
+        self.enabled = True
+
+    def budget(self, method: str, data: Any = None) -> Tuple[TokenBucket, int]:
+        points = write_points(method, data)
+        return (self.writes, points) if points else (self.reads, 1)
+
+    async def acquire(self, bucket: TokenBucket, cost: int):
+        if self.enabled:
+            await bucket.acquire(cost)
+        # counted even when disabled, release() takes it off again
+        bucket.in_flight += cost
+
+rate_limiter = RateLimiter()
+registry.collect('bot_xrpc_rate_limit_waits_total', 'XRPC calls held back by the client-side rate limiter.', 'counter',
+                 lambda: {bucket.name: bucket.waits for bucket in (rate_limiter.reads, rate_limiter.writes)}, 'budget')
+registry.collect('bot_xrpc_rate_limit_wait_seconds_total', 'Time XRPC calls spent waiting for the rate limiter.', 'counter',
+                 lambda: {bucket.name: bucket.waited for bucket in (rate_limiter.reads, rate_limiter.writes)}, 'budget')
+registry.collect('bot_xrpc_throttled_total', 'XRPC calls the server answered with a 429.', 'counter',
+                 lambda: {bucket.name: bucket.throttled for bucket in (rate_limiter.reads, rate_limiter.writes)}, 'budget')
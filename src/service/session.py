@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import time
+
+from atproto import AsyncClient, Session, SessionEvent
+from atproto_client.client.base import InvokeType
+from atproto.exceptions import AtProtocolError, RequestErrorBase
+
+from dal import db
+from service.http import BSKY_SERVICE_URL
+from service.metrics import registry, xrpc_failures, xrpc_seconds
+from service.rate_limit import XRPC_MAX_RATE_LIMIT_WAIT, rate_limiter
+from service.tracing import span
+
+SESSION_CONFIG_KEY = 'BlueskySession'
+# what the PDS answers when the tokens of a session are no good anymore
+_SESSION_ERRORS = ('ExpiredToken', 'InvalidToken', 'AuthenticationRequired')
+
+def _is_session_error(e: RequestErrorBase) -> bool:
+    if e.response is None:
+        return False
+    if e.response.status_code == 401:
+        return True
+    return getattr(e.response.content, 'error', None) in _SESSION_ERRORS
+
+class InstrumentedClient(AsyncClient):
+    """AsyncClient that times, rate limits and coalesces every XRPC call.
+
+    Every request the client makes (login, uploadBlob, createRecord, getRecord,
+    putRecord, deleteRecord, refreshSession...) goes through ``_invoke``. Each
+    call first draws from :data:`service.rate_limit.rate_limiter`, and a 429
+    whose window resets soon is waited out and sent again. Identical queries
+    that are in flight at the same time share one request.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.coalesced = 0
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        # called when the PDS rejects the session, e.g. after the refresh token expired
+        self.on_session_error: Optional[Callable[[], Awaitable]] = None
+
+    async def _invoke(self, invoke_type: InvokeType, **kwargs):
+        if invoke_type is not InvokeType.QUERY:
+            return await self._send(invoke_type, kwargs)
+        params = kwargs.get('params')
+        params = params.model_dump(exclude_none=True, by_alias=True) if hasattr(params, 'model_dump') else params
+        key = (kwargs['url'], json.dumps(params, sort_keys=True, default=str))
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._send(invoke_type, kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # one caller giving up doesn't cancel the request the others wait for
+        return await asyncio.shield(task)
+
+    async def _send(self, invoke_type: InvokeType, kwargs: Dict):
+        method = kwargs['url'].rsplit('/', 1)[-1]
+        bucket, cost = rate_limiter.budget(method, kwargs.get('data'))
+        while True:
+            await rate_limiter.acquire(bucket, cost)
+            start = time.perf_counter()
+            try:
+                with span(f'xrpc.{method}'):
+                    response = await super()._invoke(invoke_type, **kwargs)
+            except RequestErrorBase as e:
+                xrpc_failures.labels(method).inc()
+                # a 429 means the call was not executed, sending it again is safe
+                if e.response is not None and e.response.status_code == 429:
+                    wait = bucket.limited(e.response.headers)
+                    if rate_limiter.enabled and wait <= XRPC_MAX_RATE_LIMIT_WAIT:
+                        print(f'{method} rate limited, sending it again in {wait:.0f}s')
+                        continue
+                if self.on_session_error and _is_session_error(e):
+                    await self.on_session_error()
+                raise
+            except Exception:
+                xrpc_failures.labels(method).inc()
+                raise
+            finally:
+                bucket.release(cost)
+                xrpc_seconds.labels(method).observe(time.perf_counter() - start)
+            bucket.update(response.headers)
+            return response
+
+class SessionManager():
+    """Process-wide owner of the authenticated atproto client.
+
+    The first caller logs in (reusing the session string stored in ``db.Config``
+    when there is one), every later caller gets the same client. Token refresh is
+    done by the atproto client itself a few minutes before the access JWT expires,
+    the manager only persists the new tokens and counts what happened.
+    """
+    def __init__(self):
+        self._client: Optional[AsyncClient] = None
+        self._lock = asyncio.Lock()
+        self.logins = 0
+        self.refreshes = 0
+        self.imports = 0
+
+    async def get_client(self) -> AsyncClient:
+        if self._client:
+            return self._client
+        async with self._lock:
+            if not self._client:
+                self._client = await self._create_client()
+        return self._client
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'logins': self.logins,
+            'refreshes': self.refreshes,
+            'imports': self.imports,
+        }
+
+    async def reset(self, client: Optional[AsyncClient] = None):
+        """Drop the cached client and the stored session, next call logs in again.
+
+        With ``client``, only when that is still the cached one: several calls
+        failing on the same dead session reset it once.
+        """
+        async with self._lock:
+            if client is not None and client is not self._client:
+                return
+            self._client = None
+            await asyncio.to_thread(db.Config.objects(Key = SESSION_CONFIG_KEY).delete)
+
+    async def _create_client(self) -> AsyncClient:
+        client = InstrumentedClient(BSKY_SERVICE_URL)
+        client.on_session_change(self._on_session_change)
+
+        session_string = await asyncio.to_thread(self._load_session)
+        logged_in = False
+        if session_string:
+            try:
+                await client.login(session_string=session_string)
+                logged_in = True
+            except AtProtocolError as e:
+                print(f'Stored Bluesky session could not be reused, logging in again: {e}')
+
+        if not logged_in:
+            await client.login(os.environ['BSKY_USERNAME'], os.environ['BSKY_PASSWORD'])
+        # set after the login, which runs under the lock reset() takes
+        client.on_session_error = lambda: self._on_session_error(client)
+        return client
+
+    async def _on_session_error(self, client: AsyncClient):
+        if client is self._client:
+            print('Bluesky rejected the session, logging in again on the next call')
+        await self.reset(client)
+
+    async def _on_session_change(self, event: SessionEvent, session: Session):
+        if event == SessionEvent.CREATE:
+            self.logins += 1
+        elif event == SessionEvent.REFRESH:
+            self.refreshes += 1
+        elif event == SessionEvent.IMPORT:
+            self.imports += 1
+            return
+        await asyncio.to_thread(self._save_session, session.export())
+
+    def _load_session(self) -> Optional[str]:
+        config = db.Config.objects(Key = SESSION_CONFIG_KEY).first()
+        return config.Value if config else None
+
+    def _save_session(self, session_string: str):
+        config = db.Config.objects(Key = SESSION_CONFIG_KEY).first()
+        newConfig = db.Config() if not config else config
+        newConfig.Key = SESSION_CONFIG_KEY
+        newConfig.Value = session_string
+        newConfig.save()
+
+session_manager = SessionManager()
+registry.collect('bot_bluesky_sessions_total', 'Bluesky logins, token refreshes and imported sessions.', 'counter',
+                 session_manager.stats, 'event')
+registry.collect('bot_xrpc_coalesced_total', 'XRPC queries answered by a request already in flight.', 'counter',
+                 lambda: session_manager._client.coalesced if session_manager._client else 0)
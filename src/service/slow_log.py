@@ -0,0 +1,40 @@
+import asyncio
+from typing import List, Set
+
+from dal import db
+from service import tracing
+from service.tracing import Trace
+
+class SlowLog():
+    """Keeps the traces of slow updates in the capped ``db.SlowUpdates`` collection.
+
+    Registered as a :data:`tracing.slow_sinks` callback, so every trace over
+    ``SLOW_UPDATE_SECONDS`` is saved with its stage breakdown. The save runs in
+    the background, the slow update doesn't also wait for the write.
+    """
+    def __init__(self):
+        self.recorded = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    def record(self, trace: Trace):
+        doc = db.SlowUpdates(name=trace.name, started_at=trace.started_at, duration_ms=round(trace.duration * 1000, 1),
+                             error=trace.error, info={key: value for key, value in trace.info.items() if value is not None},
+                             spans=trace.breakdown(), dropped=trace.dropped)
+        task = asyncio.get_running_loop().create_task(self._save(doc))
+        # the loop only keeps a weak reference to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _save(self, doc: db.SlowUpdates):
+        try:
+            await asyncio.to_thread(doc.save)
+            self.recorded += 1
+        except Exception as e:
+            print(f'Could not save the slow update {doc.name}: {type(e).__name__}: {e}')
+
+    async def latest(self, limit: int = 5) -> List[db.SlowUpdates]:
+        # at most a couple hundred documents, sorting them needs no index
+        return await asyncio.to_thread(lambda: list(db.SlowUpdates.objects.order_by('-started_at').limit(limit)))
+
+slow_log = SlowLog()
+tracing.slow_sinks.append(slow_log.record)
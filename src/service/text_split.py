@@ -0,0 +1,142 @@
+import bisect
+import re
+import unicodedata
+from typing import List, Sequence, Tuple
+
+from atproto import models
+
+# app.bsky.feed.post text limit
+POST_GRAPHEME_LIMIT = 300
+
+_ZWJ = 0x200D
+# end of a sentence (with closing quotes/brackets) followed by whitespace, or a line break
+_sentence_end = re.compile(r'[.!?…]["\'”’)\]]*(?=\s)|\n')
+_whitespace = re.compile(r'\s')
+
+def _extends_cluster(codepoint: int, char: str) -> bool:
+    return (
+        unicodedata.category(char) in ('Mn', 'Me', 'Mc')
+        or codepoint == _ZWJ
+        # variation selectors, emoji skin tones and tag characters (flag sub-regions)
+        or 0xFE00 <= codepoint <= 0xFE0F
+        or 0x1F3FB <= codepoint <= 0x1F3FF
+        or 0xE0020 <= codepoint <= 0xE007F
+    )
+
+def grapheme_starts(text: str) -> Sequence[int]:
+    """Index of the first character of every grapheme cluster in ``text``.
+
+    A close approximation of the Unicode extended grapheme cluster rules using
+    only ``unicodedata``: combining marks, ZWJ sequences, variation selectors,
+    skin tone modifiers, tag sequences, regional indicator pairs and CRLF are
+    kept together. ASCII text takes a fast path.
+    """
+    if text.isascii() and '\r\n' not in text:
+        return range(len(text))
+
+    starts = []
+    previous = None
+    regional_run = 0
+    for i, char in enumerate(text):
+        codepoint = ord(char)
+        extend = previous is not None and (
+            previous == _ZWJ
+            or (codepoint == 0x0A and previous == 0x0D)
+            or _extends_cluster(codepoint, char)
+        )
+        if 0x1F1E6 <= codepoint <= 0x1F1FF:
+            # regional indicators pair up into flags
+            extend = extend or regional_run % 2 == 1
+            regional_run += 1
+        else:
+            regional_run = 0
+        if not extend:
+            starts.append(i)
+        previous = codepoint
+    return starts
+
+def grapheme_len(text: str) -> int:
+    return len(grapheme_starts(text))
+
+def _break_at(window: str, fits_whole: bool) -> int:
+    """Where to end a chunk inside ``window``, as a character count."""
+    if fits_whole:
+        return len(window)
+    # prefer a sentence end, unless it would leave a tiny chunk behind
+    sentence = None
+    for match in _sentence_end.finditer(window):
+        sentence = match.end()
+    if sentence and sentence >= len(window) // 3:
+        return sentence
+    for i in range(len(window) - 1, 0, -1):
+        if _whitespace.match(window, i):
+            return i
+    # a single word longer than the limit, cut it
+    return len(window)
+
+def split_text(text: str, limit: int = POST_GRAPHEME_LIMIT) -> List[Tuple[int, int]]:
+    """Split ``text`` into chunks of at most ``limit`` graphemes.
+
+    Breaks at the last sentence end in a chunk, else at the last whitespace,
+    and only cuts inside a word (at a grapheme boundary) when a single word is
+    longer than the limit. Whitespace around chunks is dropped.
+
+    Returns:
+        List[Tuple[int, int]]: (start, end) character offsets into ``text``.
+    """
+    starts = grapheme_starts(text)
+    total = len(starts)
+    spans = []
+    g = 0
+    while g < total:
+        while g < total and text[starts[g]].isspace():
+            g += 1
+        if g == total:
+            break
+        start = starts[g]
+        if total - g <= limit:
+            end = len(text)
+        else:
+            hard_end = starts[g + limit]
+            end = start + _break_at(text[start:hard_end], text[hard_end].isspace())
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        spans.append((start, end))
+        g = bisect.bisect_left(starts, end)
+    return spans
+
+def split_thread(text: str, facets: List[models.AppBskyRichtextFacet.Main], limit: int = POST_GRAPHEME_LIMIT) -> List[Tuple[str, List[models.AppBskyRichtextFacet.Main]]]:
+    """Split a post into thread chunks and move the facets to the chunk they fall in.
+
+    ``facets`` are computed once on the whole text; their byte offsets are
+    rebased onto each chunk. A facet that would straddle two chunks is dropped
+    (breaks happen at whitespace, so only an over-long URL can do that).
+    Text that is empty or only whitespace gives one empty post, for the images.
+
+    Returns:
+        List[Tuple[str, List[Facet]]]: Text and facets of every post, in order.
+    """
+    ordered = sorted(facets, key=lambda facet: facet.index.byte_start)
+    chunks = []
+    byte_pos = 0
+    char_pos = 0
+    next_facet = 0
+    for start, end in split_text(text, limit):
+        byte_pos += len(text[char_pos:start].encode('UTF-8'))
+        chunk = text[start:end]
+        chunk_start = byte_pos
+        byte_pos += len(chunk.encode('UTF-8'))
+        char_pos = end
+
+        chunk_facets = []
+        while next_facet < len(ordered) and ordered[next_facet].index.byte_start < byte_pos:
+            facet = ordered[next_facet]
+            next_facet += 1
+            if facet.index.byte_start < chunk_start or facet.index.byte_end > byte_pos:
+                continue
+            chunk_facets.append(facet.model_copy(update={'index': models.AppBskyRichtextFacet.ByteSlice(
+                byte_start=facet.index.byte_start - chunk_start,
+                byte_end=facet.index.byte_end - chunk_start,
+            )}))
+        chunks.append((chunk, chunk_facets))
+    return chunks or [('', [])]
@@ -0,0 +1,34 @@
+import random
+import time
+
+_TID_ALPHABET = '234567abcdefghijklmnopqrstuvwxyz'
+_tid_clock_id = random.randrange(1024)
+_last_tid_micros = 0
+
+def encode_tid(value: int) -> str:
+    return ''.join(_TID_ALPHABET[(value >> (60 - 5 * i)) & 31] for i in range(13))
+
+def decode_tid(tid: str) -> int:
+    value = 0
+    for char in tid:
+        value = (value << 5) | _TID_ALPHABET.index(char)
+    return value
+
+def make_tid() -> str:
+    """Generate an atproto TID (timestamp record key), unique within this process."""
+    global _last_tid_micros
+    micros = max(time.time_ns() // 1000, _last_tid_micros + 1)
+    _last_tid_micros = micros
+    return encode_tid((micros << 10) | _tid_clock_id)
+
+def offset_tid(tid: str, offset: int) -> str:
+    """``tid`` with its clock id moved on by ``offset``.
+
+    Gives every post of a thread its own record key derived from the one
+    idempotency key of the job, so a retry recreates the same keys. The
+    timestamp stays the same, and :func:`make_tid` never hands out the same
+    microsecond twice, so the derived keys can't collide with other jobs.
+    """
+    value = decode_tid(tid)
+    clock_id = ((value & 1023) + offset) % 1024
+    return encode_tid((value >> 10 << 10) | clock_id)
@@ -0,0 +1,163 @@
+import contextlib
+import functools
+import os
+import time
+from collections import defaultdict
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram.request import HTTPXRequest
+
+# updates and outbox jobs that take longer than this end up in the slow log
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS', '3'))
+# spans kept per trace, a bulk list add can make thousands
+MAX_SPANS = 300
+
+class Span():
+    """One timed stage. Children are the stages that ran inside it."""
+    __slots__ = ('name', 'start', 'duration', 'children', 'trace')
+
+    def __init__(self, name: str, trace: Optional['Trace'], start: float):
+        self.name = name
+        self.start = start
+        self.duration: Optional[float] = None
+        self.children: List['Span'] = []
+        self.trace = trace or self
+
+    def child(self, name: str, start: Optional[float] = None) -> Optional['Span']:
+        trace = self.trace
+        if trace.spans >= MAX_SPANS:
+            trace.dropped += 1
+            return None
+        trace.spans += 1
+        span = Span(name, trace, time.perf_counter() if start is None else start)
+        self.children.append(span)
+        return span
+
+class Trace(Span):
+    """The root span of one Telegram update or outbox job."""
+    __slots__ = ('wall_start', 'spans', 'dropped', 'info', 'error')
+
+    def __init__(self, name: str, info: Dict):
+        super().__init__(name, None, time.perf_counter())
+        self.wall_start = time.time()
+        self.spans = 1
+        self.dropped = 0
+        self.info = info
+        self.error: Optional[str] = None
+
+    @property
+    def started_at(self) -> datetime:
+        # only slow traces are ever stored, the datetime is made for them alone
+        return datetime.utcfromtimestamp(self.wall_start)
+
+    def breakdown(self) -> List[Dict]:
+        """Every span depth first, with offset and duration in ms from the start of the trace."""
+        rows = []
+
+        def walk(span: Span, depth: int):
+            # spans reported after the fact (Mongo commands) are appended out of order
+            for child in sorted(span.children, key=lambda child: child.start):
+                rows.append({
+                    'name': child.name,
+                    'depth': depth,
+                    'offset_ms': round((child.start - self.start) * 1000, 1),
+                    # still running when the trace ended: a task it started and didn't wait for
+                    'ms': round(child.duration * 1000, 1) if child.duration is not None else None,
+                })
+                walk(child, depth + 1)
+        walk(self, 0)
+        return rows
+
+    def totals(self) -> List[Tuple[str, int, float]]:
+        """(name, count, total seconds) of every stage, slowest first."""
+        totals: Dict[str, List] = defaultdict(lambda: [0, 0.0])
+
+        def walk(span: Span):
+            for child in span.children:
+                totals[child.name][0] += 1
+                totals[child.name][1] += child.duration or 0.0
+                walk(child)
+        walk(self)
+        return sorted(((name, count, seconds) for name, (count, seconds) in totals.items()), key=lambda row: -row[2])
+
+_current: ContextVar[Optional[Span]] = ContextVar('tracing_span', default=None)
+# outside a trace span() hands this out, nothing is allocated or timed
+_NOOP = contextlib.nullcontext()
+
+# called with every slow trace, see service.slow_log
+slow_sinks: List[Callable[[Trace], None]] = []
+
+class _Scope():
+    __slots__ = ('name', 'parent', 'span', 'token')
+
+    def __init__(self, name: str, parent: Span):
+        self.name = name
+        self.parent = parent
+        self.span: Optional[Span] = None
+
+    def __enter__(self) -> Optional[Span]:
+        self.span = self.parent.child(self.name)
+        if self.span:
+            self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *_):
+        if self.span:
+            self.span.duration = time.perf_counter() - self.span.start
+            _current.reset(self.token)
+        return False
+
+def span(name: str):
+    """Time the ``with`` block as a child of the current span.
+
+    Tasks started inside the block (``gather``) inherit it as their parent.
+    Outside of a trace this does nothing.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return _Scope(name, parent)
+
+def traced(name: str) -> Callable:
+    """Decorator for coroutine functions, runs each call in a :func:`span`."""
+    def decorate(function: Callable) -> Callable:
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def record(name: str, duration: float):
+    """Add a stage that was timed by someone else and just finished."""
+    parent = _current.get()
+    if parent is not None:
+        child = parent.child(name, time.perf_counter() - duration)
+        if child:
+            child.duration = duration
+
+def start_trace(name: str, **info) -> Tuple[Trace, Token]:
+    trace = Trace(name, info)
+    return trace, _current.set(trace)
+
+def finish_trace(trace: Trace, token: Token, error: Optional[BaseException] = None):
+    trace.duration = time.perf_counter() - trace.start
+    _current.reset(token)
+    if error is not None:
+        trace.error = f'{type(error).__name__}: {error}'
+    if trace.duration < SLOW_UPDATE_SECONDS:
+        return
+    stages = ', '.join(f'{name}{f" x{count}" if count > 1 else ""} {seconds:.2f}s' for name, count, seconds in trace.totals()[:6])
+    print(f'Slow {trace.name}: {trace.duration:.2f}s ({stages})')
+    for sink in slow_sinks:
+        sink(trace)
+
+class TracedRequest(HTTPXRequest):
+    """Bot API requests as spans, so replies and file downloads show up in a trace."""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # file URLs carry the token, only the method name goes into the span
+        name = 'telegram.download' if '/file/bot' in url else f"telegram.{url.rsplit('/', 1)[-1]}"
+        with span(name):
+            return await super().do_request(url, method, *args, **kwargs)
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# same as ApplicationBuilder.concurrent_updates(True)
+MAX_CONCURRENT_UPDATES = 256
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time per chat.
+
+    The persistent ConversationHandlers keep their state and the draft in
+    ``user_data``; two quick messages from the same user handled at once would
+    race on both. Updates of different chats still run side by side, up to
+    ``max_concurrent_updates``. An update waits for its chat before it takes a
+    slot, so a busy chat doesn't hold the slots of the others.
+    """
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # chat id -> [lock, updates holding or waiting for it]
+        self._chats: Dict[int, List] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        # inline queries and the like have no chat, only a user
+        return update.effective_user.id if update.effective_user else None
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        chat = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
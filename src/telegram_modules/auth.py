@@ -0,0 +1,81 @@
+import asyncio
+import functools
+import os
+import re
+from typing import Iterable, Optional, Set
+
+from telegram import Update
+from telegram.ext import ContextTypes, ConversationHandler
+
+from dal import db
+
+AUTH_CONFIG_KEY = 'AuthorizedUser'
+
+response_welcome = '''
+Welcome, here's your ID: {userId}, send it to my creator so you can be allowed to post,
+meanwhile check what I can do:
+/bluesky_post: the basic, I will ask for image and/or text and write a post (can also QRT or reply to a post)
+/repost: repost a Bluesky post by URL
+/update_profile: this allows to set Name, Description, Profile Picture or Banner
+/list_posts: I try to keep track of things I posted, this will list and allow to add replies or delete something
+/stop: if something broke or you want to stop what you're doing, this is the command
+'''
+
+class AuthorizedUsers():
+    """In-memory set of the Telegram user IDs allowed to post.
+
+    Loaded from ``db.Config`` on first use and replaced in place by :meth:`set`,
+    so checking an update never touches Mongo.
+    """
+    def __init__(self):
+        self._ids: Optional[Set[int]] = None
+
+    def _load(self) -> Set[int]:
+        config = db.Config.objects(Key = AUTH_CONFIG_KEY).first()
+        if not config or not config.Value:
+            return set()
+        return {int(user_id) for user_id in re.split(r'[,\s]+', config.Value.strip()) if user_id}
+
+    async def is_authorized(self, user_id: int) -> bool:
+        if self._ids is None:
+            self._ids = await asyncio.to_thread(self._load)
+        return user_id in self._ids
+
+    async def set(self, user_ids: Iterable[int]):
+        ids = set(user_ids)
+
+        def save():
+            config = db.Config.objects(Key = AUTH_CONFIG_KEY).first()
+            newConfig = db.Config() if not config else config
+            newConfig.Key = AUTH_CONFIG_KEY
+            newConfig.Value = ','.join(str(user_id) for user_id in sorted(ids))
+            newConfig.save()
+
+        await asyncio.to_thread(save)
+        self._ids = ids
+
+authorized_users = AuthorizedUsers()
+
+def is_admin(user_id: int) -> bool:
+    return user_id == int(os.getenv('ADMIN_ID'))
+
+def authorized(handler):
+    """Only run the handler for authorized users, everyone else gets the welcome text."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        if not await authorized_users.is_authorized(user_id):
+            await update.effective_message.reply_text(response_welcome.replace('{userId}', str(user_id)))
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
+
+def admin_only(handler):
+    """Only run the handler for the ADMIN_ID user."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_admin(update.effective_user.id):
+            await update.effective_message.reply_text('these are not the droids you are looking for ')
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
@@ -1,23 +1,17 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, CallbackQueryHandler,Application
 
-import os
-import base64
+import re
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
 
-from service.bluesky_service import BlueskyService
-from dal import db
+from service.bluesky_service import AsyncBlueskyService, is_valid_bluesky_url
+from service.images import ImageRef
+from service.outbox import outbox
+from service.tracing import span
+from telegram_modules.auth import authorized
 
-STATE_POST_TEXT, STATE_POST_REPOST, STATE_POST_IMAGE, STATE_ADD_IMAGE, STATE_POST_KEYBOARD_CALLBACK, SELECT_WHAT_TO_UPDATE, UPDATE_TEXT, UPDATE_IMAGE, STATE_REPOST = range(9)
-
-response_welcome = '''
-Welcome, here's your ID: {userId}, send it to my creator so you can be allowed to post,
-meanwhile check what I can do:
-/bluesky_post: the basic, I will ask for image and/or text and write a post (can also QRT or reply to a post)
-/repost: repost a Bluesky post by URL
-/update_profile: this allows to set Name, Description, Profile Picture or Banner
-/list_posts: I try to keep track of things I posted, this will list and allow to add replies or delete something
-/stop: if something broke or you want to stop what you're doing, this is the command
-'''
+STATE_POST_TEXT, STATE_POST_REPOST, STATE_POST_IMAGE, STATE_ADD_IMAGE, STATE_POST_KEYBOARD_CALLBACK, SELECT_WHAT_TO_UPDATE, UPDATE_TEXT, UPDATE_IMAGE, STATE_REPOST, STATE_POST_SCHEDULE, STATE_REPLY_TEXT = range(11)
 
 # region post
 
@@ -42,13 +36,8 @@ responding to this post:
 {respond_url}
     '''
 
+@authorized
 async def bsky_post_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-    
     text = ""
     if not (context.user_data.get('post_text') or 
             context.user_data.get('post_images')):
@@ -74,7 +63,8 @@ async def bsky_post_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE)
         keyboard.append([InlineKeyboardButton('Image (add another)', callback_data='post_images_add')])
     
     if context.user_data.get('post_text') or context.user_data.get('post_images'):
-        keyboard.append([InlineKeyboardButton('Send :D', callback_data='post_send')])
+        keyboard.append([InlineKeyboardButton('Send :D', callback_data='post_send'),
+                         InlineKeyboardButton('Send at...', callback_data='post_schedule')])
 
     if update.message:
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -117,119 +107,301 @@ async def bsky_post_images_add(update: Update, _: ContextTypes.DEFAULT_TYPE) ->
 async def bsky_post_images_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     if update.message.photo:
-        image = await update.message.photo[-1].get_file()
-        image_bytes = await image.download_as_bytearray()
-        image_base64 = base64.b64encode(image_bytes).decode('ascii')
-        context.user_data['post_images'] = [ image_base64 ]
+        # keep only the file reference, the bytes are fetched when the post is sent
+        context.user_data['post_images'] = [ ImageRef.from_photo(update.message.photo[-1]) ]
 
     return await bsky_post_keyboard(update, context)
 
 async def bsky_post_images_keyboard_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.photo:
-        image = await update.message.photo[-1].get_file()
-        image_bytes = await image.download_as_bytearray()
-        image_base64 = base64.b64encode(image_bytes).decode('ascii')
-        
         if 'post_images' not in context.user_data:
             context.user_data['post_images'] = []
         
-        context.user_data['post_images'].append(image_base64)
+        context.user_data['post_images'].append(ImageRef.from_photo(update.message.photo[-1]))
     
     return await bsky_post_keyboard(update, context)
 
-async def bsky_post_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-    
+def parse_schedule_time(text: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Parse "+30m"/"+2h"/"+1d", "HH:MM" (next occurrence) or "YYYY-MM-DD HH:MM" in local time.
+
+    Returns:
+        datetime: naive UTC time, like the rest of the database, or None if it can't be parsed.
+    """
+    now = now or datetime.now()
+    text = text.strip()
+    local = None
+    relative = re.fullmatch(r'\+(\d+)\s*([mhd])', text)
+    if relative:
+        amount, unit = int(relative.group(1)), relative.group(2)
+        unit_name = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[unit]
+        local = now + timedelta(**{unit_name: amount})
+    else:
+        for pattern in ('%Y-%m-%d %H:%M', '%H:%M'):
+            try:
+                parsed = datetime.strptime(text, pattern)
+            except ValueError:
+                continue
+            if pattern == '%H:%M':
+                parsed = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+                if parsed <= now:
+                    parsed += timedelta(days=1)
+            local = parsed
+            break
+    if not local:
+        return None
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def enqueue_draft(update: Update, context: ContextTypes.DEFAULT_TYPE, due_at: Optional[datetime] = None) -> bool:
     text = context.user_data.get('post_text')
-    images_base64 = context.user_data.get('post_images')
-    if not text and not images_base64:
-        await update.message.reply_text('Please, try again and provide text or image.')
-        return ConversationHandler.END
+    images = context.user_data.get('post_images')
+    if not text and not images:
+        await update.effective_message.reply_text('Please, try again and provide text or image.')
+        return False
     
     qrt_link = context.user_data.get('post_repost')
     respond_to = context.user_data.get('post_respond_to')
     
+    # stored before the draft is dropped, the outbox worker sends it (and retries)
+    with span('draft.enqueue'):
+        await outbox.enqueue('post', {
+            'text': text,
+            'images': [image.to_dict() for image in images or []],
+            'qrt_link': qrt_link,
+            'respond_to': respond_to,
+        }, chat_id=update.effective_chat.id, due_at=due_at)
     context.user_data.clear()
-    service = BlueskyService()
-    service.post(text, images_base64, qrt_link, respond_to)
-    await update.callback_query.edit_message_text('Post sent')
+    return True
+
+@authorized
+async def bsky_post_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if await enqueue_draft(update, context):
+        await update.callback_query.edit_message_text('Post queued, I\'ll let you know when it\'s sent')
     return ConversationHandler.END
 
+async def bsky_post_schedule(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.callback_query.edit_message_text(
+        'When should I send it? Use +30m / +2h / +1d, HH:MM or YYYY-MM-DD HH:MM')
+    return STATE_POST_SCHEDULE
+
+@authorized
+async def bsky_post_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    due_at = parse_schedule_time(update.message.text)
+    if not due_at:
+        await update.message.reply_text('Couldn\'t read that time, try again (+30m, +2h, 18:30, 2025-01-31 18:30)')
+        return STATE_POST_SCHEDULE
+    if due_at <= datetime.utcnow():
+        await update.message.reply_text('That time already passed, try again')
+        return STATE_POST_SCHEDULE
+
+    if await enqueue_draft(update, context, due_at):
+        local_time = due_at.replace(tzinfo=timezone.utc).astimezone()
+        await update.message.reply_text(f'Post scheduled for {local_time:%Y-%m-%d %H:%M}, see /scheduled')
+    return ConversationHandler.END
+
+@authorized
+async def list_scheduled(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    jobs = await outbox.scheduled()
+    if not jobs:
+        await update.message.reply_text('No scheduled posts')
+        return
+    lines = []
+    for job in jobs:
+        local_time = job.due_at.replace(tzinfo=timezone.utc).astimezone()
+        text = job.payload.get('text') or f"{len(job.payload.get('images') or [])} images"
+        lines.append(f"{local_time:%Y-%m-%d %H:%M}: {text}\n /unschedule_{job.idempotency_key}")
+    await update.message.reply_text('\n-------------------\n'.join(lines))
+
+@authorized
+async def unschedule(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    idempotency_key = update.message.text.split('_', 1)[-1]
+    if await outbox.cancel(idempotency_key):
+        await update.message.reply_text('Scheduled post cancelled')
+    else:
+        await update.message.reply_text('That post was already sent or cancelled')
+
 # endregion
 
 # region list posts
 
-async def list_posts(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return
-    
-    service = BlueskyService()
-    posts = service.list_posts()
+@authorized
+async def list_posts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    before_id = after_id = None
+    if update.callback_query:
+        # list_posts_older_<id> / list_posts_newer_<id>
+        await update.callback_query.answer()
+        _, _, direction, cursor = update.callback_query.data.split('_')
+        if direction == 'older':
+            before_id = int(cursor)
+        else:
+            after_id = int(cursor)
+
+    service = await AsyncBlueskyService.create()
+    posts, has_older, has_newer = await service.list_posts(before_id=before_id, after_id=after_id)
     if not posts:
-        await update.message.reply_text('No posts found')
+        await update.effective_message.reply_text('No posts found')
+        return
+
+    with span('render.list_posts'):
+        posts_formatted = '\n-------------------\n'.join([f"{post.text}\n /reply_{post.id} /delete_{post.id} /thread_{post.id}" for post in posts])
+
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton('<< Newer', callback_data=f'list_posts_newer_{posts[0].id}'))
+    if has_older:
+        buttons.append(InlineKeyboardButton('Older >>', callback_data=f'list_posts_older_{posts[-1].id}'))
+    # remembered for the multi-select delete keyboard of this page
+    context.user_data['delete_candidates'] = [(post.id, post.text or '') for post in posts]
+    context.user_data['delete_selected'] = []
+    rows = [buttons] if buttons else []
+    rows.append([InlineKeyboardButton('Select posts to delete', callback_data='delete_select')])
+    reply_markup = InlineKeyboardMarkup(rows)
+
+    if update.callback_query:
+        await update.callback_query.edit_message_text(posts_formatted, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(posts_formatted, reply_markup=reply_markup)
 
-    posts_formatted = '\n-------------------\n'.join([f"{post.text}\n /reply_{post.id} /delete_{post.id}" for post in posts])
-    await update.message.reply_text(posts_formatted)
+# endregion
+
+# region thread
+
+# Telegram rejects messages over 4096 characters
+MESSAGE_LIMIT = 4000
+THREAD_PREVIEW_CHARS = 200
+MAX_THREAD_INDENT = 4
+
+def render_thread(root: dict, children: dict) -> List[str]:
+    """Depth-first text rendering of a thread, split into Telegram-sized messages."""
+    entries = []
+    stack = [(root, 0)]
+    while stack:
+        doc, depth = stack.pop()
+        stack.extend((child, depth + 1) for child in reversed(children.get(doc['_id'], [])))
+        if doc.get('deleted'):
+            entries.append('(deleted post)')
+            continue
+        text = doc.get('text') or '(no text)'
+        if len(text) > THREAD_PREVIEW_CHARS:
+            text = text[:THREAD_PREVIEW_CHARS] + '…'
+        indent = '    ' * min(depth, MAX_THREAD_INDENT)
+        marker = '↳ ' if depth else ''
+        entries.append(f"{indent}{marker}{text}\n{indent}{' ' * len(marker)}/reply_{doc['_id']} /delete_{doc['_id']}")
+
+    messages = ['']
+    for entry in entries:
+        if messages[-1] and len(messages[-1]) + len(entry) + 1 > MESSAGE_LIMIT:
+            messages.append('')
+        messages[-1] += ('\n' if messages[-1] else '') + entry
+    return messages
+
+@authorized
+async def show_thread(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    post_id = int(update.message.text.split('_')[-1])
+    service = await AsyncBlueskyService.create()
+    try:
+        root, children = await service.get_thread(post_id)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    with span('render.thread'):
+        messages = render_thread(root, children)
+    for message in messages:
+        await update.message.reply_text(message)
 
 # endregion
 
 # region delete post
 
+@authorized
 async def delete_post(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return
-
     if len(update.message.text.split('_')) < 2:
         await update.message.reply_text('Please, use the link provided by the list_posts command')
         return
     
     post_id = int(update.message.text.split('_')[-1])
 
-    service = BlueskyService()
-    service.delete_post(post_id)
-    await update.message.reply_text('Post deleted, probably')
+    await outbox.enqueue('delete', {'post_id': post_id}, chat_id=update.effective_chat.id)
+    await update.message.reply_text('Delete queued')
+
+def delete_selection_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+    selected = context.user_data.get('delete_selected', [])
+    rows = [[InlineKeyboardButton(f"{'☑' if post_id in selected else '☐'} {text[:40] or '(no text)'}", callback_data=f'delete_toggle_{post_id}')]
+            for post_id, text in context.user_data.get('delete_candidates', [])]
+    rows.append([
+        InlineKeyboardButton(f'Delete {len(selected)} selected', callback_data='delete_confirm'),
+        InlineKeyboardButton('Cancel', callback_data='delete_cancel'),
+    ])
+    return InlineKeyboardMarkup(rows)
+
+@authorized
+async def select_posts_to_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if 'delete_candidates' not in context.user_data:
+        await query.edit_message_text('This list is out of date, please run /list_posts again')
+        return
+    if query.data.startswith('delete_toggle_'):
+        post_id = int(query.data.split('_')[-1])
+        selected = context.user_data.setdefault('delete_selected', [])
+        if post_id in selected:
+            selected.remove(post_id)
+        else:
+            selected.append(post_id)
+    await query.edit_message_reply_markup(reply_markup=delete_selection_keyboard(context))
+
+@authorized
+async def delete_selected_posts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    selected = context.user_data.pop('delete_selected', [])
+    texts = dict(context.user_data.pop('delete_candidates', []))
+    if query.data == 'delete_cancel' or not selected:
+        await query.edit_message_text('Nothing deleted')
+        return
+
+    # one job for the whole selection, the outbox reports back when it's done
+    await outbox.enqueue('delete', {'post_ids': selected}, chat_id=update.effective_chat.id)
+    lines = [f"• {texts.get(post_id, '')[:40] or post_id}" for post_id in selected]
+    await query.edit_message_text(f'Delete of {len(selected)} posts queued\n' + '\n'.join(lines))
+
+# endregion
+
+# region reply
+
+@authorized
+async def reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['reply_to_post'] = int(update.message.text.split('_')[-1])
+    await update.message.reply_text('Please, send the text of your reply')
+    return STATE_REPLY_TEXT
+
+@authorized
+async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    post_id = context.user_data.pop('reply_to_post', None)
+    if post_id is None:
+        await update.message.reply_text('Please, use the /reply link provided by the list_posts command')
+        return ConversationHandler.END
+    await outbox.enqueue('reply', {'post_id': post_id, 'text': update.message.text}, chat_id=update.effective_chat.id)
+    await update.message.reply_text('Reply queued')
+    return ConversationHandler.END
 
 # endregion
 
 # region repost
 
+@authorized
 async def repost_command(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-    
     await update.message.reply_text('Please, provide the Bluesky post URL to repost')
     return STATE_REPOST
 
+@authorized
 async def handle_repost(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-    
-    if not update.message.text.startswith('https://bsky.app/'):
+    if not is_valid_bluesky_url(update.message.text):
         await update.message.reply_text('This doesn\'t look like a valid Bluesky post URL. Please provide a URL like https://bsky.app/profile/username/post/postid')
         return STATE_REPOST
     
     try:
-        service = BlueskyService()
-        service.repost(update.message.text)
-        await update.message.reply_text('Post reposted successfully')
-    except ValueError as e:
-        await update.message.reply_text(f'Error: {str(e)}')
+        await outbox.enqueue('repost', {'url': update.message.text}, chat_id=update.effective_chat.id)
+        await update.message.reply_text('Repost queued')
     except Exception as e:
         await update.message.reply_text(f'An unexpected error occurred: {str(e)}')
     
@@ -237,6 +409,20 @@ async def handle_repost(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
 
 # endregion
 
+# region outbox
+
+@authorized
+async def outbox_status(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await outbox.stats()
+    text = (f"Outbox: {stats['pending']} pending ({stats['retrying']} waiting for a retry, {stats['scheduled']} scheduled), {stats['running']} running, "
+            f"{stats['done']} done, {stats['failed']} failed\n"
+            f"Since start: {stats['processed']} processed, {stats['retries']} retries")
+    if stats['last_errors']:
+        text += '\nLast failures:\n' + '\n'.join(stats['last_errors'])
+    await update.message.reply_text(text)
+
+# endregion
+
 
 async def stop(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text('Operation cancelled')
@@ -252,13 +438,18 @@ def load(app: Application) -> None:
                  CallbackQueryHandler(bsky_post_repost, pattern="^(quote_repost|response_repost)$"),
                  CallbackQueryHandler(bsky_post_images, pattern="^post_images$"),
                  CallbackQueryHandler(bsky_post_images_add, pattern="^post_images_add$"),
-                 CallbackQueryHandler(bsky_post_send, pattern="^post_send$")],
+                 CallbackQueryHandler(bsky_post_send, pattern="^post_send$"),
+                 CallbackQueryHandler(bsky_post_schedule, pattern="^post_schedule$")],
+            STATE_POST_SCHEDULE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bsky_post_schedule_time)],
             STATE_POST_REPOST: [MessageHandler(filters.TEXT & ~filters.COMMAND, bsky_post_repost_keyboard)],
             STATE_POST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bsky_post_text_keyboard)],
             STATE_POST_IMAGE: [MessageHandler(filters.PHOTO & ~filters.COMMAND, bsky_post_images_keyboard)],
             STATE_ADD_IMAGE: [MessageHandler(filters.PHOTO & ~filters.COMMAND, bsky_post_images_keyboard_add)]
         },
-        fallbacks=[CommandHandler("stop", stop)]
+        fallbacks=[CommandHandler("stop", stop)],
+        # drafts survive a restart, see service.persistence
+        name="bluesky_post",
+        persistent=True
     )
     app.add_handler(post_handler)
 
@@ -267,10 +458,30 @@ def load(app: Application) -> None:
         states={
             STATE_REPOST: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_repost)]
         },
-        fallbacks=[CommandHandler("stop", stop)]
+        fallbacks=[CommandHandler("stop", stop)],
+        name="repost",
+        persistent=True
     )
     app.add_handler(repost_handler)
 
     app.add_handler(CommandHandler("list_posts", list_posts))
+    app.add_handler(CommandHandler("outbox", outbox_status))
+    app.add_handler(CommandHandler("scheduled", list_scheduled))
+    app.add_handler(MessageHandler(filters.Regex('^/unschedule_[a-z2-7]+$'), unschedule))
+    app.add_handler(CallbackQueryHandler(list_posts, pattern="^list_posts_(older|newer)_[0-9]+$"))
+
+    reply_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^/reply_[0-9]+$'), reply_command)],
+        states={
+            STATE_REPLY_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reply)]
+        },
+        fallbacks=[CommandHandler("stop", stop)],
+        name="reply",
+        persistent=True
+    )
+    app.add_handler(reply_handler)
 
-    app.add_handler(MessageHandler(filters.Regex('^/delete_[0-9]+$'), delete_post))
\ No newline at end of file
+    app.add_handler(MessageHandler(filters.Regex('^/delete_[0-9]+$'), delete_post))
+    app.add_handler(CallbackQueryHandler(select_posts_to_delete, pattern="^delete_(select|toggle_[0-9]+)$"))
+    app.add_handler(CallbackQueryHandler(delete_selected_posts, pattern="^delete_(confirm|cancel)$"))
+    app.add_handler(MessageHandler(filters.Regex('^/thread_[0-9]+$'), show_thread))
\ No newline at end of file
@@ -1,52 +1,81 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, CallbackQueryHandler,Application
 
-import os
-import base64
-
-from service.bluesky_service import BlueskyService
-from dal import db
+from service.bluesky_service import AsyncBlueskyService, post_ref_cache
+from service.images import ImageRef
+from service.handles import handle_resolver
+from service.link_preview import link_previews
+from service.session import session_manager
+from service.slow_log import slow_log
+from telegram_modules.auth import admin_only, authorized, authorized_users
 
 #flags
 STATE_POST_TEXT, STATE_POST_REPOST, STATE_POST_IMAGE, STATE_ADD_IMAGE, STATE_POST_KEYBOARD_CALLBACK, SELECT_WHAT_TO_UPDATE, UPDATE_TEXT, UPDATE_IMAGE, STATE_REPOST = range(9)
 
-response_welcome = '''
-Welcome, here's your ID: {userId}, send it to my creator so you can be allowed to post,
-meanwhile check what I can do:
-/bluesky_post: the basic, I will ask for image and/or text and write a post (can also QRT or reply to a post)
-/repost: repost a Bluesky post by URL
-/update_profile: this allows to set Name, Description, Profile Picture or Banner
-/list_posts: I try to keep track of things I posted, this will list and allow to add replies or delete something
-/stop: if something broke or you want to stop what you're doing, this is the command
-'''
-
+@admin_only
 async def set_authorized_user(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.effective_user.id == int(os.getenv('ADMIN_ID')):
-        await update.message.reply_text('these are not the droids you are looking for ')
+    user_ids = update.message.text.replace(',', ' ').split()[1:]
+    if not user_ids:
+        await update.message.reply_text('Please, provide the user id (or several, separated by spaces)')
         return
-    if len(update.message.text.split()) < 2:
-        await update.message.reply_text('Please, provide the user id')
+    if not all(user_id.isdigit() for user_id in user_ids):
+        await update.message.reply_text('User ids must be numbers')
         return
-    user_id = update.message.text.split()[1]
 
-    config = db.Config.objects(Key = 'AuthorizedUser').first()
+    await authorized_users.set(int(user_id) for user_id in user_ids)
+
+    await update.message.reply_text(f'Authorized users set to {", ".join(user_ids)}')
+
+@admin_only
+async def session_stats(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = session_manager.stats()
+    await update.message.reply_text(
+        f"Bluesky session: {stats['logins']} logins, {stats['refreshes']} refreshes, {stats['imports']} restored from storage")
 
-    newConfig = db.Config() if not config else config
-    newConfig.Key = 'AuthorizedUser'
-    newConfig.Value = user_id
-    newConfig.save()
+@admin_only
+async def cache_stats(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    caches = {'handles': handle_resolver.cache, 'posts': post_ref_cache, 'link previews': link_previews.cache}
+    lines = [f"{name}: {s['size']} entries, {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.0%})"
+             for name, s in ((name, cache.stats()) for name, cache in caches.items())]
+    await update.message.reply_text('\n'.join(lines))
 
-    await update.message.reply_text(f'Authorized user set to {user_id}')
+# Telegram rejects messages over 4096 characters
+SLOWLOG_MESSAGE_LIMIT = 4000
+SLOWLOG_STAGES = 8
+
+@admin_only
+async def slowlog(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    entries = await slow_log.latest()
+    if not entries:
+        await update.message.reply_text('No slow updates recorded')
+        return
+    blocks = []
+    for entry in entries:
+        header = f"{entry.started_at:%Y-%m-%d %H:%M:%S} {entry.name} {entry.duration_ms / 1000:.2f}s"
+        if entry.info:
+            header += ' (' + ', '.join(f'{key} {value}' for key, value in entry.info.items()) + ')'
+        lines = [header] + ([f'error: {entry.error}'] if entry.error else [])
+        # the top two levels show where the time went, deeper stages are in the document
+        stages = [stage for stage in entry.spans if stage['depth'] < 2]
+        for stage in stages[:SLOWLOG_STAGES]:
+            ms = 'unfinished' if stage['ms'] is None else f"{stage['ms']:.0f}ms"
+            lines.append(f"{'  ' * (stage['depth'] + 1)}{stage['name']} +{stage['offset_ms']:.0f}ms {ms}")
+        hidden = len(entry.spans) - min(len(stages), SLOWLOG_STAGES) + (entry.dropped or 0)
+        if hidden:
+            lines.append(f'  ... {hidden} more stages')
+        blocks.append('\n'.join(lines))
+
+    text = ''
+    for block in blocks:
+        if len(text) + len(block) + 2 > SLOWLOG_MESSAGE_LIMIT:
+            break
+        text += ('\n\n' if text else '') + block
+    await update.message.reply_text(text or blocks[0][:SLOWLOG_MESSAGE_LIMIT])
 
 # region update profile
 
+@authorized
 async def update_profile(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-    
     keyboard = [[
         InlineKeyboardButton('Name', callback_data='name'), 
         InlineKeyboardButton('Description', callback_data='description'), 
@@ -66,31 +95,24 @@ async def update_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     await update.callback_query.edit_message_text('Please, provide the new image')
     return UPDATE_IMAGE
 
+@authorized
 async def send_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_id = update.effective_user.id
-    auth_config = db.Config.objects(Key = 'AuthorizedUser').first()
-    if not auth_config or auth_config.Value != str(user_id):
-        await update.message.reply_text(response_welcome.replace('{userId}', str(user_id)))
-        return ConversationHandler.END
-
     update_type = context.user_data['update']
     text = update.message.text
-    image_base64 = None
+    image = None
 
     if update.message.photo:
-        image = await update.message.photo[-1].get_file()
-        image_bytes = await image.download_as_bytearray()
-        image_base64 = base64.b64encode(image_bytes).decode('ascii')
+        image = await ImageRef.from_photo(update.message.photo[-1]).load(context.bot)
 
-    service = BlueskyService()
+    service = await AsyncBlueskyService.create()
     if update_type == 'name':
-        service.update_profile(name=text)
+        await service.update_profile(name=text)
     elif update_type == 'description':
-        service.update_profile(description=text)
+        await service.update_profile(description=text)
     elif update_type == 'image':
-        service.update_profile(photo=image_base64)
+        await service.update_profile(photo=image)
     elif update_type == 'banner':
-        service.update_profile(banner=image_base64)
+        await service.update_profile(banner=image)
         
     await update.message.reply_text('Update sent')
     return ConversationHandler.END
@@ -104,6 +126,9 @@ async def stop(update: Update, _: ContextTypes.DEFAULT_TYPE) -> int:
 def load(app: Application) -> None:
 
     app.add_handler(CommandHandler("set_authorized_user", set_authorized_user))
+    app.add_handler(CommandHandler("session_stats", session_stats))
+    app.add_handler(CommandHandler("cache_stats", cache_stats))
+    app.add_handler(CommandHandler("slowlog", slowlog))
 
     update_profile_handler = ConversationHandler(
         entry_points=[CommandHandler("update_profile", update_profile)],
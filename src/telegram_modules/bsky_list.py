@@ -1,44 +1,159 @@
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, CallbackQueryHandler,Application
+from telegram import Message, Update
+from telegram.ext import CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters, Application
 
 import os
+import re
+import time
+from typing import List
 
-from service.bluesky_service import BlueskyService
+from telegram.error import BadRequest
 
-STATE_GIVE_USERNAME = 0
+from service.bluesky_service import AsyncBlueskyService
+from service.list_mirror import list_mirror
+from telegram_modules.auth import admin_only
+
+STATE_GIVE_USERNAME, STATE_GIVE_REMOVE_USERNAME = range(2)
+
+# bigger uploads are almost certainly the wrong file
+MAX_LIST_FILE_BYTES = 1024 * 1024
+# Telegram throttles bots that edit the same message too often
+PROGRESS_INTERVAL = 1.5
+
+handle_regex = re.compile(r'^(did:[a-z0-9]+:[a-zA-Z0-9._:%-]+|([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)$')
 
 list_exists = os.getenv("BLUESKY_LIST", "") != ""
-admin_id = int(os.getenv('ADMIN_ID'))
 
+@admin_only
 async def add_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the process of adding a user to the Bluesky list. (main admin command)"""
-    if not update.effective_user.id == admin_id:
-        await update.message.reply_text('These are not the droids you are looking for ')
     if not list_exists:
         await update.message.reply_text("BLUESKY_LIST environment variable is not set.")
         return ConversationHandler.END
 
     await update.message.reply_text(
-        "Please provide the user handle of the Bluesky user you want to add to the list."
+        "Please provide the handle of the Bluesky user you want to add to the list.\n"
+        "To add many users, send one handle per line or upload a .txt/.csv file."
     )
     return STATE_GIVE_USERNAME
 
+def parse_handles(text: str) -> List[str]:
+    """Pick the handles and DIDs out of a pasted list or a text/CSV file."""
+    handles = []
+    for token in re.split(r'[\s,;]+', text):
+        token = token.strip('"\'').lstrip('@')
+        if handle_regex.match(token):
+            handles.append(token)
+    return handles
+
+async def read_handles(update: Update) -> str:
+    document = update.message.document
+    if not document:
+        return update.message.text
+    if document.file_size and document.file_size > MAX_LIST_FILE_BYTES:
+        raise ValueError(f'File is too big, the limit is {MAX_LIST_FILE_BYTES // 1024} KB')
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    return data.decode('utf-8-sig', errors='replace')
+
+def format_summary(result: dict) -> str:
+    lines = [f"Added {len(result['added'])} users to the list."]
+    if result['already']:
+        lines.append(f"{len(result['already'])} already on the list.")
+    if result['unresolved']:
+        lines.append(f"Could not resolve {len(result['unresolved'])}: " + ', '.join(f'@{h}' for h in result['unresolved'][:20]))
+    if result['failed']:
+        lines.append(f"Failed {len(result['failed'])}: " + ', '.join(f'@{h}' for h, _ in result['failed'][:20]))
+        lines.append(f"Last error: {result['failed'][-1][1]}")
+    return '\n'.join(lines)
+
 async def confirm_added_to_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Confirm the addition of a user to the Bluesky list."""
-    username = update.message.text.strip()
-    if not username:
-        await update.message.reply_text("Username cannot be empty. Please try again.")
+    """Add the given user, or every user in the pasted list or uploaded file, to the Bluesky list."""
+    try:
+        handles = parse_handles(await read_handles(update))
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return STATE_GIVE_USERNAME
+    if not handles:
+        await update.message.reply_text("No handles found. Please try again.")
         return STATE_GIVE_USERNAME
 
-    bluesky_service = BlueskyService()
+    bluesky_service = await AsyncBlueskyService.create()
+    if len(handles) == 1:
+        username = handles[0]
+        try:
+            await bluesky_service.add_to_list(username)
+            await update.message.reply_text(f"User @{username} has been added to the list.")
+        except Exception as e:
+            await update.message.reply_text(f"Failed to add user @{username} to the list: {str(e)}")
+        return ConversationHandler.END
+
+    status = await update.message.reply_text(f"Adding {len(handles)} users to the list...")
+    # hundreds of writes can take minutes under the rate limit, the chat's
+    # other updates shouldn't queue behind them
+    context.application.create_task(bulk_add(bluesky_service, handles, status), update=update)
+    return ConversationHandler.END
+
+async def bulk_add(bluesky_service: AsyncBlueskyService, handles: List[str], status: Message) -> None:
+    """Add the users and keep the status message up to date."""
+    last_edit = time.monotonic()
+
+    async def progress(text: str):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        try:
+            await status.edit_text(text)
+        except BadRequest:
+            # "message is not modified"
+            pass
+
     try:
-        bluesky_service.add_to_list(username)
-        await update.message.reply_text(f"User @{username} has been added to the list.")
+        result = await bluesky_service.bulk_add_to_list(handles, progress)
     except Exception as e:
-        await update.message.reply_text(f"Failed to add user @{username} to the list: {str(e)}")
+        await status.edit_text(f"Failed to add users to the list: {str(e)}")
+        return
 
+    await status.edit_text(format_summary(result))
+
+@admin_only
+async def remove_from_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start the process of removing a user from the Bluesky list."""
+    await update.message.reply_text(
+        "Please provide the handle of the Bluesky user you want to remove from the list."
+    )
+    return STATE_GIVE_REMOVE_USERNAME
+
+async def confirm_removed_from_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Remove the given user from the Bluesky list."""
+    handles = parse_handles(update.message.text)
+    if len(handles) != 1:
+        await update.message.reply_text("Please send exactly one handle.")
+        return STATE_GIVE_REMOVE_USERNAME
+
+    username = handles[0]
+    bluesky_service = await AsyncBlueskyService.create()
+    try:
+        await bluesky_service.remove_from_list(username)
+        await update.message.reply_text(f"User @{username} has been removed from the list.")
+    except Exception as e:
+        await update.message.reply_text(f"Failed to remove user @{username} from the list: {str(e)}")
     return ConversationHandler.END
 
+@admin_only
+async def list_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show how many users are on the Bluesky list."""
+    bluesky_service = await AsyncBlueskyService.create()
+    count = await bluesky_service.list_count()
+    await update.message.reply_text(f"{count} users on the list.")
+
+@admin_only
+async def sync_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Rebuild the local copy of the list, picking up removals made outside the bot."""
+    bluesky_service = await AsyncBlueskyService.create()
+    await list_mirror.sync(bluesky_service.client, full=True)
+    await update.message.reply_text(f"List synced, {await list_mirror.count()} users on the list.")
+
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stop the conversation."""
     await update.message.reply_text("Operation cancelled.")
@@ -54,8 +169,19 @@ def load(app: Application) -> None:
     add_to_list_handler = ConversationHandler(
         entry_points=[CommandHandler('addtolist', add_to_list)],
         states={
-            STATE_GIVE_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_added_to_list)],
+            STATE_GIVE_USERNAME: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, confirm_added_to_list)],
+        },
+        fallbacks=[CommandHandler("stop", stop)]
+    )
+    app.add_handler(add_to_list_handler)
+
+    remove_from_list_handler = ConversationHandler(
+        entry_points=[CommandHandler('removefromlist', remove_from_list)],
+        states={
+            STATE_GIVE_REMOVE_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_removed_from_list)],
         },
         fallbacks=[CommandHandler("stop", stop)]
     )
-    app.add_handler(add_to_list_handler)
\ No newline at end of file
+    app.add_handler(remove_from_list_handler)
+    app.add_handler(CommandHandler('listcount', list_count))
+    app.add_handler(CommandHandler('synclist', sync_list))
@@ -0,0 +1,29 @@
+"""Shared fixtures: a fake PDS and a mongomock database in place of Bluesky and MongoDB."""
+import os
+
+import pytest
+
+from benchmarks.fake_pds import FAKE_DID, FakePds
+
+# the service modules read their settings on import, so the PDS starts before any of them is imported
+_pds = FakePds(latency=0.05).start()
+os.environ['BSKY_SERVICE_URL'] = _pds.url
+os.environ.setdefault('BSKY_USERNAME', 'tests.test')
+os.environ.setdefault('BSKY_PASSWORD', 'tests')
+os.environ['BLUESKY_LIST'] = f'at://{FAKE_DID}/app.bsky.graph.list/testlist'
+os.environ['BSKY_BOT_DATABASE'] = 'bsky_bot_tests'
+
+@pytest.fixture(scope='session')
+def pds() -> FakePds:
+    yield _pds
+    _pds.stop()
+
+@pytest.fixture
+def mongo():
+    """Empty mongomock collections for the test."""
+    from benchmarks.common import reconnect
+    from dal import db
+    reconnect(True)
+    yield db
+    for document in (db.Posts, db.Outbox):
+        document.drop_collection()
@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from service.facets import FacetSpan, extract_spans
+
+SENTENCES = [
+    'Ping @alice.bsky.social about https://example.com/docs?page=2#intro #atproto ',
+    'Ci vediamo domani al caffè con @marco.test, porta la torta! #festa ',
+    '東京で会いましょう @yuki.example.jp https://例え.jp は無視 #日本語タグ ',
+    'مرحبا بالجميع @omar.test #مرحبا https://example.org/ar ',
+    'Family 👨‍👩‍👧 trip 🇮🇹 to see 👍🏽 https://photos.example.com/a/b #travel2024 ',
+]
+
+# tricky pieces random texts are built from: mentions at offset 0, e-mails, URLs
+# with fragments, full-width hashes, emoji, combining marks
+PIECES = ['@', '#', '＃', 'https://', 'http://', 'a.b', 'alice', '.test', 'x.y.z', ' ', '\n', '(', ')', '"', '.',
+          ',', '!', '?', '/', '=', '1', '42', 'é', 'é', '日本', '👍🏽', '🇮🇹', '‍', 'me@x.com', '#tag', 'www.']
+
+def check(text: str):
+    """Spans are ordered, never overlap, fall on character boundaries and decode back to their value."""
+    data = text.encode('UTF-8')
+    previous_end = 0
+    for span in extract_spans(text):
+        assert previous_end <= span.byte_start < span.byte_end <= len(data), f'bad span {span} in {text!r}'
+        covered = data[span.byte_start:span.byte_end].decode('UTF-8')
+        if span.kind == 'link':
+            assert covered == span.value, f'{span} covers {covered!r}'
+        else:
+            assert covered[1:] == span.value and covered[0] in ('@#＃'), f'{span} covers {covered!r}'
+        before = data[:span.byte_start].decode('UTF-8')
+        assert not before or before[-1].isspace() or before[-1] in '([{"\'“‘«', f'{span} starts mid-word in {text!r}'
+        previous_end = span.byte_end
+
+@pytest.mark.parametrize('text', SENTENCES)
+def test_sentences(text):
+    check(text)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_fuzz(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        check(''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 40))))
+
+@pytest.mark.parametrize('text, expected', [
+    ('@alice.test hi', [FacetSpan('mention', 0, 11, 'alice.test')]),
+    ('(@bob.test)', [FacetSpan('mention', 1, 10, 'bob.test')]),
+    ('mail me@x.com', []),
+    ('see https://example.com/a.', [FacetSpan('link', 4, 25, 'https://example.com/a')]),
+    ('#tag, ＃日本 #123', [FacetSpan('tag', 0, 4, 'tag'), FacetSpan('tag', 6, 15, '日本')]),
+    ('x#nope', []),
+])
+def test_spans(text, expected):
+    assert extract_spans(text) == expected
@@ -0,0 +1,14 @@
+import asyncio
+
+def test_posts_overlap(pds, mongo):
+    """Posts from several updates at once reach the PDS together, not one after another."""
+    from service.bluesky_service import AsyncBlueskyService
+
+    async def post_many():
+        service = await AsyncBlueskyService.create()
+        pds.reset_counters()
+        await asyncio.gather(*(service.post(f'concurrent {i}') for i in range(8)))
+
+    asyncio.run(post_many())
+    assert mongo.Posts.objects.count() == 8
+    assert pds.peak_in_flight > 1
@@ -0,0 +1,59 @@
+import pytest
+
+from service.facets import extract_spans, make_facet
+from service.text_split import grapheme_len, grapheme_starts, split_thread
+
+def link_facets(text: str):
+    return [make_facet(span) for span in extract_spans(text) if span.kind == 'link']
+
+def facet_targets(chunks):
+    targets = []
+    for chunk, facets in chunks:
+        data = chunk.encode('UTF-8')
+        targets += [(data[f.index.byte_start:f.index.byte_end].decode('UTF-8'), f.features[0].uri) for f in facets]
+    return targets
+
+def test_facets_follow_their_chunk():
+    text = 'Caffè 👍🏽 https://example.com/näme dopo. ' * 20
+    facets = link_facets(text)
+    chunks = split_thread(text, facets, 50)
+
+    assert len(chunks) > 1
+    targets = facet_targets(chunks)
+    assert len(targets) == len(facets)
+    assert all(covered == uri for covered, uri in targets)
+
+def test_facet_across_a_cut_is_dropped():
+    url = 'https://example.com/' + 'a' * 60
+    chunks = split_thread(f'see {url} ok', link_facets(f'see {url} ok'), 30)
+
+    assert all(not facets for _, facets in chunks)
+
+def test_fits_in_one_post():
+    text = 'x' * 300
+    assert split_thread(text, []) == [(text, [])]
+
+def test_breaks_at_sentence_end():
+    chunks = split_thread('First sentence here. Second one goes on and on', [], 30)
+    assert [chunk for chunk, _ in chunks] == ['First sentence here.', 'Second one goes on and on']
+
+@pytest.mark.parametrize('text', [
+    '👨‍👩‍👧' * 12,
+    'é' * 12,
+    '🇮🇹🇫🇷' * 6,
+    '👍🏽' * 12,
+])
+def test_cuts_between_graphemes(text):
+    chunks = split_thread(text, [], 5)
+
+    assert ''.join(chunk for chunk, _ in chunks) == text
+    assert all(grapheme_len(chunk) <= 5 for chunk, _ in chunks)
+    # a cluster cut in two would count twice
+    assert sum(grapheme_len(chunk) for chunk, _ in chunks) == grapheme_len(text)
+
+def test_grapheme_starts():
+    assert list(grapheme_starts('a👍🏽é🇮🇹\r\nb')) == [0, 1, 3, 5, 7, 9]
+
+@pytest.mark.parametrize('text', ['', '   ', '\n\n', ' \t\n '])
+def test_whitespace_only_gives_one_empty_post(text):
+    assert split_thread(text, []) == [('', [])]
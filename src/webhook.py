@@ -0,0 +1,56 @@
+from typing import List, Optional
+
+from telegram import Update
+from telegram.ext import (Application, BaseHandler, CallbackQueryHandler, ChatJoinRequestHandler, ChatMemberHandler,
+                          ChosenInlineResultHandler, CommandHandler, ConversationHandler, InlineQueryHandler,
+                          MessageHandler, PollAnswerHandler, PollHandler, PreCheckoutQueryHandler, ShippingQueryHandler)
+
+# which Update field each handler type reacts to
+_HANDLER_UPDATES = [
+    # our message handlers read update.message, edited messages and channel posts would break them
+    (CommandHandler, ['message']),
+    (MessageHandler, ['message']),
+    (CallbackQueryHandler, ['callback_query']),
+    (InlineQueryHandler, ['inline_query']),
+    (ChosenInlineResultHandler, ['chosen_inline_result']),
+    (ChatMemberHandler, ['my_chat_member', 'chat_member']),
+    (ChatJoinRequestHandler, ['chat_join_request']),
+    (PollAnswerHandler, ['poll_answer']),
+    (PollHandler, ['poll']),
+    (PreCheckoutQueryHandler, ['pre_checkout_query']),
+    (ShippingQueryHandler, ['shipping_query']),
+]
+
+def _handler_updates(handler: BaseHandler) -> Optional[List[str]]:
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested += list(state_handlers)
+        types = []
+        for child in nested:
+            child_types = _handler_updates(child)
+            if child_types is None:
+                return None
+            types += child_types
+        return types
+    for handler_type, types in _HANDLER_UPDATES:
+        if isinstance(handler, handler_type):
+            return types
+    # TypeHandler, custom handlers: can't tell, so they get everything
+    return None
+
+def allowed_updates(app: Application) -> List[str]:
+    """Update types the registered handlers can act on, for getUpdates/setWebhook.
+
+    Telegram then doesn't send (and we don't parse) edits, reactions, polls and
+    the rest nobody listens to. Falls back to every type when a handler's
+    interest can't be worked out.
+    """
+    types = set()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler_types = _handler_updates(handler)
+            if handler_types is None:
+                return Update.ALL_TYPES
+            types.update(handler_types)
+    return sorted(types)